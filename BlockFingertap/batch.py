@@ -0,0 +1,197 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import hashlib
+import json
+import numpy as np
+import os
+import pandas as pd
+import sys
+import yaml
+
+# modules shared by both experiments (common/) are in the parent directory
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.timeline import Timeline
+from utils import conform_condition, get_condition_events, make_design, output_name
+opj = os.path.join
+opd = os.path.dirname
+
+def read_manifest(fname):
+    """ Reads a manifest with one run per row and columns `subject`, `session`, `run`, `condition` and (optionally) `acquisition`; tab-, comma- or whitespace-separated """
+
+    df = pd.read_csv(fname, sep=None, engine="python", dtype=str, comment="#")
+    df.columns = [col.strip().lower() for col in df.columns]
+
+    missing = [col for col in ["subject","session","run","condition"] if col not in df.columns]
+    if len(missing) > 0:
+        raise ValueError(f"Manifest '{fname}' is missing column(s) {missing}")
+
+    if "acquisition" not in df.columns:
+        df["acquisition"] = None
+
+    runs = []
+    for _, row in df.iterrows():
+        acq = row["acquisition"] if isinstance(row["acquisition"], str) and row["acquisition"] not in ["", "None"] else None
+        runs.append({
+            "subject": row["subject"].strip(),
+            "session": row["session"].strip(),
+            "run": row["run"].strip(),
+            "condition": conform_condition(row["condition"].strip()),
+            "acquisition": acq
+        })
+
+    return runs
+
+def run_seed(master_seed, name):
+    """ Independent seed for run `name`: the master seed, with a spawn key derived from the name. The seed only depends on the run itself, not on the other runs in the manifest or their order """
+
+    digest = hashlib.sha256(name.encode("utf8")).digest()
+    spawn_key = tuple(int.from_bytes(digest[i:i+4], "little") for i in range(0, 16, 4))
+    return np.random.SeedSequence(master_seed, spawn_key=spawn_key)
+
+def trial_table(timeline):
+
+    # stimuli of the timeline, with onsets relative to the start of the experiment (i.e., after the dummy screen)
+    rows = timeline.rows[timeline.rows["condition"] >= 0]
+    stim, iti = rows[rows["phase"] == 0], rows[rows["phase"] == 1]
+    return pd.DataFrame({
+        "trial_nr": stim["trial_nr"],
+        "condition": np.asarray(timeline.conditions)[stim["condition"]],
+        "onset": np.round(stim["onset"], 5),
+        "duration": stim["duration"],
+        "iti": np.round(iti["duration"], 5)
+    })
+
+def generate_run(kwargs):
+
+    # worker: one complete design; everything it needs is in `kwargs`, so it can run in any process
+    spec = kwargs["spec"]
+    design_settings = kwargs["design"]
+    name = output_name(spec["subject"], spec["session"], spec["run"], spec["condition"], spec["acquisition"])
+    seed = run_seed(kwargs["master_seed"], name)
+    events = get_condition_events(spec["condition"])
+
+    design = make_design(
+        len(events),
+        design_settings.get("n_repeats"),
+        mean_duration=design_settings.get("mean_iti_duration"),
+        minimal_duration=design_settings.get("minimal_iti_duration"),
+        maximal_duration=design_settings.get("maximal_iti_duration"),
+        leeway=design_settings.get("total_iti_duration_leeway"),
+        static_isi=design_settings.get("static_isi"),
+        randomize=design_settings.get("randomize"),
+        max_run=design_settings.get("max_run_length"),
+        rng=np.random.default_rng(seed),
+        verbose=False)
+
+    out_dir = kwargs["out_dir"]
+    np.savetxt(opj(out_dir, f"{name}_itis.txt"), design["itis"])
+    np.savetxt(opj(out_dir, f"{name}_order.txt"), design["movement"], fmt="%d")
+
+    timeline = Timeline.from_design(
+        np.column_stack([np.full(len(design["itis"]), float(design_settings.get("stim_duration"))), design["itis"]]),
+        ["stim","iti"],
+        design["movement"],
+        events,
+        start_duration=design_settings.get("start_duration"),
+        end_duration=design_settings.get("end_duration"))
+
+    trials = trial_table(timeline)
+    trials.to_csv(opj(out_dir, f"{name}_trials.tsv"), sep="\t", index=False)
+
+    return {
+        "name": name,
+        **spec,
+        "spawn_key": list(seed.spawn_key),
+        "n_trials": int(len(design["itis"])),
+        "total_iti": float(design["itis"].sum())
+    }
+
+def generate_batch(runs, settings, out_dir, master_seed=None, n_jobs=None, verbose=True):
+    """generate_batch
+
+    Generates the design of every run in `runs` in parallel. Each run gets its own random stream, derived from `master_seed` and the name of the run (see :func:`run_seed`), so that a single run can be regenerated bit-for-bit later, by itself or as part of another manifest.
+
+    Parameters
+    ----------
+    runs: list
+        Dictionaries with 'subject', 'session', 'run', 'condition' and 'acquisition' (see :func:`read_manifest`)
+    settings: dict
+        Settings of the experiment; the `design`-block is used
+    out_dir: str
+        Output directory; gets `<output_str>_itis.txt`, `<output_str>_order.txt` and `<output_str>_trials.tsv` per run, plus `batch.json` with the seeds
+    master_seed: int, optional
+        Seed of the study; a random one is drawn (and stored in `batch.json`) if None
+    n_jobs: int, optional
+        Number of processes (default: all CPUs)
+    verbose: bool
+        Print progress
+
+    Returns
+    ----------
+    list
+        One dictionary per run with its name, spawn key, number of trials and total ITI
+    """
+
+    if master_seed is None:
+        master_seed = int(np.random.SeedSequence().entropy)
+
+    # ITI/order files in the settings are for single runs; the batch always generates
+    design_settings = dict(settings["design"])
+    for key in ["iti_file", "order_file", "seed", "cache_dir", "design_dir"]:
+        design_settings.pop(key, None)
+
+    os.makedirs(out_dir, exist_ok=True)
+    jobs = [{"spec": spec, "design": design_settings, "master_seed": master_seed, "out_dir": out_dir} for spec in runs]
+    names = [output_name(spec["subject"], spec["session"], spec["run"], spec["condition"], spec["acquisition"]) for spec in runs]
+    if len(set(names)) < len(names):
+        raise ValueError("Manifest contains duplicate runs")
+
+    n_jobs = os.cpu_count() if n_jobs is None else n_jobs
+    if n_jobs > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=min(n_jobs, len(jobs))) as pool:
+            results = list(pool.map(generate_run, jobs))
+    else:
+        results = [generate_run(job) for job in jobs]
+
+    with open(opj(out_dir, "batch.json"), 'w') as f_out:
+        json.dump({
+            "created": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            "master_seed": master_seed,
+            "design": design_settings,
+            "runs": results
+        }, f_out, indent=2, default=str)
+
+    if verbose:
+        print(f"Wrote designs of {len(results)} runs to '{out_dir}' (master seed = {master_seed})")
+
+    return results
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Pre-generate the designs of all runs in a manifest (columns subject, session, run, condition[, acquisition])")
+    parser.add_argument('manifest')
+    parser.add_argument('--settings', default=opj(opd(os.path.abspath(__file__)), 'settings.yml'))
+    parser.add_argument('--seed', type=int, default=None, help="master seed of the study (default: `seed` in the design-settings, or a random one)")
+    parser.add_argument('--n_jobs', type=int, default=None)
+    parser.add_argument('--out_dir', default=opj(opd(os.path.abspath(__file__)), 'designs', 'batch'))
+    args = parser.parse_args()
+
+    with open(args.settings, 'r', encoding='utf8') as f_in:
+        settings = yaml.safe_load(f_in)
+
+    master_seed = args.seed
+    if master_seed is None and isinstance(settings["design"].get("seed"), int):
+        master_seed = settings["design"].get("seed")
+
+    generate_batch(
+        read_manifest(args.manifest),
+        settings,
+        args.out_dir,
+        master_seed=master_seed,
+        n_jobs=args.n_jobs)
+
+    print(f"Set `design_dir: {args.out_dir}` in the design-settings to run these designs")
+
+if __name__ == "__main__":
+    main()
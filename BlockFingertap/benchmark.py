@@ -0,0 +1,73 @@
+import contextlib
+import io
+import numpy as np
+import os
+import sys
+
+# modules shared by both experiments (common/) are in the parent directory
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.benchmark import Benchmark
+
+bench = Benchmark(
+    os.path.dirname(os.path.abspath(__file__)),
+    "MotorSession",
+    condition="RL",
+    description="Benchmark startup, trial construction and per-frame cost of MotorSession (runs headless)")
+
+#---------------------------------------------------------------------------------------------------
+# CASES
+
+@bench.case("iterative_itis", n_trials=[18,60,180], leeway=[0.5,2.,8.])
+def bench_iterative_itis(n_trials, leeway):
+    from common.itis import iterative_itis
+    design = bench.load_settings()['design']
+    rng = np.random.default_rng(0)
+    return lambda: iterative_itis(
+        mean_duration=design['mean_iti_duration'],
+        minimal_duration=design['minimal_iti_duration'],
+        maximal_duration=design['maximal_iti_duration'],
+        n_trials=n_trials,
+        leeway=leeway,
+        rng=rng)
+
+@bench.case("session_init", display=True, use_movies=[False,True], preload=[False,True])
+def bench_session_init(use_movies, preload, output_dir=None):
+    return lambda: bench.make_session(output_dir, condition="RBL", stimuli__use_movies=use_movies, stimuli__preload_stimuli=preload)
+
+@bench.case("create_trials", display=True, n_repeats=[6,20,60], leeway=[2.,8.])
+def bench_create_trials(n_repeats, leeway, output_dir=None):
+    session = bench.make_session(
+        output_dir,
+        condition="RBL",
+        n_repeats=n_repeats,
+        total_iti_duration_leeway=leeway,
+        iti_file=None,
+        order_file=None,
+        intended_duration=None)
+
+    def create_trials():
+        with contextlib.redirect_stdout(io.StringIO()):
+            session.create_trials()
+
+    return create_trials
+
+@bench.case("draw", display=True, use_movies=[False,True], rasterize=[False,True], phase=[0,1])
+def bench_draw(use_movies, rasterize, phase, output_dir=None):
+    session = bench.make_session(output_dir, condition="RBL", stimuli__use_movies=use_movies, stimuli__rasterize_stimuli=rasterize)
+    with contextlib.redirect_stdout(io.StringIO()):
+        session.create_trials()
+
+    # on a real window (--display), flip without waiting for the refresh so the GPU-side cost counts too
+    trial = session.trials[1]
+    trial.phase = phase
+    session.win.waitBlanking = False
+    def frame():
+        trial.draw()
+        session.win.flip()
+
+    return frame
+
+#---------------------------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    bench.main()
@@ -0,0 +1,370 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import math
+import numpy as np
+import os
+import sys
+import time
+import yaml
+from order import balanced_order
+
+# modules shared by both experiments (common/) are in the parent directory
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.itis import iti_acceptance_rate, _return_itis
+from utils import conform_condition, get_condition_events
+opj = os.path.join
+opd = os.path.dirname
+
+def double_gamma_hrf(dt, length=32., peak=6., undershoot=16., ratio=1/6.):
+
+    # canonical (SPM-style) double-gamma HRF sampled at `dt`, normalized to unit sum
+    t = np.arange(0, length, dt)
+    def gamma_pdf(t, a):
+        with np.errstate(divide="ignore"):
+            return np.exp((a-1)*np.log(t) - t - math.lgamma(a))
+
+    hrf = gamma_pdf(t, peak) - ratio*gamma_pdf(t, undershoot)
+    return hrf/hrf.sum()
+
+def default_contrasts(n_events):
+
+    # each event vs baseline, plus all pairwise differences between events
+    contrasts = list(np.eye(n_events))
+    for i in range(n_events):
+        for j in range(i+1, n_events):
+            c = np.zeros(n_events)
+            c[i], c[j] = 1, -1
+            contrasts.append(c)
+
+    return np.array(contrasts)
+
+def sample_itis(n_designs, mean_duration, minimal_duration, maximal_duration, n_trials, leeway, rng=None, batch_size=4096, max_batches=1000, min_acceptance=1e-6):
+
+    # draw `n_designs` ITI-vectors that satisfy the total-duration constraint of `iterative_itis`; like it, raise up front if the constraint is (nearly) infeasible
+    if rng is None:
+        rng = np.random.default_rng()
+
+    p_accept = iti_acceptance_rate(
+        mean_duration=mean_duration,
+        minimal_duration=minimal_duration,
+        maximal_duration=maximal_duration,
+        n_trials=n_trials,
+        leeway=leeway)
+
+    if p_accept < min_acceptance:
+        raise ValueError(f"Expected acceptance rate ({p_accept:.2e}) is below {min_acceptance:.0e}; increase 'total_iti_duration_leeway' ({leeway}) or change the ITI-settings")
+
+    total_iti_duration = n_trials * mean_duration
+    itis = []
+    n_found = 0
+    n_batches = 0
+    while n_found < n_designs:
+        if n_batches == max_batches:
+            raise ValueError(f"Could only create {n_found} of {n_designs} ITI-vectors with a total duration of {total_iti_duration}±{leeway}s after {max_batches*batch_size} draws")
+
+        batch = _return_itis(
+            mean_duration=mean_duration,
+            minimal_duration=minimal_duration,
+            maximal_duration=maximal_duration,
+            n_trials=n_trials,
+            n_batch=batch_size,
+            rng=rng)
+
+        batch = batch[np.abs(batch.sum(axis=1)-total_iti_duration) <= leeway]
+        itis.append(batch)
+        n_found += batch.shape[0]
+        n_batches += 1
+
+    return np.concatenate(itis)[:n_designs]
+
+def sample_orders(n_designs, n_events, n_repeats, rng=None, randomize=True, max_run=None):
+
+    # (n_designs,n_trials) matrix of event indices, each event occurring `n_repeats` times; 'balanced' draws orders with balanced transitions (see order.py)
+    if rng is None:
+        rng = np.random.default_rng()
+
+    if randomize == "balanced":
+        return np.stack([balanced_order(n_events, n_repeats, max_run=max_run, rng=rng) for _ in range(n_designs)])
+
+    orders = np.tile(np.arange(0,n_events), (n_designs,n_repeats))
+    if randomize:
+        orders = rng.permuted(orders, axis=1)
+
+    return orders
+
+def design_matrices(itis, orders, n_events, stim_duration, start_duration, total_duration, dt=0.1, hrf=None):
+
+    """design_matrices
+
+    Build HRF-convolved design matrices for a stack of candidate designs at once. Trial `i` starts at `start_duration + i*stim_duration + sum(itis[:i])` and lasts `stim_duration` seconds, following the `[stim, iti]` phases of `MotorTrial`.
+
+    Parameters
+    ----------
+    itis: numpy.ndarray
+        ITIs of shape (n_designs,n_trials)
+    orders: numpy.ndarray
+        Event indices of shape (n_designs,n_trials)
+    n_events: int
+        Number of event types
+    stim_duration: float
+        Duration of each stimulus
+    start_duration: float
+        Baseline period before the first trial
+    total_duration: float
+        Duration of the simulated run
+    dt: float
+        Temporal resolution (s) of the simulated signal
+    hrf: numpy.ndarray, optional
+        HRF sampled at `dt`; defaults to :func:`double_gamma_hrf`
+
+    Returns
+    ----------
+    numpy.ndarray
+        Design matrices of shape (n_designs,n_timepoints,n_events+1); the last column is the intercept
+    """
+
+    if hrf is None:
+        hrf = double_gamma_hrf(dt)
+
+    n_designs, n_trials = itis.shape
+    n_t = int(np.ceil(total_duration/dt))
+
+    # onsets/offsets in samples
+    onsets = start_duration + np.arange(n_trials)*stim_duration
+    onsets = onsets + np.concatenate([np.zeros((n_designs,1)), np.cumsum(itis[:,:-1], axis=1)], axis=1)
+    on_ix = np.clip(np.round(onsets/dt).astype(int), 0, n_t)
+    off_ix = np.clip(np.round((onsets+stim_duration)/dt).astype(int), 0, n_t)
+
+    # boxcars from cumulative impulses
+    boxcars = np.zeros((n_designs, n_events, n_t+1))
+    design_ix = np.repeat(np.arange(n_designs)[:,None], n_trials, axis=1)
+    np.add.at(boxcars, (design_ix, orders, on_ix), 1)
+    np.add.at(boxcars, (design_ix, orders, off_ix), -1)
+    boxcars = np.cumsum(boxcars[...,:n_t], axis=-1)
+
+    # convolve all regressors in one go
+    n_fft = 1 << int(np.ceil(np.log2(n_t+hrf.shape[0])))
+    regressors = np.fft.irfft(np.fft.rfft(boxcars, n_fft, axis=-1) * np.fft.rfft(hrf, n_fft), n_fft, axis=-1)[...,:n_t]
+
+    X = np.ones((n_designs, n_t, n_events+1))
+    X[...,:n_events] = regressors.transpose(0,2,1)
+    return X
+
+def design_efficiency(X, contrasts):
+
+    # A-optimal estimation efficiency, 1/trace(C (X'X)^-1 C'), per design matrix
+    contrasts = np.atleast_2d(contrasts)
+    n_regressors = X.shape[-1]
+    if contrasts.shape[1] < n_regressors:
+        contrasts = np.hstack([contrasts, np.zeros((contrasts.shape[0], n_regressors-contrasts.shape[1]))])
+
+    XtX = np.einsum("nti,ntj->nij", X, X)
+    inv = np.linalg.pinv(XtX)
+    variance = np.einsum("ci,nij,cj->n", contrasts, inv, contrasts)
+    return 1/variance
+
+def _optimize_chunk(kwargs):
+
+    # score one chunk of candidates; runs in a worker process
+    rng = np.random.default_rng(kwargs.pop("seed"))
+    n_candidates = kwargs.pop("n_candidates")
+    batch_size = kwargs.pop("batch_size")
+    design = kwargs["design"]
+    hrf = double_gamma_hrf(kwargs["dt"])
+
+    best = (-np.inf, None, None)
+    scores = []
+    for start in range(0, n_candidates, batch_size):
+        n = min(batch_size, n_candidates-start)
+        itis = sample_itis(
+            n,
+            mean_duration=design["mean_iti_duration"],
+            minimal_duration=design["minimal_iti_duration"],
+            maximal_duration=design["maximal_iti_duration"],
+            n_trials=kwargs["n_trials"],
+            leeway=design["total_iti_duration_leeway"],
+            rng=rng)
+
+        orders = sample_orders(
+            n,
+            kwargs["n_events"],
+            design["n_repeats"],
+            rng=rng,
+            randomize=kwargs["randomize"],
+            max_run=design.get("max_run_length"))
+
+        X = design_matrices(
+            itis,
+            orders,
+            kwargs["n_events"],
+            design["stim_duration"],
+            design["start_duration"],
+            kwargs["total_duration"],
+            dt=kwargs["dt"],
+            hrf=hrf)
+
+        eff = design_efficiency(X, kwargs["contrasts"])
+        scores.append(eff)
+        ix = np.argmax(eff)
+        if eff[ix] > best[0]:
+            best = (eff[ix], itis[ix], orders[ix])
+
+    return best, np.concatenate(scores)
+
+def optimize_design(
+    settings,
+    condition,
+    n_candidates=None,
+    n_jobs=None,
+    seed=None,
+    dt=None,
+    contrasts=None,
+    randomize=True,
+    batch_size=256,
+    verbose=False):
+
+    """optimize_design
+
+    Generate candidate ITI/order designs from the `design` block of the settings, score their estimation efficiency for `contrasts` and return the best one. Candidates are split in chunks that are scored in parallel over a process pool.
+
+    Parameters
+    ----------
+    settings: dict
+        Settings as read from `settings.yml`
+    condition: str
+        Condition as passed to `MotorSession` (e.g., 'RL', 'RBL')
+    n_candidates: int, optional
+        Number of candidate designs; defaults to `optimizer_candidates` in the settings (or 5000)
+    n_jobs: int, optional
+        Number of worker processes; defaults to the number of CPUs
+    seed: int, optional
+        Seed for reproducible designs
+    dt: float, optional
+        Temporal resolution of the simulated signal; defaults to `optimizer_resolution` in the settings (or 0.1s)
+    contrasts: array-like, optional
+        Contrast matrix of shape (n_contrasts,n_events); defaults to `optimizer_contrasts` in the settings, or each event plus all pairwise differences
+    randomize: bool
+        Randomize the order of events across candidates; if False, only the ITIs are optimized. With `randomize: balanced` in the settings, candidate orders have balanced transitions and at most `max_run_length` repeats (see :func:`order.balanced_order`)
+    batch_size: int
+        Number of candidates scored at once within a worker
+    verbose: bool
+        Print progress information
+
+    Returns
+    ----------
+    dict
+        With keys 'itis', 'order', 'efficiency' (best design) and 'scores' (all candidates)
+    """
+
+    design = settings["design"]
+    events = get_condition_events(condition)
+    n_events = len(events)
+    n_trials = n_events*design["n_repeats"]
+
+    if n_candidates is None:
+        n_candidates = design.get("optimizer_candidates", 5000)
+
+    if not isinstance(dt, (int,float)):
+        dt = design.get("optimizer_resolution", 0.1)
+
+    if contrasts is None:
+        contrasts = design.get("optimizer_contrasts")
+
+    if not isinstance(contrasts, (list,np.ndarray)):
+        contrasts = default_contrasts(n_events)
+
+    if n_jobs is None:
+        n_jobs = os.cpu_count() or 1
+
+    if randomize and design.get("randomize") == "balanced":
+        randomize = "balanced"
+
+    # simulate up to the intended duration if specified
+    total_duration = design["start_duration"] + n_trials*(design["stim_duration"]+design["mean_iti_duration"]) + design["total_iti_duration_leeway"] + design["end_duration"]
+    if isinstance(design.get("intended_duration"), (int,float)):
+        total_duration = max(total_duration, design["intended_duration"])
+
+    # independent random streams per chunk
+    seeds = np.random.SeedSequence(seed).spawn(n_jobs)
+    chunks = np.diff(np.linspace(0, n_candidates, n_jobs+1).astype(int))
+    jobs = [
+        {
+            "design": design,
+            "n_events": n_events,
+            "n_trials": n_trials,
+            "total_duration": total_duration,
+            "dt": dt,
+            "contrasts": np.asarray(contrasts, dtype=float),
+            "randomize": randomize,
+            "n_candidates": int(n),
+            "batch_size": batch_size,
+            "seed": s
+        } for n,s in zip(chunks,seeds) if n > 0
+    ]
+
+    start = time.perf_counter()
+    if len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=len(jobs)) as pool:
+            results = list(pool.map(_optimize_chunk, jobs))
+    else:
+        results = [_optimize_chunk(jobs[0])]
+
+    scores = np.concatenate([scores for _,scores in results])
+    efficiency, itis, order = max([best for best,_ in results], key=lambda x: x[0])
+
+    if verbose:
+        print(f"Scored {len(scores)} designs in {round(time.perf_counter()-start,2)}s with {len(jobs)} worker(s); best efficiency = {efficiency:.4f} (median = {np.median(scores):.4f})")
+
+    return {
+        "itis": itis,
+        "order": order,
+        "efficiency": efficiency,
+        "scores": scores
+    }
+
+def write_design(itis, order, out_dir=None, desc=None):
+
+    # write ITIs and order in the formats read by `MotorSession.create_trials`
+    if out_dir is None:
+        out_dir = opd(os.path.abspath(__file__))
+
+    if desc is None:
+        desc = len(itis)
+
+    os.makedirs(out_dir, exist_ok=True)
+    iti_file = opj(out_dir, f"itis_desc-{desc}_events.txt")
+    order_file = opj(out_dir, f"itis_desc-{desc}_order.txt")
+    np.savetxt(iti_file, itis)
+    np.savetxt(order_file, order, fmt="%d")
+    return iti_file, order_file
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Find an efficient ITI/order design for MotorSession")
+    parser.add_argument('condition', default="RL", nargs='?')
+    parser.add_argument('--settings', default=opj(opd(os.path.abspath(__file__)), 'settings.yml'))
+    parser.add_argument('--n_candidates', type=int, default=None)
+    parser.add_argument('--n_jobs', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--fixed_order', action='store_true', help="only optimize the ITIs, keep the tiled order of events")
+    parser.add_argument('--out_dir', default=None)
+    parser.add_argument('--desc', default=None)
+    args = parser.parse_args()
+
+    with open(args.settings, 'r', encoding='utf8') as f_in:
+        settings = yaml.safe_load(f_in)
+
+    best = optimize_design(
+        settings,
+        conform_condition(args.condition),
+        n_candidates=args.n_candidates,
+        n_jobs=args.n_jobs,
+        seed=args.seed,
+        randomize=not args.fixed_order,
+        verbose=True)
+
+    iti_file, order_file = write_design(best["itis"], best["order"], out_dir=args.out_dir, desc=args.desc)
+    print(f"Wrote '{iti_file}' and '{order_file}'; set these as `iti_file` and `order_file` in the settings")
+
+if __name__ == "__main__":
+    main()
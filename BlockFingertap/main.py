@@ -1,8 +1,12 @@
 import argparse
 from datetime import datetime
 import os
-from psychopy import logging
-from session import MotorSession
+import sys
+
+# modules shared by both experiments (common/) are in the parent directory
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.startup import StartupProfile
+from utils import conform_condition, output_name
 opj = os.path.join
 opd = os.path.dirname
 
@@ -13,58 +17,73 @@ parser.add_argument('session', default=None, nargs='?')
 parser.add_argument('run', default=None, nargs='?')
 parser.add_argument('condition', default=None, nargs='?')
 parser.add_argument('acquisition', default=None, nargs='?')
+parser.add_argument('--simulate', action='store_true', help="run headless and faster than real-time with simulated scanner triggers")
+parser.add_argument('--frame_rate', type=float, default=60., help="refresh rate in simulation mode")
+parser.add_argument('--tr', type=float, default=None, help="trigger interval in simulation mode (default: 'TR' in the mri-settings)")
+parser.add_argument('--tr_drift', type=float, default=0., help="relative deviation of the simulated scanner's TR (e.g., 1e-4)")
+parser.add_argument('--tr_jitter', type=float, default=0., help="standard deviation (s) of the simulated trigger timing")
+parser.add_argument('--profile-startup', action='store_true', help="report where the time goes until the first trigger screen")
 
+# psychopy and exptools2 are only imported once the prompts have been answered
 cmd_args = parser.parse_args()
+profile = StartupProfile(enabled=cmd_args.profile_startup)
 subject, session, run, condition, acquisition = cmd_args.subject, cmd_args.session, cmd_args.run, cmd_args.condition, cmd_args.acquisition
 
 if subject is None:
-    subject = input('Subject? (999): ')
+    subject = input('Subject? (999): ') if not cmd_args.simulate else ''
     subject = 999 if subject == '' else subject
 
 if session is None:
-    session = input('Session? (0): ')
+    session = input('Session? (0): ') if not cmd_args.simulate else ''
     session = 0 if session == '' else session
 
 if run is None:
-    run = input('Run? (0): ')
+    run = input('Run? (0): ') if not cmd_args.simulate else ''
     run = 0 if run == '' else run
 
 if condition is None:
-    condition = input('Condition? (RL): ')
+    condition = input('Condition? (RL): ') if not cmd_args.simulate else ''
     condition = "RL" if condition == '' else condition    
 
 if acquisition is None:
-    acquisition = input('Acquisition? (None): ')
+    acquisition = input('Acquisition? (None): ') if not cmd_args.simulate else ''
     acquisition = None if acquisition == '' else acquisition    
 
 cmd = f"""python main.py {subject} {session} {run} {condition} {acquisition}"""
 print(f"\n{cmd}\n")
 
 # conform to specific order
-if condition == "LR":
-    condition = "RL"
-elif condition == "BR":
-    condition = "RB"
-elif condition == "BL":
-    condition = "LB"
-elif condition == "all":
-    condition = "RBL"
-elif condition == "demo":
-    condition = "demo"    
-
-add_acq = ""
-if isinstance(acquisition, str):
-    add_acq = f"_acq-{acquisition}"
-
-output_str = f'sub-{subject}_ses-{session}_run-{run}_task-{condition}{add_acq}'
+condition = conform_condition(condition)
+output_str = output_name(subject, session, run, condition, acquisition)
 settings_fn = opj(opd(__file__), 'settings.yml')
 
 output_dir = './logs/'+output_str
 
+# simulation replaces the window, clock and keyboard; must be set up before the session (and exptools2) is imported
+simulator = None
+if cmd_args.simulate:
+    from common.simulate import Simulator
+    simulator = Simulator(frame_rate=cmd_args.frame_rate, tr=cmd_args.tr, tr_drift=cmd_args.tr_drift, tr_jitter=cmd_args.tr_jitter).install()
+
+with profile.section("import"):
+    from psychopy import logging
+    from exptools2.core import Session
+    from session import MotorSession
+    from trial import DummyWaiterTrial, MotorTrial
+
 if os.path.exists(output_dir):
     logging.warn("Warning: output directory already exists. Renaming to avoid overwriting.")
     output_dir = output_dir + datetime.now().strftime('%Y%m%d%H%M%S')
 
+profile.instrument(Session, "_load_settings", "settings")
+profile.instrument(Session, "_create_window", "window")
+# stimuli are created while waiting for the scanner, so report once the first trial starts
+profile.instrument(MotorSession, "create_stimuli", "fixation")
+profile.instrument(MotorSession, "create_stim", "stimuli")
+profile.instrument(MotorSession, "create_trials", "trials")
+profile.instrument(DummyWaiterTrial, "run", "waiting")
+profile.report_before(MotorTrial, "run", "first trial")
+
 # define session
 session_object = MotorSession(
     output_str=output_str, 
@@ -73,5 +92,12 @@ session_object = MotorSession(
     condition=condition)
 
 logging.warn(f'Writing results to: {opj(session_object.output_dir, session_object.output_str)}')
+if simulator is not None:
+    simulator.attach(session_object)
+
 session_object.run()
 session_object.close()
+profile.restore()
+
+if simulator is not None:
+    simulator.uninstall()
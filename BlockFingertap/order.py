@@ -0,0 +1,199 @@
+import argparse
+import numbers
+import numpy as np
+import os
+import sys
+
+# modules shared by both experiments (common/) are in the parent directory
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+opj = os.path.join
+opd = os.path.dirname
+
+def transition_counts(order, n_events=None):
+    """ (n_events,n_events) number of times event i is followed by event j in `order` """
+
+    order = np.asarray(order, dtype=int)
+    if n_events is None:
+        n_events = order.max()+1
+
+    counts = np.zeros((n_events,n_events), dtype=int)
+    np.add.at(counts, (order[:-1], order[1:]), 1)
+    return counts
+
+def run_lengths(order):
+    """ Length of every run of the same event in `order` """
+
+    order = np.asarray(order)
+    if order.size == 0:
+        return np.zeros(0, dtype=int)
+
+    edges = np.flatnonzero(np.diff(order) != 0)+1
+    return np.diff(np.concatenate([[0], edges, [order.size]]))
+
+def transition_targets(n_events, n_repeats, max_run=None, rng=None):
+
+    # transition counts of a cyclic order with `n_repeats` of each event: row and column sums are `n_repeats`, counts differ at most 1 between pairs. The leftover transitions are whole cyclic shifts i -> i+k (of a random relabeling of the events), so the sums stay exact. With a maximum run length, repeats (shift 0) are never leftovers, so that each event keeps as many runs as possible
+    if rng is None:
+        rng = np.random.default_rng()
+
+    shifts = np.arange(n_events) if max_run is None or max_run > 1 else np.arange(1, n_events)
+    leftovers = shifts if max_run is None else shifts[shifts > 0]
+    q, r = divmod(n_repeats, shifts.size)
+    for _ in range(100):
+        extra = np.concatenate([np.repeat(shifts, q), rng.choice(leftovers, r, replace=False)])
+        targets = np.zeros((n_events,n_events), dtype=int)
+        rows = np.repeat(np.arange(n_events), extra.size)
+        np.add.at(targets, (rows, (rows+np.tile(extra, n_events)) % n_events), 1)
+
+        # all events must be reachable without repeating one; the shifts must not share a divisor with n_events
+        if np.gcd.reduce(np.append(extra[extra > 0], n_events)) == 1:
+            break
+    else:
+        raise ValueError(f"Could not connect {n_events} events with {n_repeats} repeats")
+
+    labels = rng.permutation(n_events)
+    relabeled = np.zeros_like(targets)
+    relabeled[np.ix_(labels,labels)] = targets
+    return relabeled
+
+def _euler_circuit(targets, start, rng):
+
+    # random Eulerian circuit (Hierholzer) through a multigraph with `targets[i,j]` edges i -> j
+    n_events = targets.shape[0]
+    edges = [list(rng.permutation(np.repeat(np.arange(n_events), targets[i]))) for i in range(n_events)]
+    stack = [start]
+    circuit = []
+    while stack:
+        node = stack[-1]
+        if edges[node]:
+            stack.append(edges[node].pop())
+        else:
+            circuit.append(stack.pop())
+
+    return circuit[::-1]
+
+def balanced_order(n_events, n_repeats, max_run=None, rng=None):
+    """balanced_order
+
+    Order of `n_events` events, each occurring `n_repeats` times, in which every event is followed by every other event (and by itself) equally often (up to one), and no event occurs more than `max_run` times in a row.
+
+    As for de Bruijn sequences, the order is a walk through the complete graph of transitions: the number of times each transition should occur is fixed first (:func:`transition_targets`), then a random Eulerian circuit through those transitions gives an order that contains each of them exactly that often. Repetitions of an event are taken out of the graph beforehand and distributed over its visits afterwards, so that runs never exceed `max_run`. The circuit is cut open at a random point, which drops one transition. This takes time proportional to the number of trials, so it does not need a search over shuffles.
+
+    Parameters
+    ----------
+    n_events: int
+        Number of different events
+    n_repeats: int
+        Number of times each event occurs
+    max_run: int, optional
+        Maximum number of times an event occurs in a row; None for no limit
+    rng: numpy.random.Generator, optional
+        Random generator; a fresh one is created if None
+
+    Returns
+    ----------
+    numpy.ndarray
+        Event indices of length `n_events*n_repeats`
+    """
+
+    if rng is None:
+        rng = np.random.default_rng()
+
+    if max_run in [None, "None"]:
+        max_run = None
+    elif isinstance(max_run, numbers.Integral) and not isinstance(max_run, bool):
+        max_run = int(max_run)
+    else:
+        raise ValueError(f"Maximum run length must be an integer or None, not {max_run!r}")
+
+    if max_run is not None and max_run < 1:
+        raise ValueError(f"Maximum run length must be at least 1, not {max_run}")
+
+    if n_events == 1:
+        if max_run is not None and n_repeats > max_run:
+            raise ValueError(f"A single event cannot be repeated {n_repeats} times with a maximum run length of {max_run}")
+        return np.zeros(n_repeats, dtype=int)
+
+    targets = transition_targets(n_events, n_repeats, max_run=max_run, rng=rng)
+
+    # each visit of an event in the circuit becomes one run of that event
+    repeats = np.diag(targets).copy()
+    n_runs = n_repeats-repeats
+    if max_run is not None and np.any(n_runs*max_run < n_repeats):
+        raise ValueError(f"Cannot balance {n_events} events with {n_repeats} repeats within a maximum run length of {max_run}")
+
+    np.fill_diagonal(targets, 0)
+    circuit = _euler_circuit(targets, rng.integers(n_events), rng)[:-1]
+
+    # cut the cycle open at a random point
+    circuit = np.roll(circuit, -rng.integers(len(circuit)))
+
+    # split the visits of each event into runs of at most `max_run`
+    lengths = np.zeros(len(circuit), dtype=int)
+    for event in range(n_events):
+        visits = np.flatnonzero(circuit == event)
+        lengths[visits] = _split_runs(n_repeats, n_runs[event], max_run, rng)
+
+    return np.repeat(circuit, lengths)
+
+def _split_runs(total, n_runs, max_run, rng):
+
+    # random lengths of `n_runs` runs in [1,max_run] that add up to `total`
+    if max_run is None:
+        max_run = total
+
+    lengths = np.ones(n_runs, dtype=int)
+    for _ in range(total-n_runs):
+        open_runs = np.flatnonzero(lengths < max_run)
+        lengths[rng.choice(open_runs)] += 1
+
+    return lengths
+
+def order_summary(order, n_events=None):
+    """ Number of trials, longest run and the spread (max-min) of the transition counts of `order` """
+
+    counts = transition_counts(order, n_events=n_events)
+    off_diagonal = counts[~np.eye(counts.shape[0], dtype=bool)]
+    return {
+        "n_trials": len(order),
+        "max_run": int(run_lengths(order).max()) if len(order) > 0 else 0,
+        "transitions_min": int(off_diagonal.min()) if off_diagonal.size > 0 else 0,
+        "transitions_max": int(off_diagonal.max()) if off_diagonal.size > 0 else 0,
+        "repeats": int(np.trace(counts))
+    }
+
+def write_order(order, fname):
+
+    # same format as the order-files read by `make_design`
+    np.savetxt(fname, order, fmt="%d")
+    return fname
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Create an order of events with balanced transitions and a maximum run length, as an order-file for MotorSession")
+    parser.add_argument('condition', default="RBL", nargs='?')
+    parser.add_argument('--n_repeats', type=int, default=None, help="defaults to `n_repeats` in the settings")
+    parser.add_argument('--max_run', type=int, default=None, help="defaults to `max_run_length` in the settings")
+    parser.add_argument('--settings', default=opj(opd(os.path.abspath(__file__)), 'settings.yml'))
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--out', default=None, help="defaults to itis_desc-<n_trials>_order.txt")
+    args = parser.parse_args()
+
+    import yaml
+    from utils import conform_condition, get_condition_events
+    with open(args.settings, 'r', encoding='utf8') as f_in:
+        design = yaml.safe_load(f_in)["design"]
+
+    events = get_condition_events(conform_condition(args.condition))
+    n_repeats = args.n_repeats if args.n_repeats is not None else design.get("n_repeats")
+    max_run = args.max_run if args.max_run is not None else design.get("max_run_length")
+
+    order = balanced_order(len(events), n_repeats, max_run=max_run, rng=np.random.default_rng(args.seed))
+    fname = args.out if args.out is not None else opj(opd(os.path.abspath(__file__)), f"itis_desc-{len(order)}_order.txt")
+    write_order(order, fname)
+
+    summary = order_summary(order, len(events))
+    print(f"Wrote '{fname}' ({summary['n_trials']} trials of {', '.join(events)}): each event followed by another {summary['transitions_min']}-{summary['transitions_max']} times, {summary['repeats']} repeats, longest run = {summary['max_run']}")
+
+if __name__ == "__main__":
+    main()
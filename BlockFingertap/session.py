@@ -1,18 +1,26 @@
 from exptools2.core import Session
 import numpy as np
+from common.cache import DesignCache
+from common.session import SessionMixin
 from stimuli import FixationCross, MotorStim, MotorMovie
+from common.timeline import Timeline
 from trial import MotorTrial, DummyWaiterTrial, OutroTrial
 import os
+import pandas as pd
+from utils import *
 opj = os.path.join
 opd = os.path.dirname
 
-class MotorSession(Session):
+class MotorSession(SessionMixin, Session):
     def __init__(
         self, 
         output_str, 
         output_dir, 
         settings_file, 
-        condition=None
+        condition=None,
+        win=None,
+        frame_rate=None,
+        stim_cache=None
         ):
         """ Initializes StroopSession object.
 
@@ -29,11 +37,20 @@ class MotorSession(Session):
             Make link with eyetracker during experiment, default is True
         condition: str, optional
             Which conditions to include in the experiment; options are 'LR' (for left & right hand movement), "LB" (left hand & both hands), and "RB" (right hand & both hands)
+        win: psychopy.visual.Window, optional
+            Window of a previous run to draw in, instead of opening a new one (see runner.py)
+        frame_rate: float, optional
+            Measured refresh rate of `win`
+        stim_cache: dict, optional
+            Stimuli of previous runs, which are reused if the stimulus-settings did not change (see :meth:`common.session.SessionMixin.cached`)
         """
         super().__init__(
             output_str, 
             output_dir=output_dir, 
-            settings_file=settings_file
+            settings_file=settings_file,
+            win=win,
+            frame_rate=frame_rate,
+            stim_cache=stim_cache
         )  # initialize parent class!
 
         self.duration           = self.settings['design'].get('stim_duration')
@@ -52,31 +69,45 @@ class MotorSession(Session):
         self.iti_file           = self.settings['design'].get('iti_file')
         self.order_file         = self.settings['design'].get('order_file')
         self.condition          = condition
+        self.seed               = self.settings['design'].get('seed')
+        self.cache_dir          = self.settings['design'].get('cache_dir')
+
+        # pre-generated design of this run (see batch.py); overrides iti_file/order_file
+        self.design_dir = self.settings['design'].get('design_dir')
+        if isinstance(self.design_dir, str) and self.design_dir != "None":
+            if not os.path.isabs(self.design_dir):
+                self.design_dir = opj(opd(os.path.abspath(__file__)), self.design_dir)
+
+            iti_file = opj(self.design_dir, f"{self.output_str}_itis.txt")
+            order_file = opj(self.design_dir, f"{self.output_str}_order.txt")
+            if not os.path.exists(iti_file) or not os.path.exists(order_file):
+                raise FileNotFoundError(f"No pre-generated design for '{self.output_str}' in '{self.design_dir}'")
+
+            self.iti_file = iti_file
+            self.order_file = order_file
+
+        # seeded generator for ITIs and order; None draws a fresh design
+        if not isinstance(self.seed, int):
+            self.seed = None
+
+        self.rng = np.random.default_rng(self.seed)
+
+        # cache generated designs, keyed by the settings they were generated with
+        if isinstance(self.cache_dir, str) and self.cache_dir != "None":
+            if not os.path.isabs(self.cache_dir):
+                self.cache_dir = opj(opd(os.path.abspath(__file__)), self.cache_dir)
+            self.design_cache = DesignCache(self.cache_dir, verbose=True)
+        else:
+            self.design_cache = None
         
-        # add demo mode with 1 iteration of right/left stim
+        # get events for this condition; demo mode shows 1 iteration of right/left/both
+        self.events = get_condition_events(self.condition)
         if self.condition == "demo":
-            self.events = ["right","left","both"]
             self.start_duration = 2
             self.outro_trial_time = 0
             self.stim_duration = 2
             self.static_isi = 2
             self.n_repeats = 1
-        elif self.condition == "RL":
-            self.events = ["right","left"]
-        elif self.condition == "R":
-            self.events = ["right"]
-        elif self.condition == "L":
-            self.events = ["left"]
-        elif self.condition == "both":
-            self.events = ["both"]        
-        elif self.condition == "LB":
-            self.events = ["left","both"]
-        elif self.condition == "RB":
-            self.events = ["right","both"]
-        elif self.condition == "RBL":
-            self.events = ["right","left","both"]
-        else:
-            raise ValueError(f"Condition must be one of 'RL/LR', 'LB/BL', or 'RB/BR', or 'all [R/L/both]' not '{self.condition}'")
 
         # get total number of trials
         self.n_events = len(self.events)
@@ -87,36 +118,6 @@ class MotorSession(Session):
         self.movie_left = "lhand.mp4"
         self.movie_right = "rhand.mp4"
 
-        # define crossing fixation lines
-        self.fixation = FixationCross(
-            win=self.win, 
-            lineWidth=self.fixation_width, 
-            color=self.fixation_color
-        )
-
-        # define stim:
-        for stim in self.events:
-            if stim == "both":
-                self.display_instructions = f"MOVE BOTH HANDS"
-            else:
-                self.display_instructions = f"MOVE {stim.upper()} HAND"
-
-            # use movies or text..
-            if self.settings["stimuli"].get("use_movies"):
-                stim_obj = MotorMovie(
-                    self,
-                    movie_file=getattr(self, f"movie_{stim}"),
-                    size_factor=self.settings["stimuli"].get("movie_window_scale_factor"))
-            else:
-                stim_obj  = MotorStim(
-                    session=self,
-                    color=self.text_color,
-                    text=self.display_instructions)
-            
-            # set attributes and load into memory
-            setattr(self, f"stim_{stim}", stim_obj)
-            stim_obj.draw()
-            
         # check if we want a cue before stim onset
         self.cue_time = self.settings["design"].get("cue_time")
         if isinstance(self.cue_time, (int,float)):
@@ -125,139 +126,230 @@ class MotorSession(Session):
         else:
             self.cue = False
 
-    def create_trials(self):
-        """ Creates trials (ideally before running your session!) """
+        self.create_stimuli()
 
-        # draw ISIs from negative exponential or take fixed isi
-        if self.condition != "demo":
-            if not isinstance(self.iti_file, str):
-                if not isinstance(self.static_isi, (int,float)):
-                    itis = iterative_itis(
-                        mean_duration=self.settings['design'].get('mean_iti_duration'),
-                        minimal_duration=self.settings['design'].get('minimal_iti_duration'),
-                        maximal_duration=self.settings['design'].get('maximal_iti_duration'),
-                        n_trials=self.n_trials,
-                        leeway=self.settings['design'].get('total_iti_duration_leeway'),
-                        verbose=True)
-                else:
-                    itis = np.full(self.n_trials, self.static_isi)
-            else:
-                print(f"Reading ITI-file: {self.iti_file}")
-                itis = np.loadtxt(self.iti_file, dtype=float)
+    def create_stimuli(self):
+        """ Creates the fixation cross; the stimuli for the events are created on first use or while waiting for the scanner (see :meth:`idle`), unless `preload_stimuli` is set """
+
+        # define crossing fixation lines; with `rasterize_stimuli`, every color variant is rendered to a texture once
+        self.rasterized = bool(self.settings["stimuli"].get("rasterize_stimuli"))
+        self.fixation = self.cached("fixation", lambda: FixationCross(
+            win=self.win, 
+            lineWidth=self.fixation_width, 
+            color=self.fixation_color,
+            rasterized=self.rasterized
+        ))
+        self.fixation.setColor(self.fixation_color)
+
+        if self.rasterized and self.cue:
+            self.fixation.variant(self.cue_color)
+
+        # events in the order they are needed; updated once the design is known
+        self.stimuli = {}
+        self.stim_order = list(self.events)
+        self.prefilled = False
+        if self.settings["stimuli"].get("preload_stimuli"):
+            for stim in self.events:
+                self.get_stim(stim).draw()
+
+    def create_stim(self, stim):
+        """ Creates the text or movie stimulus for event `stim` """
+
+        if stim == "both":
+            display_instructions = f"MOVE BOTH HANDS"
+        else:
+            display_instructions = f"MOVE {stim.upper()} HAND"
+
+        # use movies or text..
+        if self.settings["stimuli"].get("use_movies"):
+            stim_obj = MotorMovie(
+                self,
+                movie_file=getattr(self, f"movie_{stim}"),
+                size_factor=self.settings["stimuli"].get("movie_window_scale_factor"),
+                buffer_frames=self.settings["stimuli"].get("movie_buffer_frames"))
         else:
-            itis = np.full(self.n_trials, self.static_isi)
+            stim_obj  = MotorStim(
+                session=self,
+                color=self.text_color,
+                text=display_instructions,
+                rasterized=self.rasterized)
+
+        return stim_obj
+
+    def get_stim(self, stim):
+        """ Returns the stimulus for event `stim`, creating it if needed """
+        if stim not in self.stimuli:
+            self.stimuli[stim] = self.cached(stim, lambda: self.create_stim(stim))
+
+            # statistics of a movie from a previous run, whose decoding was stopped when that run closed
+            if isinstance(self.stimuli[stim], MotorMovie):
+                self.stimuli[stim].block_stats = []
+                self.stimuli[stim].start_decoding()
+
+        return self.stimuli[stim]
+
+    def idle(self):
+        """ Does one piece of pending work per call (creating a stimulus, or prefilling the first movie); called every frame while waiting for the scanner """
+
+        for stim in self.stim_order:
+            if stim not in self.stimuli:
+                self.get_stim(stim)
+                return
+
+        if not self.prefilled and self.timeline is not None:
+            self.prefill_stim(1)
+            self.prefilled = True
+
+    def end_trial(self, trial):
+        """ Creates the stimuli that were not created while waiting for the scanner (e.g., when the trigger came within a few frames), and prefills the first movie, so that the first trial does not create them in its first frame """
+        if isinstance(trial, DummyWaiterTrial):
+            for stim in self.stim_order:
+                self.get_stim(stim)
+
+            if not self.prefilled:
+                self.prefill_stim(1)
+                self.prefilled = True
+
+    def create_design(self):
+        """ Creates the ITIs and order of events; returns a dictionary with 'itis' and 'movement' """
+
+        # demo mode uses the static ISI and the tiled order
+        demo = self.condition == "demo"
+        return make_design(
+            self.n_events,
+            self.n_repeats,
+            mean_duration=self.settings['design'].get('mean_iti_duration'),
+            minimal_duration=self.settings['design'].get('minimal_iti_duration'),
+            maximal_duration=self.settings['design'].get('maximal_iti_duration'),
+            leeway=self.settings['design'].get('total_iti_duration_leeway'),
+            static_isi=self.static_isi,
+            randomize=False if demo else self.settings['design'].get('randomize'),
+            max_run=self.settings['design'].get('max_run_length'),
+            iti_file=None if demo else self.iti_file,
+            order_file=None if demo else self.order_file,
+            rng=self.rng)
+
+    def load_design(self):
+        """ Loads the design from the cache if the settings (and seed) did not change since it was generated, otherwise creates (and caches) it """
+
+        # without a seed every run draws a new design, so there is nothing to reuse
+        if self.design_cache is None or self.seed is None or self.condition == "demo":
+            return self.create_design()
+
+        key = self.design_cache.key(
+            self.settings["design"],
+            condition=self.condition,
+            seed=self.seed,
+            files=[self.iti_file, self.order_file])
+
+        design = self.design_cache.load(key)
+        if design is None:
+            design = self.create_design()
+            self.design_cache.save(key, f"{self.__class__.__name__}_{self.condition}", **design)
+
+        return design
+
+    def create_trials(self):
+        """ Creates trials (ideally before running your session!) from the timeline of the run """
+
+        design = self.load_design()
+        itis = design["itis"]
         
         # double check
         if len(itis) != self.n_trials:
             raise ValueError(f"Mismatch between number of ITIs ({len(itis)}) and number of trials ({self.n_trials})")
         
-        # calculate full time of experiment
-        self.total_experiment_time = self.start_duration + (self.n_trials * self.stim_duration) + itis.sum() + self.outro_trial_time
+        # planned timing of the whole run; stimulus and ITI of each trial
+        self.timeline = Timeline.from_design(
+            np.column_stack([np.full(self.n_trials, float(self.stim_duration)), itis]),
+            ["stim","iti"],
+            design["movement"],
+            self.events,
+            start_duration=self.start_duration,
+            end_duration=self.outro_trial_time)
 
         # check if we should add time to meet intended_duration
-        self.add_to_total = 0
+        add_to_total = 0
         if self.condition != "demo":
-            if isinstance(self.intended_duration, (int,float)):
-                if self.total_experiment_time < self.intended_duration:
-                    self.add_to_total = self.intended_duration-self.total_experiment_time
-                elif self.intended_duration<self.total_experiment_time:
-                    raise ValueError(f"WARNING: intended duration ({self.intended_duration}) is smaller than total experiment time ({self.total_experiment_time})")
+            add_to_total = self.timeline.pad(self.intended_duration)
             
-        self.total_experiment_time += self.add_to_total
-        self.outro_trial_time += self.add_to_total
-        print(f"Total experiment time = {round(self.total_experiment_time,2)}s (added {self.add_to_total}s, with {self.n_repeats}x {self.events} each")
+        self.total_experiment_time = self.timeline.total_duration
+        print(f"Total experiment time = {round(self.total_experiment_time,2)}s (added {round(add_to_total,2)}s, with {self.n_repeats}x {self.events} each")
         
         # baseline trial beginning exp
-        dummy_trial = DummyWaiterTrial(
-            session=self,
-            trial_nr=0,
-            phase_durations=[np.inf, self.start_duration],
-            phase_names=["dummy","intro"]
-        )
-
-        # baseline trial end of exp
-        outro_trial = OutroTrial(
-            session=self,
-            trial_nr=self.n_trials+1,
-            phase_durations=[self.outro_trial_time],
-            phase_names=["outro"],
-            txt='')
-        
-        # order file
-        if self.condition != "demo":
-            if not isinstance(self.order_file, str):
-                self.movement = np.tile(np.arange(0,self.n_events), self.n_repeats)
-                # shuffle blocks if you want
-                if self.settings['design'].get('randomize'):
-                    np.random.shuffle(self.movement)
-            else:
-                # assume order is randomized already
-                if os.path.exists(self.order_file):
-                    print(f"Reading order-file: {self.order_file}")
-                    self.movement = np.loadtxt(self.order_file, dtype=int)
-                else:
-                    raise FileNotFoundError(f"Could not find requested file: '{self.order_file}'")
-        else:
-            self.movement = np.tile(np.arange(0,self.n_events), self.n_repeats)
+        self.trials = [
+            DummyWaiterTrial(
+                session=self,
+                trial_nr=0,
+                phase_durations=self.timeline.phase_durations(0),
+                phase_names=self.timeline.phase_names(0)
+            )
+        ]
 
-        if len(self.movement) != len(itis):
-            raise ValueError(f"Mismatch between number of ITIs ({len(itis)}) and number of trials ({self.movement})")
-        
-        self.trials = [dummy_trial]
-        for i in range(self.n_trials):
+        for trial_nr in range(1, self.n_trials+1):
             
             # append trial
             self.trials.append(
                 MotorTrial(
                     session=self,
-                    trial_nr=1+i,
-                    phase_durations=[self.stim_duration,itis[i]],
-                    phase_names=['stim','iti'],
-                    parameters={'condition': self.events[self.movement[i]]},
+                    trial_nr=trial_nr,
+                    phase_durations=self.timeline.phase_durations(trial_nr),
+                    phase_names=self.timeline.phase_names(trial_nr),
+                    parameters={'condition': self.timeline.condition(trial_nr)},
                     timing='seconds',
                     verbose=True
                 )
             )
             
-        self.trials.append(outro_trial)
-
-    def run(self):
-        """ Runs experiment. """
-        self.create_trials()  # create them *before* running!
-        self.start_experiment()
-        for trial in self.trials:
-            trial.run()
-
-        self.close()
-
-# iti function based on negative exponential
-def _return_itis(mean_duration, minimal_duration, maximal_duration, n_trials):
-    itis = np.random.exponential(scale=mean_duration-minimal_duration, size=n_trials)
-    itis += minimal_duration
-    itis[itis>maximal_duration] = maximal_duration
-    return itis
-
-def iterative_itis(mean_duration=6, minimal_duration=3, maximal_duration=18, n_trials=None, leeway=0, verbose=False):
-    
-    nits = 0
-    itis = _return_itis(
-        mean_duration=mean_duration,
-        minimal_duration=minimal_duration,
-        maximal_duration=maximal_duration,
-        n_trials=n_trials)
-
-    total_iti_duration = n_trials * mean_duration
-    min_iti_duration = total_iti_duration - leeway
-    max_iti_duration = total_iti_duration + leeway
-    while (itis.sum() < min_iti_duration) | (itis.sum() > max_iti_duration):
-        itis = _return_itis(
-            mean_duration=mean_duration,
-            minimal_duration=minimal_duration,
-            maximal_duration=maximal_duration,
-            n_trials=n_trials)
-        nits += 1
-
-    if verbose:
-        print(f'ITIs created with total ITI duration of {round(itis.sum(),2)}s after {nits} iterations')    
-
-    return itis
+        # baseline trial end of exp
+        self.trials.append(
+            OutroTrial(
+                session=self,
+                trial_nr=self.n_trials+1,
+                phase_durations=self.timeline.phase_durations(self.n_trials+1),
+                phase_names=self.timeline.phase_names(self.n_trials+1),
+                txt=''
+            )
+        )
+
+        # create stimuli in the order in which they appear
+        self.stim_order = [self.events[i] for i in dict.fromkeys(design["movement"].tolist())]
+        self.prefilled = False
+
+        # planned onsets after the first pulse, for TR-locked mode
+        self.create_scheduler(self.timeline.onsets())
+
+        self.instrument_trials()
+
+    def prefill_stim(self, trial_nr):
+        """ Start decoding the movie of `trial_nr` into its frame buffer (no-op for text stimuli) """
+        if 1 <= trial_nr <= self.n_trials:
+            stim = self.get_stim(self.timeline.condition(trial_nr))
+            if isinstance(stim, MotorMovie):
+                stim.prefill()
+
+    def stop_movies(self):
+        """ Stops the decoding workers of the movies, so that they do not keep running after the session """
+        for stim_obj in self.stimuli.values():
+            if isinstance(stim_obj, MotorMovie):
+                stim_obj.stop_decoding()
+
+    def save_movie_stats(self):
+        """ Writes the per-block decoding statistics of the movies to `<output_str>_movies.tsv` """
+        stats = []
+        for stim_obj in self.stimuli.values():
+            if isinstance(stim_obj, MotorMovie):
+                stats += stim_obj.block_stats
+
+        if len(stats) > 0:
+            df = pd.DataFrame(stats).sort_values("trial_nr")
+            df.round({"decode_time": 6, "sync_decode_time": 6}).to_csv(opj(self.output_dir, self.output_str+"_movies.tsv"), sep="\t", index=False)
+
+    def close(self):
+        """ Closes the session and writes the decoding statistics of the movies (see :meth:`common.session.SessionMixin.close` for the rest) """
+        if self.closed:
+            return
+
+        super().close()
+        self.save_movie_stats()
+        self.stop_movies()
@@ -1,12 +1,41 @@
 import numpy as np
-from psychopy.visual import TextStim, ShapeStim, RadialStim, MovieStim3
+import os
+import threading
+import time
+from psychopy.visual import BufferImageStim, TextStim, ShapeStim, MovieStim3
 
 
+def capture_rect(win, stim, margin=4):
+    """ Rectangle (norm units, centered on the screen) that contains `stim`, for `BufferImageStim`; None (the whole window) if the extent of `stim` is not known """
+
+    try:
+        if isinstance(stim, TextStim):
+            w, h = stim.boundingBox
+        else:
+            w, h = 2*np.abs(np.asarray(stim.verticesPix, dtype=float)).max(axis=0)
+        x, y = (np.array([w, h], dtype=float)/2+margin)/(np.asarray(win.size, dtype=float)/2)
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+    x, y = min(x, 1), min(y, 1)
+    return [-x, y, x, -y]
+
+def rasterize(win, stim):
+    """ Renders `stim` once into a texture, which is then drawn as a single textured quad instead of re-rendering `stim` (e.g., the glyphs of a text) every frame. Uses the back buffer, so call it before drawing the frame """
+    return BufferImageStim(win, stim=[stim], rect=capture_rect(win, stim))
+
+def color_key(color):
+    # comparable key for psychopy colors (names, hex strings or rgb-lists)
+    return str(np.asarray(color).tolist())
+
 class FixationCross(object):
 
-    def __init__(self, win, lineWidth, color, *args, **kwargs):
+    def __init__(self, win, lineWidth, color, rasterized=False, *args, **kwargs):
+        self.win        = win
         self.color      = color
         self.linewidth  = lineWidth
+        self.rasterized = rasterized
+        self.variants   = {}
         self.fixation   = ShapeStim(
             win, 
             vertices=((0, -0.1), (0, 0.1), (0,0), (-0.1,0), (0.1, 0)),
@@ -14,16 +43,39 @@ class FixationCross(object):
             closeShape=False,
             lineColor=self.color)
 
+        self.image = self.variant(self.color) if self.rasterized else None
+
+    def variant(self, color):
+        """ Pre-rendered cross in `color` (rendered on first request) """
+
+        key = color_key(color)
+        if key not in self.variants:
+            self.fixation.color = color
+            self.variants[key] = rasterize(self.win, self.fixation)
+            self.fixation.color = self.color
+
+        return self.variants[key]
+
     def draw(self):
-        self.fixation.draw()
+        if self.image is not None:
+            self.image.draw()
+        else:
+            self.fixation.draw()
 
     def setColor(self, color):
-        self.fixation.color = color
+        # only touch the stimulus if the color changes; pre-rendered crosses switch texture instead
+        if color_key(color) == color_key(self.color):
+            return
+
         self.color = color
+        if self.rasterized:
+            self.image = self.variant(color)
+        else:
+            self.fixation.color = color
         
 class MotorStim(object):
 
-    def __init__(self, session, text, color="black", **kwargs):
+    def __init__(self, session, text, color="black", rasterized=False, **kwargs):
         self.session = session
         self.color = color
         self.text = TextStim(
@@ -35,8 +87,168 @@ class MotorStim(object):
             color=self.color,
             **kwargs)
 
+        # instructions never change, so render the glyphs once
+        self.image = rasterize(self.session.win, self.text) if rasterized else None
+
     def draw(self):
-        self.text.draw()
+        if self.image is not None:
+            self.image.draw()
+        else:
+            self.text.draw()
+
+class MovieFrameBuffer():
+
+    def __init__(self, movie_file, capacity=12):
+        """ Bounded ring buffer of decoded movie frames that is filled by a worker thread.
+
+        The worker decodes frames in order (looping at the end of the movie) until the buffer is full, and continues as frames are consumed. Frames are stored in one preallocated uint8 array, so they are ready to be uploaded to the GPU.
+
+        Parameters
+        ----------
+        movie_file : str
+            Movie to decode; the worker opens its own reader
+        capacity : int
+            Number of frames in the buffer, including the frame that is currently displayed
+        """
+        self.movie_file     = movie_file
+        self.capacity       = capacity
+        self.cond           = threading.Condition()
+        self.frames         = None
+        self.slots          = np.full(self.capacity, -1, dtype=np.int64)
+        self.next_decode    = 0     # absolute nr of the next frame to decode
+        self.consumed       = -1    # absolute nr of the last frame handed out
+        self.decode_time    = 0.    # seconds spent decoding by the worker
+        self.n_decoded      = 0
+        self.running        = False
+        self.thread         = None
+        self.ready          = threading.Event()
+
+    def start(self):
+        if self.thread is None:
+            self.running = True
+            self.thread = threading.Thread(target=self._worker, name=f"decode-{self.movie_file}", daemon=True)
+            self.thread.start()
+
+    def stop(self, timeout=1.):
+        """ Stops the worker and waits until it has closed its reader; :meth:`start` starts a new one """
+
+        if self.thread is None:
+            return
+
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+
+        self.thread.join(timeout=timeout)
+        self.thread = None
+        self.ready.clear()
+
+    def reset(self, frame_nr=0):
+        """ Restart decoding at `frame_nr` and discard all buffered frames """
+        with self.cond:
+            self.slots[:] = -1
+            self.next_decode = frame_nr
+            self.consumed = frame_nr-1
+            self.cond.notify_all()
+
+    def fill_level(self):
+        return self.next_decode-self.consumed-1
+
+    def _worker(self):
+        from moviepy.video.io.VideoFileClip import VideoFileClip
+        clip = VideoFileClip(self.movie_file, audio=False)
+        self.fps = clip.fps
+        self.n_frames = max(int(clip.fps*clip.duration), 1)
+        self.ready.set()
+
+        while True:
+            with self.cond:
+                # the slot of the frame that was handed out last stays untouched, as it may still be uploaded
+                while self.running and self.fill_level() >= self.capacity-1:
+                    self.cond.wait()
+
+                if not self.running:
+                    break
+
+                frame_nr = self.next_decode
+
+            start = time.perf_counter()
+            frame = clip.get_frame((frame_nr % self.n_frames)/self.fps)
+            elapsed = time.perf_counter()-start
+
+            with self.cond:
+                if self.frames is None:
+                    self.frames = np.empty((self.capacity,)+frame.shape, dtype=np.uint8)
+
+                # a reset while decoding invalidates this frame
+                if frame_nr == self.next_decode:
+                    self.frames[frame_nr % self.capacity] = frame
+                    self.slots[frame_nr % self.capacity] = frame_nr
+                    self.next_decode += 1
+                    self.decode_time += elapsed
+                    self.n_decoded += 1
+
+        clip.close()
+
+    def get(self, frame_nr):
+        """ Frame `frame_nr` (within the movie) if it is buffered, otherwise None; never blocks on decoding """
+
+        with self.cond:
+
+            # same frame as last time
+            if self.consumed >= 0 and self.consumed % self.n_frames == frame_nr and self.slots[self.consumed % self.capacity] == self.consumed:
+                return self.frames[self.consumed % self.capacity]
+
+            # next occurrence of this frame at or after the current position (the movie loops)
+            position = self.consumed+1
+            absolute = position + (frame_nr - position) % self.n_frames
+            slot = absolute % self.capacity
+            if self.slots[slot] == absolute:
+                self.consumed = absolute
+                self.cond.notify_all()
+                return self.frames[slot]
+
+            # decoding fell behind; continue from the requested frame
+            self.slots[:] = -1
+            self.next_decode = absolute+1
+            self.consumed = absolute
+            self.cond.notify_all()
+            return None
+
+class BufferedClip():
+    """ Wraps the moviepy clip of a MovieStim3: frames come from a MovieFrameBuffer if available and are decoded synchronously otherwise """
+
+    def __init__(self, clip, frame_buffer):
+        self.clip           = clip
+        self.frame_buffer   = frame_buffer
+        self.n_hits         = 0
+        self.n_misses       = 0
+        self.miss_time      = 0.
+
+    def __getattr__(self, name):
+        return getattr(self.clip, name)
+
+    def get_frame(self, t):
+        if self.frame_buffer.ready.is_set():
+            frame = self.frame_buffer.get(int(round(t*self.clip.fps)))
+            if frame is not None:
+                self.n_hits += 1
+                return frame
+
+        start = time.perf_counter()
+        frame = self.clip.get_frame(t)
+        self.miss_time += time.perf_counter()-start
+        self.n_misses += 1
+        return frame
+
+def movie_clip(movie):
+
+    # the moviepy clip that MovieStim3 reads every frame from (`_mov.get_frame`); private, so None if this psychopy version does not have it
+    clip = getattr(movie, "_mov", None)
+    if callable(getattr(clip, "get_frame", None)) and isinstance(getattr(clip, "fps", None), (int,float)):
+        return clip
+
+    return None
 
 class MotorMovie():
 
@@ -45,10 +257,12 @@ class MotorMovie():
         session, 
         movie_file=None, 
         size_factor=0.7, 
+        buffer_frames=None,
         *args, 
         **kwargs):
 
         self.session = session
+        self.movie_file = movie_file
         x,y = self.session.win.size
         new_size = [x*size_factor, y*size_factor]
 
@@ -61,5 +275,67 @@ class MotorMovie():
             *args,
             **kwargs)
         
+        # decode on a worker thread into a ring buffer, by handing MovieStim3 a clip that reads from the buffer
+        self.frame_buffer = None
+        self.clip = None
+        self.block_stats = []
+        if isinstance(buffer_frames, int) and buffer_frames > 0:
+            clip = movie_clip(self.mov)
+            if clip is None:
+                print(f"Movie '{os.path.basename(movie_file)}': this version of MovieStim3 does not read frames from a moviepy clip, so frames are decoded in the render loop ('movie_buffer_frames' is ignored)")
+            else:
+                self.frame_buffer = MovieFrameBuffer(movie_file, capacity=buffer_frames)
+                self.clip = BufferedClip(clip, self.frame_buffer)
+                self.mov._mov = self.clip
+                self.frame_buffer.start()
+
+    def start_decoding(self):
+        """ (Re)starts the decoding worker, e.g., when a movie from a previous run is used again """
+        if self.frame_buffer is not None:
+            self.frame_buffer.start()
+
+    def stop_decoding(self):
+        """ Stops the decoding worker, so that it does not keep running after the session """
+        if self.frame_buffer is not None:
+            self.frame_buffer.stop()
+
+    def prefill(self):
+        """ Start decoding the block from the first frame (e.g., during the preceding ITI) """
+        if self.frame_buffer is not None:
+            self.frame_buffer.reset(0)
+
+    def start_block(self):
+        """ Restart the movie from the first frame """
+        self.mov.seek(0)
+        self.mov.play()
+        if self.frame_buffer is not None:
+            clip = self.clip
+            self.block_start = {
+                "buffered": self.frame_buffer.fill_level(),
+                "decode_time": self.frame_buffer.decode_time,
+                "n_decoded": self.frame_buffer.n_decoded,
+                "n_hits": clip.n_hits,
+                "n_misses": clip.n_misses,
+                "miss_time": clip.miss_time
+            }
+
+    def end_block(self, trial_nr=None):
+        """ Pause the movie and report the decoding time of this block """
+        self.mov.pause()
+        if self.frame_buffer is not None:
+            clip = self.clip
+            stats = {
+                "trial_nr": trial_nr,
+                "movie": os.path.basename(self.movie_file),
+                "prefilled_frames": self.block_start["buffered"],
+                "decoded_frames": self.frame_buffer.n_decoded-self.block_start["n_decoded"],
+                "decode_time": self.frame_buffer.decode_time-self.block_start["decode_time"],
+                "buffer_hits": clip.n_hits-self.block_start["n_hits"],
+                "buffer_misses": clip.n_misses-self.block_start["n_misses"],
+                "sync_decode_time": clip.miss_time-self.block_start["miss_time"]
+            }
+            self.block_stats.append(stats)
+            print(f"Movie '{stats['movie']}': {stats['prefilled_frames']} frames prefilled, decoded {stats['decoded_frames']} frames in {round(stats['decode_time']*1000,1)}ms on the worker; {stats['buffer_misses']} misses ({round(stats['sync_decode_time']*1000,1)}ms in the render loop)")
+
     def draw(self):
         self.mov.draw()
@@ -1,6 +1,7 @@
 import numpy as np
 from exptools2.core import Trial
 from psychopy.visual import TextStim
+from stimuli import MotorMovie
 
 class MotorTrial(Trial):
 
@@ -32,6 +33,10 @@ class MotorTrial(Trial):
                          parameters, timing, load_next_during_phase=None, verbose=verbose)
         self.condition  = self.parameters['condition']
         self.session    = session
+        self.stim       = None
+        self.is_movie   = False
+        self.block_started = False
+        self.block_ended = False
 
     def run(self):
         super().run()
@@ -40,17 +45,34 @@ class MotorTrial(Trial):
         
         if self.phase == 0:  
 
-            # reset fixation cross color
-            self.session.fixation.setColor(self.session.fixation_color)            
+            # movies restart at the first frame, which was decoded during the previous ITI
+            if not self.block_started:
+
+                # reset fixation cross color (once; nothing to do if it did not change)
+                self.session.fixation.setColor(self.session.fixation_color)
+
+                self.stim = self.session.get_stim(self.condition)
+                self.is_movie = isinstance(self.stim, MotorMovie)
+                if self.is_movie:
+                    self.stim.start_block()
+                self.block_started = True
 
             # present instructions
-            getattr(self.session, f"stim_{self.condition}").draw()
+            self.stim.draw()
               
         else:
+            # stop the movie and start decoding the next one
+            if not self.block_ended:
+                if self.is_movie:
+                    self.stim.end_block(trial_nr=self.trial_nr)
+                self.session.prefill_stim(self.trial_nr+1)
+                self.block_ended = True
+
             self.session.fixation.draw()
 
     def get_events(self):
         events = super().get_events()
+        self.session.poll_triggers(self, events)
 
 class InstructionTrial(Trial):
     """ Simple trial with instruction text. """
@@ -91,6 +113,7 @@ class InstructionTrial(Trial):
 
     def get_events(self):
         events = super().get_events()
+        self.session.poll_triggers(self, events)
 
         if self.keys is None:
             if events:
@@ -124,6 +147,10 @@ class DummyWaiterTrial(InstructionTrial):
         )
 
     def draw(self):
+
+        # create stimuli while waiting for the scanner; first, as rendering them to textures uses the back buffer
+        self.session.idle()
+
         if self.phase == 0:
             self.text.draw()
         else:
@@ -131,8 +158,13 @@ class DummyWaiterTrial(InstructionTrial):
 
     def get_events(self):
         events = Trial.get_events(self)
+        triggers = self.session.poll_triggers(self, events)
 
-        if events:
+        # with a trigger listener, its (precisely timed) triggers start the experiment
+        if self.session.trigger_listener is not None:
+            if triggers and self.phase == 0:
+                self.stop_phase()
+        elif events:
             for key, t in events:
                 if key == self.session.mri_trigger:
                     if self.phase == 0:
@@ -152,6 +184,7 @@ class OutroTrial(InstructionTrial):
         
     def get_events(self):
         events = Trial.get_events(self)
+        self.session.poll_triggers(self, events)
 
         if events:
             for key, t in events:
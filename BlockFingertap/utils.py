@@ -0,0 +1,127 @@
+import numpy as np
+import os
+from common.itis import iterative_itis
+from order import balanced_order
+
+def get_condition_events(condition):
+
+    # events included in each condition
+    if condition in ["demo","RBL"]:
+        return ["right","left","both"]
+    elif condition == "RL":
+        return ["right","left"]
+    elif condition == "R":
+        return ["right"]
+    elif condition == "L":
+        return ["left"]
+    elif condition == "both":
+        return ["both"]        
+    elif condition == "LB":
+        return ["left","both"]
+    elif condition == "RB":
+        return ["right","both"]
+    else:
+        raise ValueError(f"Condition must be one of 'RL/LR', 'LB/BL', or 'RB/BR', or 'all [R/L/both]' not '{condition}'")
+
+def conform_condition(condition):
+
+    # conform to specific order (e.g., LR -> RL)
+    aliases = {"LR": "RL", "BR": "RB", "BL": "LB", "all": "RBL"}
+    return aliases.get(condition, condition)
+
+def output_name(subject, session, run, condition, acquisition=None):
+
+    # basename of all files of a run, as used by main.py
+    add_acq = f"_acq-{acquisition}" if isinstance(acquisition, str) else ""
+    return f"sub-{subject}_ses-{session}_run-{run}_task-{condition}{add_acq}"
+
+def make_design(
+    n_events, 
+    n_repeats, 
+    mean_duration=6, 
+    minimal_duration=3, 
+    maximal_duration=18, 
+    leeway=0, 
+    static_isi=None, 
+    randomize=False, 
+    max_run=None, 
+    iti_file=None, 
+    order_file=None, 
+    rng=None, 
+    verbose=True):
+
+    """make_design
+
+    Creates the ITIs and order of events of a run. All randomness comes from `rng`, so a design can be regenerated exactly from the seed of `rng`.
+
+    Parameters
+    ----------
+    n_events: int
+        Number of different events
+    n_repeats: int
+        Number of times each event is repeated; the number of trials is `n_events*n_repeats`
+    mean_duration, minimal_duration, maximal_duration, leeway: float
+        ITI settings passed to :func:`iterative_itis`
+    static_isi: float, optional
+        Use this ITI for all trials instead
+    randomize: bool, str
+        Shuffle the order of events; 'balanced' creates an order in which all transitions between events occur equally often (see :func:`order.balanced_order`); otherwise the events are tiled
+    max_run: int, optional
+        Maximum number of times an event occurs in a row with `randomize='balanced'`
+    iti_file: str, optional
+        Read the ITIs from this file instead
+    order_file: str, optional
+        Read the (already randomized) order from this file instead
+    rng: numpy.random.Generator, optional
+        Random generator for ITIs and order
+    verbose: bool
+        Print progress
+
+    Returns
+    ----------
+    dict
+        'itis' (float array) and 'movement' (int array; index into the events) of length `n_events*n_repeats`
+    """
+
+    if rng is None:
+        rng = np.random.default_rng()
+
+    n_trials = n_events*n_repeats
+
+    # draw ISIs from negative exponential or take fixed isi
+    if isinstance(iti_file, str):
+        if verbose:
+            print(f"Reading ITI-file: {iti_file}")
+        itis = np.loadtxt(iti_file, dtype=float)
+    elif isinstance(static_isi, (int,float)):
+        itis = np.full(n_trials, static_isi)
+    else:
+        itis = iterative_itis(
+            mean_duration=mean_duration,
+            minimal_duration=minimal_duration,
+            maximal_duration=maximal_duration,
+            n_trials=n_trials,
+            leeway=leeway,
+            verbose=verbose,
+            rng=rng)
+
+    # order file
+    if isinstance(order_file, str):
+        # assume order is randomized already
+        if not os.path.exists(order_file):
+            raise FileNotFoundError(f"Could not find requested file: '{order_file}'")
+        if verbose:
+            print(f"Reading order-file: {order_file}")
+        movement = np.loadtxt(order_file, dtype=float).astype(int)
+    elif randomize == "balanced":
+        movement = balanced_order(n_events, n_repeats, max_run=max_run, rng=rng)
+    else:
+        movement = np.tile(np.arange(0,n_events), n_repeats)
+        # shuffle blocks if you want
+        if randomize:
+            rng.shuffle(movement)
+
+    return {
+        "itis": np.atleast_1d(np.asarray(itis, dtype=float)),
+        "movement": np.atleast_1d(np.asarray(movement, dtype=int))
+    }
@@ -0,0 +1,349 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import glob
+import io
+import itertools
+import json
+import numpy as np
+import os
+import pandas as pd
+import re
+import sys
+
+# modules shared by both experiments (common/) are in the parent directory
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.runlog import load_run
+from common.timeline import Timeline
+from gaze import pix_per_degree
+opj = os.path.join
+
+# trial onsets as sent to the tracker by StarSession (the format of exptools2)
+ONSET_MESSAGE = re.compile(r"start_type-\w+_trial-(\d+)_phase-0")
+
+def read_messages(fname, pattern=ONSET_MESSAGE):
+    """ Trial onsets from the MSG lines of an EyeLink ASC file, as a trial number -> time (s, tracker clock) dictionary; only MSG lines are kept while reading """
+
+    onsets = {}
+    with open(fname, 'r', encoding='utf8', errors='replace') as f_in:
+        for line in f_in:
+            if line.startswith("MSG"):
+                match = pattern.search(line)
+                if match is not None:
+                    onsets[int(match.group(1))] = float(line.split()[1])/1000
+
+    return onsets
+
+def read_samples(fname, chunk_size=500000, columns=(1,2), to_deg=None, time_column="time", x_column="x", y_column="y"):
+    """read_samples
+
+    Reads the samples of an eye-tracking export in chunks of `chunk_size` lines, so that memory does not depend on the size of the file.
+
+    Parameters
+    ----------
+    fname: str
+        EyeLink ASC file (samples in ms and screen pixels; missing data as '.') or CSV file with a header (time in s, gaze in deg)
+    chunk_size: int
+        Number of lines per chunk
+    columns: tuple
+        Columns of x and y in the sample lines of an ASC file (the first eye by default)
+    to_deg: callable, optional
+        Converts (n,2) gaze to deg; applied to every chunk
+    time_column, x_column, y_column: str
+        Columns of a CSV file
+
+    Yields
+    ----------
+    numpy.ndarray
+        (n,3) time (s), x and y
+    """
+
+    if not fname.lower().endswith(".asc"):
+        for chunk in pd.read_csv(fname, usecols=[time_column, x_column, y_column], chunksize=chunk_size):
+            samples = chunk[[time_column, x_column, y_column]].to_numpy(dtype=float)
+            if to_deg is not None:
+                samples[:,1:] = to_deg(samples[:,1:])
+            yield samples
+        return
+
+    with open(fname, 'r', encoding='utf8', errors='replace') as f_in:
+        while True:
+            lines = list(itertools.islice(f_in, chunk_size))
+            if not lines:
+                break
+
+            # sample lines start with the timestamp; events and messages with a keyword
+            lines = [line for line in lines if line[:1].isdigit()]
+            if not lines:
+                continue
+
+            df = pd.read_csv(
+                io.StringIO("".join(lines)),
+                sep=r"\s+",
+                header=None,
+                usecols=[0, *columns],
+                na_values=["."],
+                on_bad_lines="skip")
+
+            samples = df.to_numpy(dtype=float)
+            samples[:,0] /= 1000
+            if to_deg is not None:
+                samples[:,1:] = to_deg(samples[:,1:])
+            yield samples
+
+def velocity(t, x, y):
+    """ Speed (deg/s) and velocity per sample, from the 5-point moving difference of Engbert & Kliegl (2003); NaN at the edges and around missing samples """
+
+    dt = np.median(np.diff(t)) if t.size > 1 else np.nan
+    vx, vy = np.full(t.size, np.nan), np.full(t.size, np.nan)
+    if t.size > 4:
+        vx[2:-2] = (x[4:]+x[3:-1]-x[1:-3]-x[:-4])/(6*dt)
+        vy[2:-2] = (y[4:]+y[3:-1]-y[1:-3]-y[:-4])/(6*dt)
+    return np.hypot(vx, vy), vx, vy
+
+def detect_saccades(t, x, y, threshold=30., min_duration=0.01):
+    """ Saccades as runs of samples faster than `threshold` (deg/s) that last at least `min_duration` (s); returns the indices of their first and last sample, and the speed of every sample """
+
+    speed, _, _ = velocity(t, x, y)
+    fast = np.concatenate([[0], (speed > threshold).astype(np.int8), [0]])
+    edges = np.diff(fast)
+    onsets, offsets = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)-1
+    keep = t[offsets]-t[onsets] >= min_duration
+    return onsets[keep], offsets[keep], speed
+
+def trial_metrics(t, x, y, coords, duration, condition, end=None, threshold=30., min_duration=0.01, latency_window=(0.08, 0.6), pursuit_skip=0.15):
+    """trial_metrics
+
+    Saccade latency and landing error (saccade trials) or pursuit gain (pursuit trials) of one trial.
+
+    Parameters
+    ----------
+    t: numpy.ndarray
+        Time of the samples relative to the onset of the trial (s)
+    x, y: numpy.ndarray
+        Gaze (deg)
+    coords: numpy.ndarray
+        (n_steps,2) positions of the dot
+    duration: float
+        Time in which the dot steps through `coords` (s; `stim_duration` in the design settings)
+    condition: str
+        'saccade' or 'pursuit'
+    end: float, optional
+        End of the trial (s), if it differs from `duration`: in gaze-contingent mode the trial ends on arrival or is held at the end position (see :class:`trial.StarTrial`). Samples after it are not used
+    threshold: float
+        Velocity threshold of saccades (deg/s)
+    min_duration: float
+        Minimal duration of a saccade (s)
+    latency_window: tuple
+        A saccade counts as a response to a jump of the dot if it starts this long (s) after the jump
+    pursuit_skip: float
+        Time after the onset of a pursuit that is not used for the gain (s)
+
+    Returns
+    ----------
+    dict
+        Number of samples, fraction lost, number of saccades, and `latency`, `landing_error`, `n_jumps` and `n_detected` (saccade trials) or `gain` (pursuit trials); NaN if not applicable
+    """
+
+    if end is None:
+        end = duration
+
+    onsets, offsets, speed = detect_saccades(t, x, y, threshold=threshold, min_duration=min_duration)
+    in_trial = (t >= 0) & (t < end)
+    metrics = {
+        "n_samples": int(in_trial.sum()),
+        "loss": float(np.isnan(x[in_trial]).mean()) if in_trial.any() else np.nan,
+        "n_saccades": int(((t[onsets] >= 0) & (t[onsets] < end)).sum()),
+        "latency": np.nan,
+        "landing_error": np.nan,
+        "n_jumps": 0,
+        "n_detected": 0,
+        "gain": np.nan
+    }
+
+    if condition == "saccade":
+
+        # first saccade in the latency window after every jump of the dot that was shown before the trial ended
+        coord_onsets = np.arange(len(coords))*(duration/len(coords))
+        jumps = np.flatnonzero(np.any(np.diff(coords, axis=0) != 0, axis=1))+1
+        jumps = jumps[coord_onsets[jumps] < end]
+        ix = np.searchsorted(t[onsets], coord_onsets[jumps]+latency_window[0])
+        found = ix < onsets.size
+        found[found] &= t[onsets[ix[found]]] <= coord_onsets[jumps[found]]+latency_window[1]
+
+        latency = t[onsets[ix[found]]]-coord_onsets[jumps[found]]
+        landing = offsets[ix[found]]
+        error = np.hypot(x[landing]-coords[jumps[found],0], y[landing]-coords[jumps[found],1])
+        metrics.update({
+            "latency": float(np.median(latency)) if latency.size > 0 else np.nan,
+            "landing_error": float(np.nanmedian(error)) if np.any(~np.isnan(error)) else np.nan,
+            "n_jumps": int(jumps.size),
+            "n_detected": int(found.sum())
+        })
+
+    elif condition == "pursuit":
+
+        # eye velocity along the path of the dot, without the saccades and the initiation of the pursuit
+        target_velocity = (coords[-1]-coords[0])/duration
+        target_speed = np.hypot(*target_velocity)
+        _, vx, vy = velocity(t, x, y)
+        smooth = np.ones(t.size, dtype=bool)
+        if onsets.size > 0:
+            in_saccade = np.zeros(t.size+1, dtype=int)
+            np.add.at(in_saccade, onsets, 1)
+            np.add.at(in_saccade, offsets+1, -1)
+            smooth = np.cumsum(in_saccade)[:-1] == 0
+
+        use = smooth & (t >= pursuit_skip) & (t < min(duration, end)) & ~np.isnan(vx)
+        if target_speed > 0 and use.any():
+            along = (vx[use]*target_velocity[0]+vy[use]*target_velocity[1])/target_speed
+            metrics["gain"] = float(np.median(along)/target_speed)
+
+    return metrics
+
+def run_trials(prefix):
+    """ Trial number, condition, onset and logged duration (session clock) of the StarTrials of a run from its `_log.npz`, with their trajectories from the `_timeline.npz` """
+
+    log = load_run(prefix+"_log.npz", keys=["trials_trial_nr", "trials_condition", "phase_onsets", "phase_durations", "settings"])
+    timeline = Timeline.load(prefix+"_timeline.npz")
+
+    star = np.isin(log["trials_condition"], timeline.conditions)
+    trials = pd.DataFrame({
+        "trial_nr": log["trials_trial_nr"][star],
+        "condition": log["trials_condition"][star],
+        "onset": log["phase_onsets"][star,0],
+        "duration": log["phase_durations"][star,0]
+    })
+    trajectories = {nr: timeline.trajectory(nr) for nr in trials["trial_nr"]}
+    return trials, trajectories, json.loads(str(log["settings"]))
+
+def analyze_run(prefix, gaze_file, offset=None, chunk_size=500000, margin=0.05, **kwargs):
+    """analyze_run
+
+    Metrics of every StarTrial of a run (see :func:`trial_metrics`). The samples are streamed in chunks; only the samples of the trial that is being completed are kept, so memory is bounded by the chunk size and the length of a trial.
+
+    Parameters
+    ----------
+    prefix: str
+        Path and basename of the output of the run (`<output_dir>/<output_str>`), which has the `_log.npz` and `_timeline.npz`
+    gaze_file: str
+        EyeLink ASC or CSV file (see :func:`read_samples`)
+    offset: float, optional
+        Time of the samples minus the time on the session clock. If None, it is estimated from the trial onsets in the MSG lines of an ASC file (see `ONSET_MESSAGE`); for CSV files the samples are assumed to be on the session clock
+    chunk_size: int
+        Number of lines per chunk
+    margin: float
+        Samples around each trial that are included for the velocity filter (s)
+    kwargs: dict
+        Passed on to :func:`trial_metrics`
+
+    Returns
+    ----------
+    pandas.DataFrame
+        One row per trial
+    """
+
+    trials, trajectories, settings = run_trials(prefix)
+    is_asc = gaze_file.lower().endswith(".asc")
+
+    # ASC files are in pixels with (0,0) at the top left of the screen
+    to_deg = None
+    if is_asc:
+        size = np.asarray(settings["window"]["size"], dtype=float)
+        ppd = pix_per_degree(settings["monitor"]["width"], settings["monitor"]["distance"], size[0])
+        to_deg = lambda xy: np.column_stack([xy[:,0]-size[0]/2, size[1]/2-xy[:,1]])/ppd
+
+    if offset is None:
+        offset = 0.
+        if is_asc:
+            messages = read_messages(gaze_file)
+            matched = [messages[nr]-onset for nr, onset in zip(trials["trial_nr"], trials["onset"]) if nr in messages]
+            if len(matched) == 0:
+                raise ValueError(f"No trial onsets in the messages of '{gaze_file}'; pass the clock offset")
+            offset = float(np.median(matched))
+
+    # the dot moves over the stimulus duration; the logged duration differs from it in gaze-contingent mode
+    duration = float(settings["design"]["stim_duration"])
+    starts = trials["onset"].to_numpy()+offset
+    ends = starts+trials["duration"].to_numpy()
+    results = []
+    pending = np.empty((0,3))
+    current = 0
+
+    def complete(ix, samples):
+        row = trials.iloc[ix]
+        use = (samples[:,0] >= starts[ix]-margin) & (samples[:,0] < ends[ix]+margin)
+        t, x, y = samples[use,0]-starts[ix], samples[use,1], samples[use,2]
+        metrics = trial_metrics(t, x, y, trajectories[row["trial_nr"]], duration, row["condition"], end=row["duration"], **kwargs)
+        results.append({"trial_nr": int(row["trial_nr"]), "condition": row["condition"], "onset": row["onset"], **metrics})
+
+    for chunk in read_samples(gaze_file, chunk_size=chunk_size, to_deg=to_deg):
+        pending = np.concatenate([pending, chunk])
+
+        # trials that are complete in what has been read so far
+        while current < len(trials) and pending.shape[0] > 0 and pending[-1,0] >= ends[current]+margin:
+            complete(current, pending)
+            current += 1
+
+        # nothing before the next trial is needed anymore
+        if current < len(trials):
+            pending = pending[pending[:,0] >= starts[current]-margin]
+        else:
+            break
+
+    while current < len(trials):
+        complete(current, pending)
+        current += 1
+
+    df = pd.DataFrame(results)
+    df.insert(0, "run", os.path.basename(prefix))
+    return df
+
+def _analyze(job):
+    # worker: one run
+    return analyze_run(job["prefix"], job["gaze_file"], **job["kwargs"])
+
+def analyze_study(runs, n_jobs=None, verbose=True, **kwargs):
+    """ Analyzes the runs in `runs` ((prefix, gaze_file) pairs, see :func:`analyze_run`) in parallel; returns all trials in one DataFrame """
+
+    jobs = [{"prefix": prefix, "gaze_file": gaze_file, "kwargs": kwargs} for prefix, gaze_file in runs]
+    n_jobs = os.cpu_count() if n_jobs is None else n_jobs
+    if n_jobs > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=min(n_jobs, len(jobs))) as pool:
+            results = list(pool.map(_analyze, jobs))
+    else:
+        results = [_analyze(job) for job in jobs]
+
+    df = pd.concat(results, ignore_index=True) if results else pd.DataFrame()
+    if verbose and df.shape[0] > 0:
+        print(df.groupby("condition")[["latency", "landing_error", "gain", "loss"]].median().round(3).to_string())
+
+    return df
+
+def find_run(run_dir, gaze_pattern="*.asc"):
+
+    # prefix of the run in `run_dir` (from its _log.npz) and its eye-tracking file
+    logs = glob.glob(opj(run_dir, "*_log.npz"))
+    gaze = sorted(glob.glob(opj(run_dir, gaze_pattern)))
+    if len(logs) != 1 or len(gaze) == 0:
+        raise FileNotFoundError(f"Expected one _log.npz and a '{gaze_pattern}'-file in '{run_dir}'")
+
+    return logs[0][:-len("_log.npz")], gaze[0]
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Saccade latency, landing error and pursuit gain per trial from the eye-tracking data of StarGaze runs")
+    parser.add_argument('run_dirs', nargs='+', help="output directories of runs, each with the eye-tracking file next to the logs")
+    parser.add_argument('--gaze_pattern', default="*.asc", help="eye-tracking file in each run directory (ASC, or CSV with time/x/y in s/deg)")
+    parser.add_argument('--threshold', type=float, default=30., help="saccade velocity threshold (deg/s)")
+    parser.add_argument('--chunk_size', type=int, default=500000)
+    parser.add_argument('--n_jobs', type=int, default=None)
+    parser.add_argument('--out', default="stargaze_metrics.tsv")
+    args = parser.parse_args()
+
+    runs = [find_run(run_dir, args.gaze_pattern) for run_dir in args.run_dirs]
+    df = analyze_study(runs, n_jobs=args.n_jobs, threshold=args.threshold, chunk_size=args.chunk_size)
+    df.round(5).to_csv(args.out, sep="\t", index=False)
+    print(f"Wrote {df.shape[0]} trials of {len(runs)} runs to {args.out}")
+
+if __name__ == "__main__":
+    main()
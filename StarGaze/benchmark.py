@@ -0,0 +1,78 @@
+import contextlib
+import io
+import numpy as np
+import os
+import sys
+
+# modules shared by both experiments (common/) are in the parent directory
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.benchmark import Benchmark
+
+bench = Benchmark(
+    os.path.dirname(os.path.abspath(__file__)),
+    "StarSession",
+    condition="gaze",
+    description="Benchmark startup, trial construction and per-frame cost of StarSession (runs headless)")
+
+#---------------------------------------------------------------------------------------------------
+# CASES
+
+@bench.case("trajectories", n_repeats=[2,20,200], steps_pursuit=[100,1000,10000])
+def bench_trajectories(n_repeats, steps_pursuit):
+    from trajectory import build_trajectories, star_positions, trajectory_steps
+    settings = bench.load_settings()
+    positions = star_positions(settings['stimuli']['star_anchors'], n_repeats)
+    eye_movements = np.resize(np.arange(2), positions.shape[0])
+    def build():
+        n_steps = trajectory_steps(eye_movements, settings['design']['steps_saccade'], steps_pursuit)
+        return build_trajectories(positions, n_steps)
+
+    return build
+
+@bench.case("session_init", display=True, n_repeats=[2,10])
+def bench_session_init(n_repeats, output_dir=None):
+    return lambda: bench.make_session(output_dir, n_repeats=n_repeats)
+
+@bench.case("create_trials", display=True, n_repeats=[2,10], steps_pursuit=[100,1000,10000])
+def bench_create_trials(n_repeats, steps_pursuit, output_dir=None):
+    session = bench.make_session(
+        output_dir,
+        n_repeats=n_repeats,
+        steps_pursuit=steps_pursuit,
+        intended_duration=None)
+
+    def create_trials():
+        with contextlib.redirect_stdout(io.StringIO()):
+            session.create_trials()
+
+    return create_trials
+
+@bench.case("draw", display=True, frame_locked=[None,"frames","time"], steps_pursuit=[100,10000])
+def bench_draw(frame_locked, steps_pursuit, output_dir=None):
+    session = bench.make_session(output_dir, frame_locked=frame_locked, steps_pursuit=steps_pursuit)
+    with contextlib.redirect_stdout(io.StringIO()):
+        session.create_trials()
+
+    # second trial is a pursuit
+    trial = session.trials[2]
+    return trial.draw
+
+@bench.case("dot", display=True, dot_backend=["circle","sprite"], show_anchors=[False,True])
+def bench_dot(dot_backend, show_anchors, output_dir=None):
+    session = bench.make_session(output_dir, stimuli__dot_backend=dot_backend, stimuli__show_anchors=show_anchors)
+    with contextlib.redirect_stdout(io.StringIO()):
+        session.create_trials()
+
+    # a frame of a pursuit; on a real window (--display), flip without waiting for the refresh so the GPU-side cost counts too
+    trial = session.trials[2]
+    session.win.waitBlanking = False
+    def frame():
+        trial.draw()
+        session.win.flip()
+
+    return frame
+
+#---------------------------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    bench.main()
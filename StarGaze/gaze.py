@@ -0,0 +1,523 @@
+import numpy as np
+import os
+import pandas as pd
+import queue
+import threading
+import time
+from common.triggers import default_clock
+opj = os.path.join
+
+def pix_per_degree(width_cm, distance_cm, width_pix):
+    """ Pixels per degree of visual angle at the center of a screen of `width_cm` (and `width_pix`) at `distance_cm` """
+    return width_pix/(2*np.degrees(np.arctan(width_cm/2/distance_cm)))
+
+class SampleBuffer():
+
+    def __init__(self, capacity=8192, n_columns=4):
+        """ Bounded buffer of the most recent gaze samples; rows are (time, x, y, error) and are written in blocks without allocating. Once full, the oldest samples are overwritten """
+
+        self.capacity   = int(capacity)
+        self.data       = np.full((self.capacity, n_columns), np.nan)
+        self.n_samples  = 0
+
+    def push(self, samples):
+        samples = samples[-self.capacity:]
+        ix = (self.n_samples+np.arange(samples.shape[0])) % self.capacity
+        self.data[ix] = samples
+        self.n_samples += samples.shape[0]
+
+    def latest(self, n=None):
+        """ The last `n` samples (default: all that are buffered), oldest first """
+
+        n = min(self.n_samples, self.capacity) if n is None else min(n, self.n_samples, self.capacity)
+        ix = (self.n_samples-n+np.arange(n)) % self.capacity
+        return self.data[ix]
+
+    def since(self, t):
+        """ Samples with a timestamp after `t` """
+        samples = self.latest()
+        return samples[samples[:,0] > t]
+
+class EyeLinkSource():
+
+    def __init__(self, address=None, tracker=None, pix_per_deg=1., win_size=(1920,1080), eye="right", start_recording=True, get_time=None):
+        """ Gaze samples from an EyeLink over the link (pylink). Gaze is converted from screen pixels to degrees relative to the center of the screen (y up, as psychopy's 'deg' units), missing data to NaN, and the tracker's timestamps to psychopy's time base with the offset between the clocks at the start.
+
+        Parameters
+        ----------
+        address : str, optional
+            IP address of the tracker; ignored if `tracker` is given
+        tracker : pylink.EyeLink, optional
+            Existing connection (e.g., from an eyetracker session)
+        pix_per_deg : float
+            Pixels per degree (see :func:`pix_per_degree`)
+        win_size : tuple
+            Size of the screen in pixels, as in the tracker's screen coordinates
+        eye : str
+            Eye to use if both are recorded
+        start_recording : bool
+            Start recording (to file and link) if the tracker is not recording yet
+        get_time : callable, optional
+            Time base of the timestamps (default: psychopy's)
+        """
+        import pylink
+        self.pylink         = pylink
+        self.tracker        = pylink.EyeLink(address) if tracker is None else tracker
+        self.pix_per_deg    = pix_per_deg
+        self.center         = np.asarray(win_size, dtype=float)/2
+        self.eye            = eye
+        self.get_time       = default_clock() if get_time is None else get_time
+
+        if start_recording and self.tracker.isRecording() != pylink.TRIAL_OK:
+            self.tracker.startRecording(1, 1, 1, 1)
+
+        self.offset = self.get_time()-self.tracker.trackerTime()/1000
+
+    def _gaze(self, sample):
+        if self.eye == "right" and sample.isRightSample():
+            return sample.getRightEye().getGaze()
+        elif sample.isLeftSample():
+            return sample.getLeftEye().getGaze()
+        elif sample.isRightSample():
+            return sample.getRightEye().getGaze()
+        return (np.nan, np.nan)
+
+    def read(self, timeout=None):
+        samples = []
+        while True:
+            item = self.tracker.getNextData()
+            if not item:
+                break
+            if item == self.pylink.SAMPLE_TYPE:
+                sample = self.tracker.getFloatData()
+                samples.append((sample.getTime()/1000+self.offset, *self._gaze(sample)))
+
+        if not samples:
+            if timeout:
+                time.sleep(0.0005)
+            return np.empty((0,3))
+
+        samples = np.array(samples, dtype=float)
+        samples[np.abs(samples[:,1:]).max(axis=1) >= abs(self.pylink.MISSING_DATA), 1:] = np.nan
+        samples[:,1] = (samples[:,1]-self.center[0])/self.pix_per_deg
+        samples[:,2] = (self.center[1]-samples[:,2])/self.pix_per_deg
+        return samples
+
+    def message(self, text):
+        # timestamped in the tracker's data file (e.g., trial onsets, to align it with the log afterwards)
+        self.tracker.sendMessage(text)
+
+    def close(self):
+        pass
+
+class MockTracker():
+
+    def __init__(self, samples=None, rate=1000., lag=0.2, noise=0.02, loss=0.02, blink_duration=0.15, saccade_duration=0.025, get_time=None, seed=None):
+        """ Stand-in for an eye tracker that produces samples at `rate` Hz in real (or simulated) time, so the gaze monitor can be tested without hardware.
+
+        With `samples`, a recorded stream is replayed from the first read on; otherwise gaze is synthesized that follows :attr:`target` (set by :class:`GazeMonitor` to the positions of the dot) `lag` seconds late, with Gaussian noise and blinks (NaN) that take up a fraction `loss` of the samples. Jumps of the target are followed by a saccade of `saccade_duration` (the target averaged over that window), so that they can be detected with a velocity threshold.
+
+        Parameters
+        ----------
+        samples : str or numpy.ndarray, optional
+            (n,3) samples (time in s from the start of the recording, x and y in deg), or a whitespace/comma-separated file with these columns
+        rate : float
+            Sampling rate (Hz)
+        lag : float
+            Delay of the synthetic gaze relative to the target (s)
+        noise : float
+            Standard deviation of the synthetic gaze (deg)
+        loss : float
+            Fraction of synthetic samples lost in blinks
+        blink_duration : float
+            Duration of a blink (s)
+        saccade_duration : float
+            Duration of the synthetic saccades (s)
+        get_time : callable, optional
+            Time base (default: psychopy's)
+        seed : int, optional
+            Seed for the noise and blinks
+        """
+        if isinstance(samples, str):
+            samples = np.loadtxt(samples, delimiter="," if samples.endswith(".csv") else None, ndmin=2)
+
+        self.samples        = None if samples is None else np.asarray(samples, dtype=float)
+        self.rate           = rate
+        self.lag            = lag
+        self.noise          = noise
+        self.blink_rate     = loss/blink_duration
+        self.blink_duration = blink_duration
+        self.window         = np.arange(0, saccade_duration, 1/rate)
+        self.get_time       = default_clock() if get_time is None else get_time
+        self.rng            = np.random.default_rng(seed)
+        self.target         = None
+        self.t_start        = None
+        self.n_read         = 0
+        self.blink_until    = -np.inf
+
+    def read(self, timeout=None):
+        now = self.get_time()
+        if self.t_start is None:
+            self.t_start = now
+
+        # all samples that are due since the last read
+        n = int((now-self.t_start)*self.rate)-self.n_read
+        if n <= 0:
+            if timeout:
+                time.sleep(0.0005)
+            return np.empty((0,3))
+
+        t = self.t_start+(self.n_read+np.arange(1, n+1))/self.rate
+        self.n_read += n
+        if self.samples is not None:
+            ix = np.searchsorted(self.samples[:,0], t-self.t_start)
+            ix = ix[ix < self.samples.shape[0]]
+            return np.column_stack([t[:ix.size], self.samples[ix,1:3]])
+
+        # follow the target (fixate the center if there is none), plus noise
+        if self.target is None:
+            pos = np.zeros((n,2))
+        else:
+            pos = self.target(t[:,None]-self.lag-self.window[None,:])
+            pos = np.where(np.isnan(pos), 0, pos).mean(axis=1)
+        pos += self.rng.normal(0, self.noise, (n,2))
+
+        # blinks start at random and last `blink_duration` (possibly into the next read)
+        pos[t < self.blink_until] = np.nan
+        for onset in t[self.rng.random(n) < self.blink_rate/self.rate]:
+            if onset > self.blink_until:
+                self.blink_until = onset+self.blink_duration
+                pos[(t >= onset) & (t < self.blink_until)] = np.nan
+
+        return np.column_stack([t, pos])
+
+    def close(self):
+        pass
+
+class SaccadeDetector():
+
+    def __init__(self, threshold=30., min_duration=0.008, get_time=None):
+        """ Velocity-threshold saccade detector for a stream of samples.
+
+        The speed of every sample is the 5-point moving difference of Engbert & Kliegl (2003), as in :func:`analysis.velocity`, but over the sample and the four before it, so that it only needs samples that have arrived (a saccade is seen two samples late); blocks of samples are processed at once, and the last samples of a block are kept for the next. A saccade is reported when it ends (the first slower sample), with the time at which that happened on `get_time`, so that the latency of the detection can be logged.
+
+        Parameters
+        ----------
+        threshold : float
+            Speed (deg/s) above which samples are part of a saccade
+        min_duration : float
+            Shorter saccades (s) are ignored (noise, blink edges)
+        get_time : callable, optional
+            Time base of the detection times (default: psychopy's)
+        """
+        self.threshold      = threshold
+        self.min_duration   = min_duration
+        self.get_time       = default_clock() if get_time is None else get_time
+        self.previous       = np.empty((0,3))
+        self.onset          = None
+
+    def process(self, samples):
+        """ Saccades that ended in `samples` ((n,3) time, x, y), as dictionaries with `onset`, `offset`, landing position `x`/`y` and `detected` (the time of detection) """
+
+        samples = np.concatenate([self.previous, samples[:,:3]])
+        self.previous = samples[-4:]
+        if samples.shape[0] < 5:
+            return []
+
+        # speed at the middle of every 5 consecutive samples
+        t, x, y = samples[2:-2,0], samples[2:-2,1], samples[2:-2,2]
+        dx = samples[4:,1:]+samples[3:-1,1:]-samples[1:-3,1:]-samples[:-4,1:]
+        speed = np.hypot(dx[:,0], dx[:,1])/(1.5*(samples[4:,0]-samples[:-4,0]))
+        fast = np.concatenate([[self.onset is not None], speed > self.threshold]).astype(np.int8)
+        edges = np.diff(fast)
+
+        saccades = []
+        for ix in np.flatnonzero(edges):
+            if edges[ix] == 1:
+                self.onset = t[ix]
+            elif self.onset is not None:
+                if t[ix]-self.onset >= self.min_duration:
+                    saccades.append({"onset": self.onset, "offset": t[ix], "x": x[ix], "y": y[ix], "detected": self.get_time()})
+                self.onset = None
+
+        return saccades
+
+class Arrival():
+
+    def __init__(self, target, radius=1.5, dwell=0.1):
+        """ Detects when gaze has arrived at `target`: all samples within `radius` deg for at least `dwell` s (missing samples reset it). :meth:`update` returns the time gaze entered the window and the time the dwell was complete, once """
+
+        self.target = np.asarray(target, dtype=float)
+        self.radius = radius
+        self.dwell  = dwell
+        self.since  = None
+        self.done   = False
+
+    def update(self, samples):
+        if self.done or samples.shape[0] == 0:
+            return None
+
+        inside = np.hypot(samples[:,1]-self.target[0], samples[:,2]-self.target[1]) < self.radius
+        outside = np.flatnonzero(~inside)
+        if outside.size > 0:
+            self.since = samples[outside[-1]+1,0] if outside[-1]+1 < samples.shape[0] else None
+        elif self.since is None:
+            self.since = samples[0,0]
+
+        if self.since is not None and samples[-1,0]-self.since >= self.dwell:
+            self.done = True
+            t_dwell = samples[np.searchsorted(samples[:,0], self.since+self.dwell),0]
+            return self.since, t_dwell
+
+        return None
+
+class GazeMonitor():
+
+    def __init__(self, source, capacity=8192, threaded=True, bin_width=0.05, max_error=20., target_capacity=4096, detector=None, get_time=None, verbose=True):
+        """ Compares gaze with the position of the dot while the run is going.
+
+        A background thread reads `source` and queues the samples (as :class:`~triggers.TriggerListener` does for triggers); :meth:`update`, called once per frame, moves them into a bounded :class:`SampleBuffer` and computes the distance of every sample to the target that was on the screen at that time, for all new samples at once. Targets are registered with :meth:`show_target` when they are flipped. Per trial, the number of samples, lost samples (blinks or tracking loss) and a histogram of the error (bins of `bin_width` deg) are kept, so that memory does not grow with the length of the run; :meth:`report` prints these to the console after each trial and :meth:`save` writes them to `<output_str>_gaze.tsv`.
+
+        Parameters
+        ----------
+        source : object
+            Has `read(timeout)`, returning an (n,3) array of samples (time in psychopy's time base, x and y in deg), and `close()`
+        capacity : int
+            Number of samples kept in the buffer
+        threaded : bool
+            Read the source on a background thread; sources that produce samples on demand (:class:`MockTracker`) are read in :meth:`update`
+        bin_width : float
+            Resolution of the error statistics (deg)
+        max_error : float
+            Errors beyond this are counted in the last bin
+        target_capacity : int
+            Number of target positions (and changes of position) kept to look up the target of a sample
+        detector : SaccadeDetector, optional
+            Runs on the samples as soon as they are read (on the background thread if `threaded`); see :meth:`saccades`
+        get_time : callable, optional
+            Time base of :meth:`show_target` (default: psychopy's)
+        verbose : bool
+            Print the statistics of every trial
+        """
+        self.source         = source
+        self.threaded       = threaded
+        self.buffer         = SampleBuffer(capacity)
+        self.bin_width      = bin_width
+        self.n_bins         = int(np.ceil(max_error/bin_width))+1
+        self.get_time       = default_clock() if get_time is None else get_time
+        self.verbose        = verbose
+        self.queue          = queue.SimpleQueue()
+        self.running        = False
+        self.thread         = None
+        self.stats          = {}
+        self.detector       = detector
+        self.detected       = queue.SimpleQueue()
+        self.last_pos       = None
+
+        # targets in the order they were shown: time, trial number and position
+        self.target_capacity    = target_capacity
+        self.target_times       = np.full(target_capacity, np.inf)
+        self.target_trials      = np.full(target_capacity, -1, dtype=np.int32)
+        self.target_pos         = np.full((target_capacity,2), np.nan)
+        self.n_targets          = 0
+
+        # times at which the target changed position
+        self.jump_times         = np.full(target_capacity, np.inf)
+        self.n_jumps            = 0
+
+    def start(self):
+        if self.threaded and self.thread is None:
+            self.running = True
+            self.thread = threading.Thread(target=self._listen, name="gaze-monitor", daemon=True)
+            self.thread.start()
+
+        if self.verbose:
+            print(f"Monitoring gaze from {self.source.__class__.__name__}")
+
+    def _listen(self):
+        while self.running:
+            samples = self.source.read(timeout=0.001)
+            if samples.shape[0] > 0:
+                self.queue.put(samples)
+                self._detect(samples)
+
+    def _detect(self, samples):
+        if self.detector is not None:
+            for saccade in self.detector.process(samples):
+                self.detected.put(saccade)
+
+    def saccades(self):
+        """ Saccades detected since the last call (see :class:`SaccadeDetector`) """
+
+        saccades = []
+        while True:
+            try:
+                saccades.append(self.detected.get_nowait())
+            except queue.Empty:
+                return saccades
+
+    def last_jump(self, t):
+        """ Time of the last change of the target position before `t` (NaN if none) """
+        ix = np.searchsorted(self.jump_times[:self.n_jumps], t)-1
+        return self.jump_times[ix] if ix >= 0 else np.nan
+
+    def show_target(self, trial_nr, pos):
+        """ Register that the target of `trial_nr` is at `pos` (None: no target) from now on; call on the flip that shows it """
+
+        if self.n_targets == self.target_capacity:
+            keep = self.target_capacity//2
+            for arr in [self.target_times, self.target_trials, self.target_pos]:
+                arr[:keep] = arr[-keep:]
+            self.target_times[keep:] = np.inf
+            self.n_targets = keep
+
+        ix = self.n_targets
+        if pos is not None and (self.last_pos is None or np.any(self.last_pos != pos)):
+            if self.n_jumps == self.target_capacity:
+                keep = self.target_capacity//2
+                self.jump_times[:keep] = self.jump_times[-keep:]
+                self.jump_times[keep:] = np.inf
+                self.n_jumps = keep
+
+            self.jump_times[self.n_jumps] = self.get_time()
+            self.n_jumps += 1
+            self.last_pos = np.asarray(pos, dtype=float)
+
+        self.target_times[ix] = self.get_time()
+        self.target_trials[ix] = trial_nr
+        self.target_pos[ix] = (np.nan, np.nan) if pos is None else pos
+        self.n_targets += 1
+
+    def target_at(self, t):
+        """ Position of the target at times `t` (NaN before the first target) """
+
+        ix = np.searchsorted(self.target_times[:self.n_targets], t, side="right")-1
+        pos = self.target_pos[np.maximum(ix, 0)].copy()
+        pos[ix < 0] = np.nan
+        return pos
+
+    def _read(self):
+        if not self.threaded:
+            samples = self.source.read(timeout=0)
+            self._detect(samples)
+            return samples
+
+        blocks = []
+        while True:
+            try:
+                blocks.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return np.concatenate(blocks) if blocks else np.empty((0,3))
+
+    def update(self):
+        """ Takes the samples that arrived since the last call, computes their error and adds them to the statistics of their trial; returns them as (n,4) rows of time, x, y and error """
+
+        samples = self._read()
+        if samples.shape[0] == 0:
+            return np.empty((0,4))
+
+        # target and trial of every sample
+        ix = np.searchsorted(self.target_times[:self.n_targets], samples[:,0], side="right")-1
+        valid = ix >= 0
+        ix = np.maximum(ix, 0)
+        target = np.where(valid[:,None], self.target_pos[ix], np.nan)
+        trial_nrs = np.where(valid, self.target_trials[ix], -1)
+
+        error = np.hypot(samples[:,1]-target[:,0], samples[:,2]-target[:,1])
+        samples = np.column_stack([samples[:,:3], error])
+        self.buffer.push(samples)
+
+        # only samples with a target count towards the statistics
+        scored = valid & ~np.isnan(target[:,0])
+        lost = np.isnan(samples[:,1]) | np.isnan(samples[:,2])
+        for trial_nr in np.unique(trial_nrs[scored]):
+            in_trial = scored & (trial_nrs == trial_nr)
+            stats = self.stats.setdefault(int(trial_nr), {"n_samples": 0, "n_lost": 0, "hist": np.zeros(self.n_bins)})
+            stats["n_samples"] += int(in_trial.sum())
+            stats["n_lost"] += int((in_trial & lost).sum())
+            bins = np.minimum((error[in_trial & ~lost]/self.bin_width).astype(int), self.n_bins-1)
+            stats["hist"] += np.bincount(bins, minlength=self.n_bins)
+
+        return samples
+
+    def _percentiles(self, hist, q):
+        if hist.sum() == 0:
+            return [np.nan]*len(q)
+        cdf = np.cumsum(hist)/hist.sum()
+        return [(np.searchsorted(cdf, p/100)+0.5)*self.bin_width for p in q]
+
+    def trial_stats(self, trial_nr):
+        """ Number of samples, fraction lost and median/95th percentile/mean error (deg) of `trial_nr`; None if it had no target """
+
+        stats = self.stats.get(trial_nr)
+        if stats is None:
+            return None
+
+        hist = stats["hist"]
+        median, p95 = self._percentiles(hist, [50, 95])
+        centers = (np.arange(self.n_bins)+0.5)*self.bin_width
+        return {
+            "trial_nr": trial_nr,
+            "n_samples": stats["n_samples"],
+            "loss": stats["n_lost"]/max(stats["n_samples"], 1),
+            "median_error": median,
+            "p95_error": p95,
+            "mean_error": float((hist*centers).sum()/hist.sum()) if hist.sum() > 0 else np.nan
+        }
+
+    def report(self, trial_nr):
+        """ Prints the statistics of `trial_nr` and of the run so far """
+
+        self.update()
+        stats = self.trial_stats(trial_nr)
+        if stats is None or not self.verbose:
+            return stats
+
+        run = sum(s["hist"] for s in self.stats.values())
+        n_samples = sum(s["n_samples"] for s in self.stats.values())
+        n_lost = sum(s["n_lost"] for s in self.stats.values())
+        run_median = self._percentiles(run, [50])[0]
+        print(f"gaze trial #{trial_nr}\t| error = {round(stats['median_error'],2)}deg (95%: {round(stats['p95_error'],2)}deg)\t| loss = {round(stats['loss']*100,1)}%\t| run: {round(run_median,2)}deg, loss = {round(n_lost/max(n_samples,1)*100,1)}%")
+        return stats
+
+    def summary(self):
+        return pd.DataFrame([self.trial_stats(trial_nr) for trial_nr in sorted(self.stats)])
+
+    def save(self, output_dir, output_str):
+        """ Writes the statistics of every trial to `<output_str>_gaze.tsv` """
+
+        if len(self.stats) == 0:
+            return None
+
+        df = self.summary().round(4)
+        df.to_csv(opj(output_dir, output_str+"_gaze.tsv"), sep="\t", index=False)
+        return df
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(timeout=1)
+            self.thread = None
+
+        self.source.close()
+
+def create_gaze_monitor(settings, pix_per_deg=1., win_size=(1920,1080)):
+    """ Gaze monitor for the `eyetracker`-block of the settings, or None if `gaze_monitor` is not set. `gaze_monitor` is 'eyelink' (samples over the link from the tracker at `address`) or 'mock' (a :class:`MockTracker` that replays `mock_samples`, or follows the dot at `sample_rate`) """
+
+    settings = {} if settings is None else settings
+    source = settings.get("gaze_monitor")
+    if source == "eyelink":
+        return GazeMonitor(EyeLinkSource(settings.get("address"), pix_per_deg=pix_per_deg, win_size=win_size))
+    elif source == "mock":
+        samples = settings.get("mock_samples")
+        rate = settings.get("sample_rate", 1000)
+        tracker = MockTracker(samples=None if samples in [None, "None"] else samples, rate=rate)
+        monitor = GazeMonitor(tracker, capacity=max(8192, int(4*rate)), threaded=False)
+        tracker.target = monitor.target_at
+        return monitor
+    elif source in [None, "None"]:
+        return None
+    else:
+        raise ValueError(f"Gaze monitor must be 'eyelink', 'mock' or None, not '{source}'")
@@ -1,8 +1,11 @@
 import argparse
 from datetime import datetime
 import os
-from psychopy import logging
-from session import StarSession
+import sys
+
+# modules shared by both experiments (common/) are in the parent directory
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.startup import StartupProfile
 opj = os.path.join
 opd = os.path.dirname
 
@@ -12,24 +15,32 @@ parser.add_argument('subject', default=None, nargs='?')
 parser.add_argument('session', default=None, nargs='?')
 parser.add_argument('run', default=None, nargs='?')
 parser.add_argument('condition', default=None, nargs='?')
+parser.add_argument('--simulate', action='store_true', help="run headless and faster than real-time with simulated scanner triggers")
+parser.add_argument('--frame_rate', type=float, default=60., help="refresh rate in simulation mode")
+parser.add_argument('--tr', type=float, default=None, help="trigger interval in simulation mode (default: 'TR' in the mri-settings)")
+parser.add_argument('--tr_drift', type=float, default=0., help="relative deviation of the simulated scanner's TR (e.g., 1e-4)")
+parser.add_argument('--tr_jitter', type=float, default=0., help="standard deviation (s) of the simulated trigger timing")
+parser.add_argument('--profile-startup', action='store_true', help="report where the time goes until the first trigger screen")
 
+# psychopy and exptools2 are only imported once the prompts have been answered
 cmd_args = parser.parse_args()
+profile = StartupProfile(enabled=cmd_args.profile_startup)
 subject, session, run, condition = cmd_args.subject, cmd_args.session, cmd_args.run, cmd_args.condition
 
 if subject is None:
-    subject = input('Subject? (999): ')
+    subject = input('Subject? (999): ') if not cmd_args.simulate else ''
     subject = 999 if subject == '' else subject
 
 if session is None:
-    session = input('Session? (0): ')
+    session = input('Session? (0): ') if not cmd_args.simulate else ''
     session = 0 if session == '' else session
 
 if run is None:
-    run = input('Run? (0): ')
+    run = input('Run? (0): ') if not cmd_args.simulate else ''
     run = 0 if run == '' else run
 
 if condition is None:
-    condition = input('Condition? (gaze): ')
+    condition = input('Condition? (gaze): ') if not cmd_args.simulate else ''
     condition = "gaze" if condition == '' else condition    
 
 cmd = f"""python main.py {subject} {session} {run} {condition}"""
@@ -40,10 +51,27 @@ settings_fn = opj(opd(__file__), 'settings.yml')
 
 output_dir = './logs/'+output_str
 
+# simulation replaces the window, clock and keyboard; must be set up before the session (and exptools2) is imported
+simulator = None
+if cmd_args.simulate:
+    from common.simulate import Simulator
+    simulator = Simulator(frame_rate=cmd_args.frame_rate, tr=cmd_args.tr, tr_drift=cmd_args.tr_drift, tr_jitter=cmd_args.tr_jitter).install()
+
+with profile.section("import"):
+    from psychopy import logging
+    from exptools2.core import Session
+    from session import StarSession
+
 if os.path.exists(output_dir):
     logging.warn("Warning: output directory already exists. Renaming to avoid overwriting.")
     output_dir = output_dir + datetime.now().strftime('%Y%m%d%H%M%S')
 
+profile.instrument(Session, "_load_settings", "settings")
+profile.instrument(Session, "_create_window", "window")
+profile.instrument(StarSession, "create_stimuli", "stimuli")
+profile.instrument(StarSession, "create_trials", "trials")
+profile.report_before(StarSession, "start_experiment")
+
 # define session
 session_object = StarSession(
     output_str=output_str, 
@@ -53,5 +81,12 @@ session_object = StarSession(
 )
 
 logging.warn(f'Writing results to: {opj(session_object.output_dir, session_object.output_str)}')
+if simulator is not None:
+    simulator.attach(session_object)
+
 session_object.run()
 session_object.close()
+profile.restore()
+
+if simulator is not None:
+    simulator.uninstall()
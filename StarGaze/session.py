@@ -1,19 +1,27 @@
 from exptools2.core import Session
 import numpy as np
-from stimuli import StarStim
+from common.cache import DesignCache
+from common.session import SessionMixin
+from gaze import SaccadeDetector, create_gaze_monitor, pix_per_degree
+from stimuli import AnchorStim, SpriteStim, StarStim
+from trajectory import build_trajectories, star_positions, trajectory_steps
+from common.timeline import Timeline
 from trial import StarTrial, DummyWaiterTrial, OutroTrial
 import os
 from utils import *
 opj = os.path.join
 opd = os.path.dirname
 
-class StarSession(Session):
+class StarSession(SessionMixin, Session):
     def __init__(
         self, 
         output_str, 
         output_dir, 
         settings_file, 
-        condition=None
+        condition=None,
+        win=None,
+        frame_rate=None,
+        stim_cache=None
         ):
         """ Initializes StroopSession object.
 
@@ -30,11 +38,20 @@ class StarSession(Session):
             Make link with eyetracker during experiment, default is True
         condition: str, optional
             Which conditions to include in the experiment; options are 'LR' (for left & right hand movement), "LB" (left hand & both hands), and "RB" (right hand & both hands)
+        win: psychopy.visual.Window, optional
+            Window of a previous run to draw in, instead of opening a new one (see runner.py)
+        frame_rate: float, optional
+            Measured refresh rate of `win`
+        stim_cache: dict, optional
+            Stimuli of previous runs, which are reused if the stimulus-settings did not change (see :meth:`common.session.SessionMixin.cached`)
         """
         super().__init__(
             output_str, 
             output_dir=output_dir, 
-            settings_file=settings_file
+            settings_file=settings_file,
+            win=win,
+            frame_rate=frame_rate,
+            stim_cache=stim_cache
         )  # initialize parent class!
 
         self.duration           = self.settings['design'].get('stim_duration')
@@ -48,18 +65,45 @@ class StarSession(Session):
         self.condition          = condition
         self.size_cue           = self.settings['stimuli'].get('cue_size')
         self.color_cue          = self.settings['stimuli'].get('cue_color')
+        self.seed               = self.settings['design'].get('seed')
+        self.cache_dir          = self.settings['design'].get('cache_dir')
+        self.events             = ["saccade","pursuit"]
+        self.n_events           = len(self.events)
 
-        # define dot as fixation
-        self.StarStim = StarStim(
-            self,
-            units="deg",
-            size=self.size_cue,
-            fillColor=self.color_cue
-        )
-        
-        # draw into memory
-        self.StarStim.draw()
+        # seeded generator for the design; None draws a fresh design
+        if not isinstance(self.seed, int):
+            self.seed = None
+
+        self.rng = np.random.default_rng(self.seed)
+
+        # cache generated designs, keyed by the settings they were generated with
+        if isinstance(self.cache_dir, str) and self.cache_dir != "None":
+            if not os.path.isabs(self.cache_dir):
+                self.cache_dir = opj(opd(os.path.abspath(__file__)), self.cache_dir)
+            self.design_cache = DesignCache(self.cache_dir, verbose=True)
+        else:
+            self.design_cache = None
+
+        # compare gaze with the dot while running (see gaze.py)
+        self.gaze_monitor = create_gaze_monitor(
+            self.settings.get('eyetracker'),
+            pix_per_deg=pix_per_degree(self.settings['monitor'].get('width'), self.settings['monitor'].get('distance'), self.win.size[0]),
+            win_size=self.win.size)
 
+        # gaze-contingent mode: detect saccades online and end ('end') or hold ('hold') the stimulus on arrival at the target
+        self.gaze_contingent = self.settings['design'].get('gaze_contingent')
+        if self.gaze_contingent in [None, False, "None"]:
+            self.gaze_contingent = None
+        elif self.gaze_contingent not in ["end","hold"]:
+            raise ValueError(f"'gaze_contingent' must be 'end', 'hold' or None, not '{self.gaze_contingent}'")
+        elif self.gaze_monitor is None:
+            raise ValueError("Gaze-contingent mode needs gaze samples; set `gaze_monitor` in the eyetracker-settings")
+        elif self.settings['design'].get('tr_locked'):
+            raise ValueError("Gaze-contingent mode changes the trial durations, so it cannot be combined with `tr_locked`")
+        else:
+            self.gaze_monitor.detector = SaccadeDetector(threshold=self.settings['design'].get('saccade_threshold', 30))
+
+        self.create_stimuli()
 
         # check demo mode
         if self.condition == "demo":
@@ -70,108 +114,237 @@ class StarSession(Session):
         # traverse spokes of star with saccades and smooth pursuit
         self.n_trials = self.star_points*self.n_repeats
 
-    def create_trials(self):
-        """ Creates trials (ideally before running your session!) """
+    def create_stimuli(self):
+        """ Creates the dot that is followed with the eyes """
 
-        # calculate full time of experiment
-        self.total_experiment_time = self.start_duration + (self.n_trials * self.stim_duration) + self.outro_trial_time
+        # define dot as fixation; 'sprite' rasterizes it once into a texture
+        backend = self.settings['stimuli'].get('dot_backend')
+        if backend == "sprite":
+            self.StarStim = self.cached("dot", lambda: SpriteStim(
+                self,
+                units="deg",
+                size=self.size_cue,
+                color=self.color_cue
+            ))
+        elif backend in [None, "None", "circle"]:
+            self.StarStim = self.cached("dot", lambda: StarStim(
+                self,
+                units="deg",
+                size=self.size_cue,
+                fillColor=self.color_cue
+            ))
+        else:
+            raise ValueError(f"'dot_backend' must be 'circle' or 'sprite', not '{backend}'")
 
-        # check if we should add time to meet intended_duration
-        self.add_to_total = 0
-        if self.condition != "demo":
-            if isinstance(self.intended_duration, (int,float)):
-                if self.total_experiment_time < self.intended_duration:
-                    self.add_to_total = self.intended_duration-self.total_experiment_time
-                elif self.intended_duration<self.total_experiment_time:
-                    raise ValueError(f"WARNING: intended duration ({self.intended_duration}) is smaller than total experiment time ({self.total_experiment_time})")
-            
-        self.total_experiment_time += self.add_to_total
-        self.outro_trial_time += self.add_to_total
-        print(f"Total experiment time = {round(self.total_experiment_time,2)}s (added {round(self.add_to_total,2)}s), with {self.n_repeats}x {self.star_points} spokes")
+        # all anchors as faint placeholders, in one draw call
+        self.anchor_stim = None
+        if self.settings['stimuli'].get('show_anchors'):
+            self.anchor_stim = self.cached("anchors", lambda: AnchorStim(
+                self,
+                self.settings['stimuli'].get('star_anchors'),
+                units="deg",
+                size=self.size_cue,
+                color=self.color_cue,
+                opacity=self.settings['stimuli'].get('anchor_opacity', 0.2)
+            ))
+            self.anchor_stim.draw()
         
-        # baseline trial beginning exp
-        dummy_trial = DummyWaiterTrial(
-            session=self,
-            trial_nr=0,
-            phase_durations=[np.inf, self.start_duration],
-            phase_names=["dummy","intro"]
-        )
+        # draw into memory
+        self.StarStim.draw()
 
-        # baseline trial end of exp
-        outro_trial = OutroTrial(
-            session=self,
-            trial_nr=self.n_trials+1,
-            phase_durations=[self.outro_trial_time],
-            phase_names=["outro"],
-            txt='')
-        
-        # parameters
-        self.events = ["saccade","pursuit"] 
-        self.n_events = len(self.events)
-        self.eye_movements = np.tile(np.arange(0,self.n_events), self.star_points)
+    def create_design(self):
+        """ Creates the order of eye movements and the coordinates of each trial; returns a dictionary with 'eye_movements', 'positions', 'coordinates' (n_trials,max_steps,2; padded with the end position) and 'n_steps' """
+
+        # alternate saccades and pursuits
+        eye_movements = np.resize(np.arange(0,self.n_events), self.n_trials)
 
         # shuffle blocks if you want
         if self.settings['design'].get('randomize'):
-            np.random.shuffle(self.movement)
+            self.rng.shuffle(eye_movements)
+
+        # get positions and the number of steps for each event
+        positions = star_positions(self.settings["stimuli"].get("star_anchors"), self.n_repeats)
+        n_steps = trajectory_steps(
+            eye_movements,
+            self.settings["design"].get("steps_saccade"),
+            self.settings["design"].get("steps_pursuit"),
+            events=self.events)
+
+        # positions along line between points for all trials at once
+        coordinates = build_trajectories(positions, n_steps)
+
+        return {
+            "eye_movements": eye_movements,
+            "positions": positions,
+            "coordinates": coordinates,
+            "n_steps": n_steps
+        }
+
+    def load_design(self):
+        """ Loads the design from the cache if the settings (and seed) did not change since it was generated, otherwise creates (and caches) it """
+
+        # without a seed every run draws a new design, so there is nothing to reuse
+        if self.design_cache is None or self.seed is None or self.condition == "demo":
+            return self.create_design()
+
+        key = self.design_cache.key(
+            {
+                "design": self.settings["design"],
+                "star_anchors": self.settings["stimuli"].get("star_anchors")
+            },
+            condition=self.condition,
+            seed=self.seed)
+
+        design = self.design_cache.load(key)
+        if design is None:
+            design = self.create_design()
+            self.design_cache.save(key, f"{self.__class__.__name__}_{self.condition}", **design)
 
-        # get positions
-        self.star_anchors = self.settings["stimuli"].get("star_anchors")
-        self.positions = get_positions(self.star_anchors, self.n_repeats)
+        return design
 
-        self.trials = [dummy_trial]
-        for i in range(self.n_trials):
+    def create_trials(self):
+        """ Creates trials (ideally before running your session!) from the timeline of the run """
+
+        # get design; eye movement type, positions and coordinates for each trial
+        design = self.load_design()
+
+        # planned timing of the whole run, with the trajectory of each trial
+        self.timeline = Timeline.from_design(
+            np.full((self.n_trials,1), float(self.stim_duration)),
+            ["stim"],
+            design["eye_movements"],
+            self.events,
+            start_duration=self.start_duration,
+            end_duration=self.outro_trial_time,
+            n_steps=design["n_steps"],
+            coordinates=design["coordinates"])
+
+        # check if we should add time to meet intended_duration
+        add_to_total = 0
+        if self.condition != "demo":
+            add_to_total = self.timeline.pad(self.intended_duration)
             
-            # get number of steps for each event
-            event_type = self.events[self.eye_movements[i]]
-            if event_type == "saccade":
-                steps = self.settings["design"].get("steps_saccade")
-            else:
-                steps = self.settings["design"].get("steps_pursuit")
-
-            # get the end point per trial
-            start_pos = self.positions[i]
-            if i<(self.n_trials-1):
-                end_pos = self.positions[i+1]
-            else:
-                end_pos = self.positions[0]
-
-            print(f"trial #{i}\t| start = {start_pos}\t| end = {end_pos}")
-
-            # calculate positions along line between points
-            a = Point(*start_pos)
-            b = Point(*end_pos)
-
-            line = a.line_function(b)
-            x_vals = np.linspace(start_pos[0],end_pos[0],steps)
-
-            # fill in x in line function
-            moving_coordinates = []
-            for x in x_vals:
-                y = line(x=x)
-                moving_coordinates.append((x,y))
+        self.total_experiment_time = self.timeline.total_duration
+        print(f"Total experiment time = {round(self.total_experiment_time,2)}s (added {round(add_to_total,2)}s), with {self.n_repeats}x {self.star_points} spokes")
+        
+        # baseline trial beginning exp
+        self.trials = [
+            DummyWaiterTrial(
+                session=self,
+                trial_nr=0,
+                phase_durations=self.timeline.phase_durations(0),
+                phase_names=self.timeline.phase_names(0)
+            )
+        ]
+
+        for trial_nr in range(1, self.n_trials+1):
             
+            moving_coordinates = self.timeline.trajectory(trial_nr)
+            print(f"trial #{trial_nr-1}\t| start = {moving_coordinates[0]}\t| end = {moving_coordinates[-1]}")
+
             # append trial
             self.trials.append(
                 StarTrial(
                     session=self,
-                    trial_nr=1+i,
-                    phase_durations=[self.stim_duration],
-                    phase_names=['stim'],
+                    trial_nr=trial_nr,
+                    phase_durations=self.timeline.phase_durations(trial_nr),
+                    phase_names=self.timeline.phase_names(trial_nr),
                     parameters={
-                        'condition': event_type,
-                        'n_steps': steps
+                        'condition': self.timeline.condition(trial_nr),
+                        'n_steps': len(moving_coordinates)
                     },
                     coords=moving_coordinates,
                     timing='seconds',
                     verbose=True))
             
-        self.trials.append(outro_trial)
+        # baseline trial end of exp
+        self.trials.append(
+            OutroTrial(
+                session=self,
+                trial_nr=self.n_trials+1,
+                phase_durations=self.timeline.phase_durations(self.n_trials+1),
+                phase_names=self.timeline.phase_names(self.n_trials+1),
+                txt=''
+            )
+        )
+
+        # planned onsets after the first pulse, for TR-locked mode
+        self.create_scheduler(self.timeline.onsets())
+
+        self.instrument_trials()
                     
-    def run(self):
-        """ Runs experiment. """
-        self.create_trials()  # create them *before* running!
-        self.start_experiment()
-        for trial in self.trials:
-            trial.run()
-
-        self.close()
\ No newline at end of file
+    def start_run(self):
+        """ Also starts reading gaze samples """
+        super().start_run()
+        if self.gaze_monitor is not None:
+            self.gaze_monitor.start()
+
+    def start_trial(self, trial):
+        """ Also clears the target of the gaze monitor and marks the onset of the trial in the tracker's file """
+        super().start_trial(trial)
+
+        # no target until a StarTrial shows one; mark the onset in the tracker's file (see analysis.py)
+        if self.gaze_monitor is not None:
+            self.gaze_monitor.show_target(trial.trial_nr, None)
+            if hasattr(self.gaze_monitor.source, "message"):
+                self.win.callOnFlip(self.gaze_monitor.source.message, f"start_type-stim_trial-{trial.trial_nr}_phase-0")
+
+            # only saccades during the stimulus are logged (see check_gaze)
+            self.gaze_monitor.saccades()
+
+    def end_trial(self, trial):
+        """ Prints the gaze error of the trial """
+        if self.gaze_monitor is not None:
+            self.gaze_monitor.report(trial.trial_nr)
+
+    def poll_gaze(self):
+        """ Scores the gaze samples that arrived since the last call against the target on the screen (see :class:`gaze.GazeMonitor`) """
+        if self.gaze_monitor is not None:
+            return self.gaze_monitor.update()
+
+    def check_gaze(self, trial, samples, arrival):
+        """ Logs the saccades detected since the last call and the arrival of gaze at the target (see :class:`gaze.Arrival`) as 'response' events (response 'saccade' or 'arrival'), with the duration of the saccade (or dwell) in 'gaze_duration' and the landing position of saccades in 'gaze_x'/'gaze_y' (deg). The 'latency' column holds the time from the end of the saccade (or dwell) until its detection; for saccades, 'rt' holds the time since the last jump of the dot. Ends the phase on arrival ('end'), or on arrival once the nominal duration has passed ('hold'); returns True if gaze has arrived """
+
+        t0 = self.clock.getLastResetTime()
+        for saccade in self.gaze_monitor.saccades():
+            idx = self.global_log.shape[0]
+            self.global_log.loc[idx, 'trial_nr'] = trial.trial_nr
+            self.global_log.loc[idx, 'onset'] = saccade["onset"]-t0
+            self.global_log.loc[idx, 'event_type'] = 'response'
+            self.global_log.loc[idx, 'phase'] = trial.phase
+            self.global_log.loc[idx, 'response'] = 'saccade'
+            self.global_log.loc[idx, 'gaze_duration'] = saccade["offset"]-saccade["onset"]
+            self.global_log.loc[idx, 'gaze_x'] = saccade["x"]
+            self.global_log.loc[idx, 'gaze_y'] = saccade["y"]
+            self.global_log.loc[idx, 'latency'] = saccade["detected"]-saccade["offset"]
+            self.global_log.loc[idx, 'rt'] = saccade["onset"]-self.gaze_monitor.last_jump(saccade["onset"])
+
+        if samples is not None and not arrival.done:
+            arrived = arrival.update(samples)
+            if arrived is not None:
+                idx = self.global_log.shape[0]
+                self.global_log.loc[idx, 'trial_nr'] = trial.trial_nr
+                self.global_log.loc[idx, 'onset'] = arrived[0]-t0
+                self.global_log.loc[idx, 'event_type'] = 'response'
+                self.global_log.loc[idx, 'phase'] = trial.phase
+                self.global_log.loc[idx, 'response'] = 'arrival'
+                self.global_log.loc[idx, 'gaze_duration'] = arrived[1]-arrived[0]
+                self.global_log.loc[idx, 'latency'] = self.gaze_monitor.get_time()-arrived[1]
+
+        if arrival.done and trial.phase == 0:
+            if self.gaze_contingent == "end":
+                trial.stop_phase()
+            elif trial.phase_durations[0] + self.timer.getTime() >= self.stim_duration:
+                trial.stop_phase()
+
+        return arrival.done
+
+    def close(self):
+        """ Closes the session and writes the gaze errors (see :meth:`common.session.SessionMixin.close` for the rest) """
+        if self.closed:
+            return
+
+        super().close()
+        if self.gaze_monitor is not None:
+            self.gaze_monitor.stop()
+            self.gaze_monitor.save(self.output_dir, self.output_str)
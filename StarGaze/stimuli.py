@@ -1,10 +1,19 @@
-from psychopy.visual import Circle
+import numpy as np
+from psychopy.visual import Circle, ElementArrayStim, GratingStim
 
-class StarStim(object):   
+def disk_mask(res=128, fringe=1.5):
+
+    # anti-aliased disk (-1 outside, 1 inside) with a soft edge of `fringe` texels
+    r = np.arange(res)+0.5-res/2
+    dist = np.hypot(r[None,:], r[:,None])
+    return np.clip((res/2-dist)/fringe, 0, 1)*2-1
+
+class StarStim(object):
 
     def __init__(self, session, *args, **kwargs):
 
         self.session = session
+        self.pos = None
         self.star_point = Circle(
             win=self.session.win,
             # opacity=0.1,
@@ -12,5 +21,85 @@ class StarStim(object):
             *args,
             **kwargs)
 
+    def set_pos(self, pos):
+        # only touch the stimulus when the dot moves (setting the position rebuilds the vertices); True if it moved
+        if self.pos is None or pos[0] != self.pos[0] or pos[1] != self.pos[1]:
+            self.pos = (pos[0], pos[1])
+            self.star_point.pos = self.pos
+            return True
+        return False
+
+    def draw(self):
+        self.star_point.draw()
+
+class SpriteStim(StarStim):
+
+    def __init__(self, session, units="deg", size=1, color=(1,1,1), res=128):
+        """ The dot rasterized once into a texture (an anti-aliased disk mask on a single-colored quad), rather than a 128-edge polygon. Moving it only updates the 4 vertices of the quad, and only when the position changes (see :meth:`set_pos`).
+
+        Parameters
+        ----------
+        session : StarSession
+            Session with the window
+        units : str
+            Units of `size`
+        size : float
+            Diameter of the dot
+        color : list
+            RGB color of the dot
+        res : int
+            Resolution of the texture (texels)
+        """
+
+        self.session = session
+        self.pos = None
+        self.star_point = GratingStim(
+            win=self.session.win,
+            tex=None,
+            mask=disk_mask(res),
+            texRes=res,
+            units=units,
+            size=size,
+            color=color,
+            interpolate=True)
+
+class AnchorStim(object):
+
+    def __init__(self, session, anchors, units="deg", size=1, color=(1,1,1), opacity=0.2, res=128):
+        """ All star anchors as faint placeholders, drawn in a single call as one `ElementArrayStim` with the same disk texture as :class:`SpriteStim`
+
+        Parameters
+        ----------
+        session : StarSession
+            Session with the window
+        anchors : list
+            (n,2) positions of the placeholders
+        units : str
+            Units of `anchors` and `size`
+        size : float
+            Diameter of each placeholder
+        color : list
+            RGB color of the placeholders
+        opacity : float
+            Opacity of the placeholders
+        res : int
+            Resolution of the texture (texels)
+        """
+
+        self.session = session
+        anchors = np.asarray(anchors, dtype=float)
+        self.anchors = ElementArrayStim(
+            win=self.session.win,
+            units=units,
+            nElements=anchors.shape[0],
+            xys=anchors,
+            sizes=size,
+            colors=color,
+            opacities=opacity,
+            elementTex=None,
+            elementMask=disk_mask(res),
+            texRes=res,
+            interpolate=True)
+
     def draw(self):
-        self.star_point.draw()      
\ No newline at end of file
+        self.anchors.draw()
@@ -0,0 +1,45 @@
+import numpy as np
+
+def star_positions(anchors, n_repeats):
+
+    # start position of each trial: the anchors, repeated `n_repeats` times
+    return np.tile(np.asarray(anchors, dtype=float), (n_repeats,1))
+
+def trajectory_steps(eye_movements, steps_saccade, steps_pursuit, events=("saccade","pursuit")):
+
+    # number of steps for each trial, based on its eye movement type
+    eye_movements = np.asarray(eye_movements)
+    return np.where(eye_movements == events.index("saccade"), steps_saccade, steps_pursuit).astype(int)
+
+def build_trajectories(positions, n_steps):
+
+    """build_trajectories
+
+    Compute the positions along the path of all trials at once. Trial `i` moves in a straight line from `positions[i]` to `positions[i+1]` (the last trial returns to `positions[0]`) in `n_steps[i]` equidistant steps. The line is interpolated parametrically, so vertical segments are no different from any other.
+
+    Parameters
+    ----------
+    positions: array-like
+        Start position of each trial, shape (n_trials,2)
+    n_steps: int, array-like
+        Number of steps per trial; either one value for all trials or one per trial
+
+    Returns
+    ----------
+    numpy.ndarray
+        Coordinates of shape (n_trials,max(n_steps),2). Trials with fewer steps than the maximum are padded with their end position, so `coords[i,:n_steps[i]]` is the path of trial `i`
+    """
+
+    positions = np.asarray(positions, dtype=float)
+    n_trials = positions.shape[0]
+    n_steps = np.broadcast_to(np.asarray(n_steps, dtype=int), (n_trials,))
+    if np.any(n_steps < 1):
+        raise ValueError(f"Number of steps must be at least 1, not {n_steps.min()}")
+
+    start = positions
+    end = np.roll(positions, -1, axis=0)
+
+    # fraction of the path covered at each step; single-step trials stay at their start, as np.linspace(start, end, 1)
+    t = np.minimum(np.arange(n_steps.max())[None,:] / np.maximum(n_steps-1, 1)[:,None], 1)
+
+    return start[:,None,:] + t[...,None]*(end-start)[:,None,:]
@@ -1,5 +1,6 @@
 import numpy as np
 from exptools2.core import Trial
+from gaze import Arrival
 from psychopy.visual import TextStim
 
 class StarTrial(Trial):
@@ -50,7 +51,7 @@ class StarTrial(Trial):
 
         self.condition = self.parameters['condition']
         self.session = session
-        self.coordinates = coords
+        self.coordinates = np.asarray(coords, dtype=float)
         self.time_per_coord = self.session.duration/len(self.coordinates)
         
         # get switch times
@@ -64,15 +65,56 @@ class StarTrial(Trial):
         self.switch_times = -self.switch_times[::-1]
         self.coord_ix = 0
         self.pos = self.coordinates[0]
+        self.target_shown = False
+
+        # gaze-contingent mode: arrival at the end of the trajectory ends the stimulus, or holds it for at most `max_hold` s
+        self.arrival = None
+        if self.session.gaze_contingent is not None:
+            self.arrival = Arrival(
+                self.coordinates[-1],
+                radius=self.session.settings['design'].get('arrival_radius', 1.5),
+                dwell=self.session.settings['design'].get('arrival_dwell', 0.1))
+            if self.session.gaze_contingent == "hold":
+                self.phase_durations[0] += self.session.settings['design'].get('max_hold', 2)
+
+        # frame-locked lookup of positions: 'frames' indexes a table by frame number, 'time' looks up the elapsed time
+        self.frame_locked = self.session.settings['design'].get('frame_locked')
+        if self.frame_locked in ["frames","time"]:
+            self.coord_onsets = np.arange(len(self.coordinates))*self.time_per_coord
+
+            if self.frame_locked == "frames":
+                self.frame_positions = self.create_frame_lookup(self.session.actual_framerate)
+                self.frame_ix = 0
+        elif self.frame_locked not in [None, False, "None"]:
+            raise ValueError(f"'frame_locked' must be one of 'frames', 'time' or None, not '{self.frame_locked}'")
+
+    def create_frame_lookup(self, frame_rate):
+        """ Position on each frame of the stimulus phase at `frame_rate`; the frame flipped at time t shows the coordinate that is active at t, so the velocity is correct no matter how many steps there are """
+
+        n_frames = max(int(round(self.session.duration*frame_rate)), 1)
+        frame_times = np.arange(n_frames)/frame_rate
+
+        # small tolerance so frames that coincide with a switch time get the new coordinate
+        coord_ix = np.searchsorted(self.coord_onsets, frame_times+1e-9, side='right')-1
+        return self.coordinates[np.clip(coord_ix, 0, len(self.coordinates)-1)]
         
     def run(self):
         super().run()
 
     def draw(self):
         
-        # loop through switch times based on active presentation time
-        self.presentation_time = self.session.timer.getTime()
-        if self.coord_ix < len(self.switch_times):
+        if self.frame_locked == "frames":
+            # constant-time lookup by frame number; hold the last position if the phase runs over
+            self.pos = self.frame_positions[min(self.frame_ix, len(self.frame_positions)-1)]
+            self.frame_ix += 1
+        elif self.frame_locked == "time":
+            # binary search of the elapsed time in the coordinate onsets
+            elapsed = self.phase_durations[self.phase] + self.session.timer.getTime()
+            self.coord_ix = min(max(np.searchsorted(self.coord_onsets, elapsed, side='right')-1, 0), len(self.coordinates)-1)
+            self.pos = self.coordinates[self.coord_ix]
+        elif self.coord_ix < len(self.switch_times):
+            # loop through switch times based on active presentation time
+            self.presentation_time = self.session.timer.getTime()
             if self.presentation_time < self.switch_times[self.coord_ix]:
                 self.pos = self.coordinates[self.coord_ix]
             else:
@@ -81,11 +123,26 @@ class StarTrial(Trial):
             self.pos = self.coordinates[-1]
             
         # draw
-        self.session.StarStim.star_point.setPos(self.pos)
+        if self.session.anchor_stim is not None:
+            self.session.anchor_stim.draw()
+
+        moved = self.session.StarStim.set_pos(self.pos)
         self.session.StarStim.draw()
 
+        # the gaze monitor scores samples against the position from the flip that shows it
+        if self.session.gaze_monitor is not None and (moved or not self.target_shown):
+            self.session.win.callOnFlip(self.session.gaze_monitor.show_target, self.trial_nr, self.pos)
+            self.target_shown = True
+
     def get_events(self):
         events = super().get_events()
+        self.session.poll_triggers(self, events)
+        samples = self.session.poll_gaze()
+
+        # only samples from after the dot reached its end position count as arrival
+        if self.arrival is not None:
+            at_end = self.target_shown and np.array_equal(self.pos, self.coordinates[-1])
+            self.session.check_gaze(self, samples if at_end else None, self.arrival)
 
 class InstructionTrial(Trial):
     """ Simple trial with instruction text. """
@@ -126,6 +183,8 @@ class InstructionTrial(Trial):
 
     def get_events(self):
         events = super().get_events()
+        self.session.poll_triggers(self, events)
+        self.session.poll_gaze()
 
         if self.keys is None:
             if events:
@@ -164,8 +223,14 @@ class DummyWaiterTrial(InstructionTrial):
 
     def get_events(self):
         events = Trial.get_events(self)
+        triggers = self.session.poll_triggers(self, events)
+        self.session.poll_gaze()
 
-        if events:
+        # with a trigger listener, its (precisely timed) triggers start the experiment
+        if self.session.trigger_listener is not None:
+            if triggers and self.phase == 0:
+                self.stop_phase()
+        elif events:
             for key, t in events:
                 if key == self.session.mri_trigger:
                     if self.phase == 0:
@@ -185,6 +250,8 @@ class OutroTrial(InstructionTrial):
         
     def get_events(self):
         events = Trial.get_events(self)
+        self.session.poll_triggers(self, events)
+        self.session.poll_gaze()
 
         if events:
             for key, t in events:
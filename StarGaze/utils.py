@@ -1,4 +1,5 @@
 import numpy as np
+from common.itis import iterative_itis
 
 def slope(dx, dy):
     return (dy / dx) if dx else None
@@ -68,35 +69,3 @@ def get_positions(pos, n_repeats):
         all_pos += pos
 
     return all_pos
-
-# iti function based on negative exponential
-def _return_itis(mean_duration, minimal_duration, maximal_duration, n_trials):
-    itis = np.random.exponential(scale=mean_duration-minimal_duration, size=n_trials)
-    itis += minimal_duration
-    itis[itis>maximal_duration] = maximal_duration
-    return itis
-
-def iterative_itis(mean_duration=6, minimal_duration=3, maximal_duration=18, n_trials=None, leeway=0, verbose=False):
-    
-    nits = 0
-    itis = _return_itis(
-        mean_duration=mean_duration,
-        minimal_duration=minimal_duration,
-        maximal_duration=maximal_duration,
-        n_trials=n_trials)
-
-    total_iti_duration = n_trials * mean_duration
-    min_iti_duration = total_iti_duration - leeway
-    max_iti_duration = total_iti_duration + leeway
-    while (itis.sum() < min_iti_duration) | (itis.sum() > max_iti_duration):
-        itis = _return_itis(
-            mean_duration=mean_duration,
-            minimal_duration=minimal_duration,
-            maximal_duration=maximal_duration,
-            n_trials=n_trials)
-        nits += 1
-
-    if verbose:
-        print(f'ITIs created with total ITI duration of {round(itis.sum(),2)}s after {nits} iterations')    
-
-    return itis
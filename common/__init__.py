@@ -0,0 +1 @@
+""" Modules shared by BlockFingertap and StarGaze: session instrumentation, ITI sampling, design cache, timeline, scanner triggers and TR-locked scheduling, frame recording, event streaming, run logs, profiling, real-time mode, simulation and benchmarks. The scripts of both experiments add the parent directory of `common` to `sys.path`, so that this package is importable when they are run from their own directory """
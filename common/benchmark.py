@@ -0,0 +1,220 @@
+import argparse
+import contextlib
+from datetime import datetime
+import importlib
+import io
+import itertools
+import json
+import numpy as np
+import os
+import platform
+import re
+import subprocess
+import tempfile
+import time
+import yaml
+opj = os.path.join
+
+def time_case(fn, repeat=5, number=None, min_time=0.2):
+    """ Time `fn`; calls are batched so that each repeat takes at least `min_time` seconds (unless `number` is given). Returns seconds per call """
+
+    if number is None:
+        number = 1
+        while True:
+            start = time.perf_counter()
+            for _ in range(number):
+                fn()
+            elapsed = time.perf_counter()-start
+            if elapsed >= min_time or number >= 1e6:
+                break
+            number *= 10
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        timings.append((time.perf_counter()-start)/number)
+
+    timings = np.array(timings)
+    return {
+        "min": float(timings.min()),
+        "median": float(np.median(timings)),
+        "max": float(timings.max()),
+        "number": int(number),
+        "repeat": int(repeat)
+    }
+
+def compare(results, ref, history, history_fn):
+
+    # latest result per case for a branch or commit
+    previous = {}
+    for record in history:
+        if ref in [record.get("branch"), record.get("commit")] or (record.get("commit") or "").startswith(ref):
+            for res in record["results"]:
+                previous[(res["name"], json.dumps(res["params"], sort_keys=True))] = res
+
+    if not previous:
+        print(f"No results for '{ref}' in {history_fn}")
+        return
+
+    print(f"\nCompared to '{ref}' (ratio of median times; >1 is slower)")
+    for res in results:
+        prev = previous.get((res["name"], json.dumps(res["params"], sort_keys=True)))
+        if prev is not None:
+            ratio = res["median"]/prev["median"]
+            flag = "  <-- slower" if ratio > 1.1 else ""
+            print(f"  {res['name']:<16} {json.dumps(res['params']):<48} {ratio:6.2f}x{flag}")
+
+class Benchmark():
+
+    def __init__(self, bench_dir, session_class, condition=None, description=None):
+        """ Headless benchmark suite of an experiment, with a history of results.
+
+        The `benchmark.py` of an experiment creates a Benchmark, registers its cases with the :meth:`case` decorator and calls :meth:`main`. Each run appends the results (with branch, commit, host and versions) to `benchmark_history.jsonl` in `bench_dir`, so that they can be compared between branches or commits.
+
+        Parameters
+        ----------
+        bench_dir : str
+            Directory of the experiment, with `settings.yml` and `session.py`
+        session_class : str
+            Name of the session class in `session.py`; it is imported only when a session is made, after the simulation is set up
+        condition : str, optional
+            Condition of the sessions made by :meth:`make_session`, unless another one is passed
+        description : str, optional
+            Description of the command line interface
+        """
+        self.bench_dir      = bench_dir
+        self.settings_fn    = opj(bench_dir, 'settings.yml')
+        self.history_fn     = opj(bench_dir, 'benchmark_history.jsonl')
+        self.session_class  = session_class
+        self.condition      = condition
+        self.description    = description
+        self.cases          = []
+
+    def case(self, name, display=False, **grid):
+        """ Register a benchmark case; the decorated function receives one combination of the parameters in `grid` and returns the callable to be timed. Cases with `display=True` need a (simulated) session """
+
+        def register(fn):
+            keys = list(grid.keys())
+            for values in itertools.product(*grid.values()):
+                self.cases.append({
+                    "name": name,
+                    "params": dict(zip(keys, values)),
+                    "setup": fn,
+                    "display": display
+                })
+            return fn
+
+        return register
+
+    def load_settings(self, **design):
+        with open(self.settings_fn, 'r', encoding='utf8') as f_in:
+            settings = yaml.safe_load(f_in)
+
+        for key, val in design.items():
+            block, key = key.split('__') if '__' in key else ('design', key)
+            settings[block][key] = val
+
+        return settings
+
+    def settings_file(self, **design):
+
+        # write a copy of the settings with some values changed; no caching, so every call really generates a design
+        settings = self.load_settings(cache_dir=None, various__stream_events=False, **design)
+        fd, fname = tempfile.mkstemp(suffix='.yml')
+        with os.fdopen(fd, 'w') as f_out:
+            yaml.dump(settings, f_out)
+
+        return fname
+
+    def make_session(self, output_dir, condition=None, **design):
+        session_class = getattr(importlib.import_module("session"), self.session_class)
+        fname = self.settings_file(**design)
+        with contextlib.redirect_stdout(io.StringIO()):
+            session = session_class(
+                output_str="sub-bench_ses-0_run-0_task-bench",
+                output_dir=output_dir,
+                settings_file=fname,
+                condition=self.condition if condition is None else condition)
+
+        os.remove(fname)
+        return session
+
+    def git_info(self):
+        info = {}
+        for key, cmd in [("branch", ["git", "rev-parse", "--abbrev-ref", "HEAD"]), ("commit", ["git", "rev-parse", "--short", "HEAD"])]:
+            try:
+                info[key] = subprocess.check_output(cmd, cwd=self.bench_dir, stderr=subprocess.DEVNULL).decode().strip()
+            except Exception:
+                info[key] = None
+
+        return info
+
+    def main(self):
+
+        parser = argparse.ArgumentParser(description=self.description)
+        parser.add_argument('--filter', default=None, help="only run cases whose name matches this regular expression")
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--compare', default=None, help="compare against the latest results of this branch or commit")
+        parser.add_argument('--no_save', action='store_true', help="do not append results to the history")
+        parser.add_argument('--list', action='store_true', help="list cases and exit")
+        parser.add_argument('--display', action='store_true', help="run session cases on a real window rather than the simulated one (needs a display)")
+        args = parser.parse_args()
+
+        selected = [c for c in self.cases if args.filter is None or re.search(args.filter, c["name"])]
+        if args.list:
+            for c in selected:
+                print(f"{c['name']:<16} {c['params']}")
+            return
+
+        # display-cases run against the simulated window, so they also work without a display
+        simulator = None
+        if any(c["display"] for c in selected) and not args.display:
+            try:
+                from .simulate import Simulator
+                simulator = Simulator(verbose=False).install()
+                import exptools2.core
+            except ImportError as e:
+                print(f"Skipping session cases; could not set up simulation ({e})")
+                selected = [c for c in selected if not c["display"]]
+
+        results = []
+        with tempfile.TemporaryDirectory() as output_dir:
+            for c in selected:
+                kwargs = dict(c["params"])
+                if c["display"]:
+                    kwargs["output_dir"] = output_dir
+
+                fn = c["setup"](**kwargs)
+                stats = time_case(fn, repeat=args.repeat)
+
+                # results on a real window are kept apart from simulated ones
+                params = {**c["params"], "display": True} if c["display"] and args.display else c["params"]
+                results.append({"name": c["name"], "params": params, **stats})
+                print(f"{c['name']:<16} {json.dumps(params):<48} {stats['median']*1e3:10.4f}ms (min {stats['min']*1e3:.4f}ms, n={stats['number']}x{stats['repeat']})")
+
+        if simulator is not None:
+            simulator.uninstall()
+
+        history = []
+        if os.path.exists(self.history_fn):
+            with open(self.history_fn, 'r') as f_in:
+                history = [json.loads(line) for line in f_in if line.strip()]
+
+        if args.compare is not None:
+            compare(results, args.compare, history, self.history_fn)
+
+        if not args.no_save:
+            record = {
+                "date": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                **self.git_info(),
+                "host": platform.node(),
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "results": results
+            }
+            with open(self.history_fn, 'a') as f_out:
+                f_out.write(json.dumps(record)+"\n")
+
+            print(f"\nAppended results to {self.history_fn}")
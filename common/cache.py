@@ -0,0 +1,133 @@
+from datetime import datetime
+import hashlib
+import json
+import numpy as np
+import os
+opj = os.path.join
+opd = os.path.dirname
+
+class DesignCache():
+
+    def __init__(self, cache_dir, verbose=False):
+        """ Content-addressed cache of generated designs.
+
+        Designs are stored as `<key>.npz` in `cache_dir`, where the key is a hash of everything that went into generating them (settings, condition, seed and the contents of any files they were read from). An `index.json` maps keys to files and keeps track of the most recent key per "slot" (e.g., experiment and condition), so that entries that went stale because the settings changed are removed automatically.
+
+        Parameters
+        ----------
+        cache_dir : str
+            Directory in which designs and the index are stored (created if needed)
+        verbose : bool
+            Print cache hits/misses
+        """
+        self.cache_dir  = cache_dir
+        self.index_file = opj(self.cache_dir, "index.json")
+        self.verbose    = verbose
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.index = self._read_index()
+
+    def _read_index(self):
+        if os.path.exists(self.index_file):
+            try:
+                with open(self.index_file, 'r') as f_in:
+                    index = json.load(f_in)
+
+                if "entries" in index and "slots" in index:
+                    return index
+            except ValueError:
+                pass
+
+        return {"entries": {}, "slots": {}}
+
+    def _write_index(self):
+
+        # write atomically so a crash never leaves a half-written index
+        tmp_file = self.index_file + ".tmp"
+        with open(tmp_file, 'w') as f_out:
+            json.dump(self.index, f_out, indent=2, sort_keys=True)
+
+        os.replace(tmp_file, self.index_file)
+
+    @staticmethod
+    def file_digest(fname):
+        h = hashlib.sha256()
+        with open(fname, 'rb') as f_in:
+            for block in iter(lambda: f_in.read(1<<16), b''):
+                h.update(block)
+
+        return h.hexdigest()
+
+    def key(self, settings, condition=None, seed=None, files=None):
+        """ Hash of everything that determines a design. `settings` should only contain the relevant parts of the settings (e.g., the `design` block); files in `files` that exist are hashed by content, so editing an ITI- or order-file invalidates the entry as well """
+
+        content = {
+            "settings": settings,
+            "condition": condition,
+            "seed": seed,
+            "files": {}
+        }
+
+        if files is not None:
+            for fname in files:
+                if isinstance(fname, str) and os.path.exists(fname):
+                    content["files"][os.path.basename(fname)] = self.file_digest(fname)
+
+        blob = json.dumps(content, sort_keys=True, default=str)
+        return hashlib.sha256(blob.encode("utf8")).hexdigest()[:20]
+
+    def load(self, key):
+        """ Returns a dictionary with the cached arrays, or None if `key` is not in the cache """
+
+        entry = self.index["entries"].get(key)
+        if entry is None:
+            if self.verbose:
+                print(f"Design cache miss ({key})")
+            return None
+
+        fname = opj(self.cache_dir, entry["file"])
+        if not os.path.exists(fname):
+            self.evict(key)
+            return None
+
+        with np.load(fname, allow_pickle=False) as f_in:
+            design = {k: f_in[k] for k in f_in.files}
+
+        if self.verbose:
+            print(f"Loaded design from cache: {fname}")
+
+        return design
+
+    def save(self, key, slot, **arrays):
+        """ Store `arrays` under `key`; the previous entry for `slot` (if different) is evicted """
+
+        fname = f"{key}.npz"
+        np.savez(opj(self.cache_dir, fname), **arrays)
+
+        stale = self.index["slots"].get(slot)
+        if stale is not None and stale != key:
+            self.evict(stale, write=False)
+
+        self.index["entries"][key] = {
+            "file": fname,
+            "slot": slot,
+            "created": datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        }
+        self.index["slots"][slot] = key
+        self._write_index()
+
+        if self.verbose:
+            print(f"Saved design to cache: {opj(self.cache_dir, fname)}")
+
+    def evict(self, key, write=True):
+        entry = self.index["entries"].pop(key, None)
+        if entry is not None:
+            fname = opj(self.cache_dir, entry["file"])
+            if os.path.exists(fname):
+                os.remove(fname)
+
+            if self.index["slots"].get(entry["slot"]) == key:
+                self.index["slots"].pop(entry["slot"])
+
+        if write:
+            self._write_index()
@@ -0,0 +1,131 @@
+import atexit
+import json
+import numpy as np
+import os
+import queue
+import threading
+opj = os.path.join
+
+# marker on the queue: fsync after writing everything before it
+_SYNC = "sync"
+_STOP = "stop"
+
+def _to_json(val):
+    if isinstance(val, np.generic):
+        return val.item()
+    return str(val)
+
+class EventStream():
+
+    def __init__(self, output_dir, output_str, verbose=True):
+        """ Append-only, crash-safe copy of the event log.
+
+        exptools2 keeps the event log (`session.global_log`) in memory and only writes it at `close()`. :meth:`instrument` hooks into the phase logging of the trials, so that the rows added to the log during the previous phase (the phase row itself, responses, triggers) are put on a queue when the next phase starts; the log is not looked at on the frames in between. A background thread takes the rows off the queue in batches and appends them to `<output_str>_events.jsonl` (one JSON object per line). Each batch is flushed, so the file can be read while the run is going (see :func:`read_stream`), and the file is fsync'ed on every trial boundary (:meth:`start_trial`). The frame loop itself never touches the disk.
+
+        Parameters
+        ----------
+        output_dir : str
+            Directory of the run (created if needed)
+        output_str : str
+            Basename of the output files
+        verbose : bool
+            Print where the stream is written
+        """
+        self.fname      = opj(output_dir, output_str+"_events.jsonl")
+        self.queue      = queue.SimpleQueue()
+        self.n_logged   = 0
+        self.n_written  = 0
+        self.closed     = False
+
+        os.makedirs(output_dir, exist_ok=True)
+        self.f_out = open(self.fname, 'a', encoding='utf8')
+        self.thread = threading.Thread(target=self._writer, name="event-stream", daemon=True)
+        self.thread.start()
+
+        # write whatever is still queued if the process dies of an exception
+        atexit.register(self.close)
+        if verbose:
+            print(f"Streaming events to {self.fname}")
+
+    def _writer(self):
+        while True:
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            lines = []
+            sync = stop = False
+            for item in batch:
+                if item is _SYNC:
+                    sync = True
+                elif item is _STOP:
+                    stop = True
+                else:
+                    lines.append(json.dumps(item, default=_to_json))
+
+            if lines:
+                self.f_out.write("\n".join(lines)+"\n")
+                self.n_written += len(lines)
+
+            self.f_out.flush()
+            if sync or stop:
+                os.fsync(self.f_out.fileno())
+
+            if stop:
+                break
+
+    def poll(self, log):
+        """ Queue the rows that were added to `log` (a DataFrame) since the last call """
+        n_rows = log.shape[0]
+        if n_rows > self.n_logged:
+            for row in log.iloc[self.n_logged:n_rows].to_dict('records'):
+                self.queue.put({key: val for key, val in row.items() if not (isinstance(val, float) and np.isnan(val))})
+            self.n_logged = n_rows
+
+    def start_trial(self, trial):
+        # the responses of the last phase of the previous trial go into this sync
+        self.poll(trial.session.global_log)
+        self.queue.put(_SYNC)
+
+    def _streaming(self, trial, log_phase_info):
+
+        # phase logging runs right after the flip that starts the phase
+        def log_and_stream(*args, **kwargs):
+            result = log_phase_info(*args, **kwargs)
+            self.poll(trial.session.global_log)
+            return result
+
+        return log_and_stream
+
+    def instrument(self, trials):
+        """ Stream the new rows of the event log at the start of every phase of every trial in `trials` """
+        for trial in trials:
+            trial.log_phase_info = self._streaming(trial, trial.log_phase_info)
+
+    def close(self):
+        """ Write what is left on the queue and close the file """
+        if self.closed:
+            return
+
+        self.closed = True
+        self.queue.put(_STOP)
+        self.thread.join()
+        self.f_out.close()
+        atexit.unregister(self.close)
+
+def read_stream(fname):
+    """ Reads an event stream into a DataFrame; a partially written last line (e.g., after a crash) is skipped """
+
+    import pandas as pd
+    rows = []
+    with open(fname, 'r', encoding='utf8') as f_in:
+        for line in f_in:
+            try:
+                rows.append(json.loads(line))
+            except ValueError:
+                break
+
+    return pd.DataFrame(rows)
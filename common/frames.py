@@ -0,0 +1,101 @@
+import numpy as np
+import os
+import pandas as pd
+opj = os.path.join
+
+class FrameRecorder():
+
+    def __init__(self, frame_rate, capacity=2**18, dropped_factor=1.5, max_dropped=None):
+        """ Records the timestamp of every flip into a preallocated ring buffer.
+
+        Recording is a store into two preallocated arrays, so it can run on every frame without allocating. Flips are attributed to the trial set with :meth:`start_trial`. At the end of the session, :meth:`save` writes all timestamps to `<output_str>_frametimes.npz` and a per-trial summary to `<output_str>_frames.tsv`.
+
+        Parameters
+        ----------
+        frame_rate : float
+            Measured refresh rate of the window (Hz); used to detect dropped frames
+        capacity : int
+            Size of the ring buffer; once full, the oldest timestamps are overwritten
+        dropped_factor : float
+            Intervals longer than `dropped_factor` frame periods count as dropped frame(s)
+        max_dropped : int, optional
+            Flag the run as bad if more frames than this were dropped
+        """
+        self.frame_rate     = frame_rate
+        self.frame_period   = 1/frame_rate
+        self.capacity       = int(capacity)
+        self.dropped_factor = dropped_factor
+        self.max_dropped    = max_dropped
+        self.timestamps     = np.full(self.capacity, np.nan)
+        self.trial_nrs      = np.full(self.capacity, -1, dtype=np.int32)
+        self.n_frames       = 0
+        self.trial_nr       = -1
+
+    def start_trial(self, trial_nr):
+        self.trial_nr = trial_nr
+
+    def record(self, t):
+        ix = self.n_frames % self.capacity
+        self.timestamps[ix] = t
+        self.trial_nrs[ix] = self.trial_nr
+        self.n_frames += 1
+
+    def wrap(self, flip):
+        """ Wrap `win.flip` so that every flip is recorded with the timestamp it returns (psychopy's clock). A flip without a timestamp is recorded as NaN rather than timed with another clock, so the intervals next to it are left out """
+
+        def flip_and_record(*args, **kwargs):
+            t = flip(*args, **kwargs)
+            self.record(t if t is not None else np.nan)
+            return t
+
+        return flip_and_record
+
+    def data(self):
+        """ Recorded frames in chronological order as a dictionary of columns """
+
+        n = min(self.n_frames, self.capacity)
+        order = np.arange(self.n_frames-n, self.n_frames) % self.capacity
+        timestamps = self.timestamps[order]
+        intervals = np.diff(timestamps, prepend=np.nan)
+        dropped = np.zeros(n, dtype=np.int32)
+        late = intervals > self.dropped_factor*self.frame_period
+        dropped[late] = np.maximum(np.round(intervals[late]/self.frame_period).astype(np.int32)-1, 1)
+
+        return {
+            "trial_nr": self.trial_nrs[order],
+            "timestamp": timestamps,
+            "interval": intervals,
+            "dropped": dropped
+        }
+
+    def summary(self):
+        """ Per-trial frame count, mean/max interval and number of dropped frames """
+
+        data = self.data()
+        df = pd.DataFrame(data)
+        summary = df.groupby("trial_nr").agg(
+            n_frames=("timestamp", "size"),
+            mean_interval=("interval", "mean"),
+            max_interval=("interval", "max"),
+            dropped=("dropped", "sum"))
+
+        return summary
+
+    def save(self, output_dir, output_str, verbose=True):
+        if self.n_frames == 0:
+            return None
+
+        data = self.data()
+        np.savez(opj(output_dir, output_str+"_frametimes.npz"), frame_rate=self.frame_rate, **data)
+
+        summary = self.summary()
+        summary.round({"mean_interval": 6, "max_interval": 6}).to_csv(opj(output_dir, output_str+"_frames.tsv"), sep="\t")
+
+        n_dropped = int(summary["dropped"].sum())
+        if verbose:
+            print(f"Recorded {self.n_frames} frames; {n_dropped} dropped (max interval = {round(np.nanmax(data['interval'])*1000,2)}ms)")
+
+        if isinstance(self.max_dropped, int) and n_dropped > self.max_dropped:
+            print(f"WARNING: {n_dropped} dropped frames exceeds 'max_dropped_frames' ({self.max_dropped}); check the timing of this run!")
+
+        return summary
@@ -0,0 +1,145 @@
+import math
+import numpy as np
+
+# iti functions based on a truncated negative exponential
+def _truncated_exponential_scale(mean_duration, minimal_duration, maximal_duration, tol=1e-10):
+
+    # find the scale for which the mean of the exponential truncated to [min,max] equals `mean_duration`
+    target = mean_duration-minimal_duration
+    width = maximal_duration-minimal_duration
+    if not 0 < target < width/2:
+        raise ValueError(f"Mean ITI ({mean_duration}) must lie between the minimal ITI ({minimal_duration}) and halfway to the maximal ITI ({minimal_duration+width/2}) for a truncated exponential")
+
+    lo, hi = target*1e-3, target
+    while _truncated_exponential_moments(hi, width)[0] < target:
+        hi *= 2
+
+    while (hi-lo) > tol*hi:
+        mid = (lo+hi)/2
+        if _truncated_exponential_moments(mid, width)[0] < target:
+            lo = mid
+        else:
+            hi = mid
+
+    return (lo+hi)/2
+
+def _truncated_exponential_moments(scale, width):
+
+    # mean and variance of an exponential with `scale`, truncated to [0,width]
+    r = width/scale
+    if r > 700:
+        return scale, scale**2
+    
+    em1 = np.expm1(r)
+    mean = scale - width/em1
+    var = scale**2 - width**2 * (em1+1)/em1**2
+    return mean, var
+
+def _return_itis(mean_duration, minimal_duration, maximal_duration, n_trials, n_batch=None, rng=None):
+
+    # inverse-CDF sampling of an exponential truncated to [min,max]; returns a (n_batch,n_trials) matrix if n_batch is set
+    if rng is None:
+        rng = np.random.default_rng()
+
+    scale = _truncated_exponential_scale(mean_duration, minimal_duration, maximal_duration)
+    size = n_trials if n_batch is None else (n_batch, n_trials)
+    u = rng.random(size=size)
+    itis = -scale*np.log1p(-u*(-np.expm1(-(maximal_duration-minimal_duration)/scale)))
+    itis += minimal_duration
+    return itis
+
+def iti_acceptance_rate(mean_duration=6, minimal_duration=3, maximal_duration=18, n_trials=None, leeway=0):
+
+    # probability that the summed ITIs land within n_trials*mean_duration±leeway (normal approximation of the sum)
+    scale = _truncated_exponential_scale(mean_duration, minimal_duration, maximal_duration)
+    _, var = _truncated_exponential_moments(scale, maximal_duration-minimal_duration)
+    if leeway <= 0:
+        return 0.
+    
+    return math.erf(leeway/np.sqrt(2*n_trials*var))
+
+def iterative_itis(
+    mean_duration=6, 
+    minimal_duration=3, 
+    maximal_duration=18, 
+    n_trials=None, 
+    leeway=0, 
+    verbose=False, 
+    batch_size=1000, 
+    max_batches=1000, 
+    min_acceptance=1e-6,
+    rng=None):
+
+    """iterative_itis
+
+    Draw ITIs from a truncated negative exponential until their sum lies within `leeway` seconds of `n_trials*mean_duration`. Candidate ITI-vectors are drawn in batches of `batch_size` as a single matrix, and the first vector that meets the constraint is returned. The expected acceptance rate is computed beforehand, so that infeasible settings raise immediately rather than looping forever.
+
+    Parameters
+    ----------
+    mean_duration: float
+        Mean ITI duration; also defines the target total duration
+    minimal_duration: float
+        Shortest possible ITI
+    maximal_duration: float
+        Longest possible ITI (the distribution is truncated here, rather than clipped)
+    n_trials: int
+        Number of ITIs to draw
+    leeway: float
+        Allowed deviation (in seconds) of the total ITI duration
+    verbose: bool
+        Print the acceptance rate and number of iterations
+    batch_size: int
+        Number of candidate ITI-vectors drawn at once
+    max_batches: int
+        Give up after this many batches
+    min_acceptance: float
+        Raise if the expected acceptance rate is below this value
+    rng: numpy.random.Generator, optional
+        Random number generator to use; a fresh one is created if None
+
+    Returns
+    ----------
+    numpy.ndarray
+        ITIs of shape (n_trials,)
+    """
+
+    if rng is None:
+        rng = np.random.default_rng()
+
+    p_accept = iti_acceptance_rate(
+        mean_duration=mean_duration,
+        minimal_duration=minimal_duration,
+        maximal_duration=maximal_duration,
+        n_trials=n_trials,
+        leeway=leeway)
+    
+    if verbose:
+        print(f"Expected acceptance rate of ITI-vectors: {p_accept:.2e} (~{int(np.ceil(1/max(p_accept,1e-300)))} draws)")
+
+    if p_accept < min_acceptance:
+        raise ValueError(f"Expected acceptance rate ({p_accept:.2e}) is below {min_acceptance:.0e}; increase 'total_iti_duration_leeway' ({leeway}) or change the ITI-settings")
+
+    total_iti_duration = n_trials * mean_duration
+    min_iti_duration = total_iti_duration - leeway
+    max_iti_duration = total_iti_duration + leeway
+    for nits in range(max_batches):
+        itis = _return_itis(
+            mean_duration=mean_duration,
+            minimal_duration=minimal_duration,
+            maximal_duration=maximal_duration,
+            n_trials=n_trials,
+            n_batch=batch_size,
+            rng=rng)
+
+        sums = itis.sum(axis=1)
+        valid = np.flatnonzero((sums >= min_iti_duration) & (sums <= max_iti_duration))
+        if valid.size > 0:
+            itis = itis[valid[0]]
+            break
+    else:
+        raise ValueError(f"Could not create ITIs with a total duration of {total_iti_duration}±{leeway}s after {max_batches*batch_size} draws")
+
+    if verbose:
+        print(f'ITIs created with total ITI duration of {round(itis.sum(),2)}s after {nits*batch_size+valid[0]} iterations')    
+
+    return itis
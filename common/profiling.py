@@ -0,0 +1,202 @@
+import numpy as np
+import os
+import pandas as pd
+import sys
+import threading
+import time
+import traceback
+opj = os.path.join
+
+# calls that are timed on every frame; `flip` closes the frame
+CALLS = ["get_events", "draw", "log_phase_info", "flip"]
+
+class CallProfiler():
+
+    def __init__(self, frame_rate, capacity=2**18, slow_factor=1.5, sample_stacks=False, sample_interval=0.002, max_depth=8, max_samples=10000):
+        """ Times the calls that make up a frame (see `CALLS`) with `time.perf_counter_ns`.
+
+        :meth:`instrument` wraps `draw`, `get_events` and `log_phase_info` of every trial, and :meth:`wrap` wraps `win.flip`; each wrapper adds the duration of the call to the row of the current frame in a preallocated (capacity,n_calls) array, and the flip moves on to the next row. A frame thus holds everything between two flips: the events of the previous frame, drawing, phase logging (on the flip) and the flip itself (including other flip hooks, like the frame recorder and event stream). Frames that take longer than `slow_factor` frame periods are slow.
+
+        With `sample_stacks`, a background thread looks at the Python stack of the frame loop every `sample_interval` seconds, but only keeps it while the current frame is already slow, so it shows which code made the frame late. :meth:`save` writes a report per trial type at the end of the run.
+
+        Parameters
+        ----------
+        frame_rate : float
+            Measured refresh rate of the window (Hz)
+        capacity : int
+            Number of frames kept; once full, the oldest frames are overwritten
+        slow_factor : float
+            Frames longer than `slow_factor` frame periods are slow
+        sample_stacks : bool
+            Sample the stack of the frame loop during slow frames
+        sample_interval : float
+            Time (s) between stack samples
+        max_depth : int
+            Number of innermost stack frames kept per sample
+        max_samples : int
+            Stop sampling after this many samples
+        """
+        self.frame_rate         = frame_rate
+        self.budget_ns          = int(slow_factor*1e9/frame_rate)
+        self.capacity           = int(capacity)
+        self.durations          = np.zeros((self.capacity, len(CALLS)), dtype=np.int64)
+        self.intervals          = np.zeros(self.capacity, dtype=np.int64)
+        self.trial_nrs          = np.full(self.capacity, -1, dtype=np.int32)
+        self.trial_types        = np.full(self.capacity, -1, dtype=np.int16)
+        self.type_names         = []
+        self.n_frames           = 0
+        self.ix                 = 0
+        self.last_flip          = None
+        self.trial_nr           = -1
+        self.trial_type         = -1
+
+        self.sample_stacks      = sample_stacks
+        self.sample_interval    = sample_interval
+        self.max_depth          = max_depth
+        self.max_samples        = max_samples
+        self.stacks             = {}
+        self.n_samples          = 0
+        self.thread             = None
+        self.stopped            = threading.Event()
+
+    def start(self):
+        """ Starts sampling stacks of the calling thread (the frame loop), if enabled """
+
+        if self.sample_stacks and self.thread is None:
+            self.thread_id = threading.get_ident()
+            self.thread = threading.Thread(target=self._sample, name="stack-sampler", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join(timeout=1)
+            self.thread = None
+
+    def start_trial(self, trial):
+        name = type(trial).__name__
+        if name not in self.type_names:
+            self.type_names.append(name)
+
+        self.trial_nr = trial.trial_nr
+        self.trial_type = self.type_names.index(name)
+
+    def timed(self, function, call):
+        """ `function`, with its duration added to `call` of the current frame """
+
+        k = CALLS.index(call)
+        durations = self.durations
+        def timed_call(*args, **kwargs):
+            start = time.perf_counter_ns()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                durations[self.ix, k] += time.perf_counter_ns()-start
+
+        return timed_call
+
+    def instrument(self, trials):
+        """ Wrap the calls of every trial in `trials` (on the instances, so other sessions are not affected) """
+        for trial in trials:
+            for call in CALLS[:-1]:
+                if hasattr(trial, call):
+                    setattr(trial, call, self.timed(getattr(trial, call), call))
+
+    def wrap(self, flip):
+        """ Wrap `win.flip`, which closes the current frame """
+
+        k = CALLS.index("flip")
+        def timed_flip(*args, **kwargs):
+            start = time.perf_counter_ns()
+            t = flip(*args, **kwargs)
+            now = time.perf_counter_ns()
+
+            ix = self.ix
+            self.durations[ix, k] += now-start
+            self.intervals[ix] = 0 if self.last_flip is None else now-self.last_flip
+            self.trial_nrs[ix] = self.trial_nr
+            self.trial_types[ix] = self.trial_type
+            self.last_flip = now
+
+            self.n_frames += 1
+            self.ix = self.n_frames % self.capacity
+            self.durations[self.ix] = 0
+            return t
+
+        return timed_flip
+
+    def _sample(self):
+        while not self.stopped.wait(self.sample_interval):
+            last_flip = self.last_flip
+            if last_flip is None or time.perf_counter_ns()-last_flip < self.budget_ns:
+                continue
+
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+
+            summary = traceback.StackSummary.extract(traceback.walk_stack(frame), limit=self.max_depth, lookup_lines=False)
+            stack = " < ".join(f"{f.name} ({os.path.basename(f.filename)}:{f.lineno})" for f in summary)
+            key = (self.trial_type, stack)
+            self.stacks[key] = self.stacks.get(key, 0)+1
+            self.n_samples += 1
+            if self.n_samples >= self.max_samples:
+                return
+
+    def data(self):
+        """ Recorded frames in chronological order: durations (s) of each call, frame interval (s), trial number and trial type """
+
+        n = min(self.n_frames, self.capacity)
+        order = np.arange(self.n_frames-n, self.n_frames) % self.capacity
+        data = {call: self.durations[order,k]/1e9 for k, call in enumerate(CALLS)}
+        data["interval"] = np.where(self.intervals[order] > 0, self.intervals[order]/1e9, np.nan)
+        data["trial_nr"] = self.trial_nrs[order]
+        data["trial_type"] = np.asarray(self.type_names+["unknown"])[self.trial_types[order]]
+        return data
+
+    def summary(self):
+        """ Per trial type: number of frames and slow frames, mean and max duration (ms) of each call, and the call that took longest in most slow frames """
+
+        df = pd.DataFrame(self.data())
+        df["slow"] = df["interval"] > self.budget_ns/1e9
+        df["culprit"] = np.asarray(CALLS)[np.argmax(df[CALLS].to_numpy(), axis=1)]
+
+        rows = []
+        for trial_type, frames in df.groupby("trial_type", sort=False):
+            row = {"trial_type": trial_type, "n_frames": len(frames), "n_slow": int(frames["slow"].sum())}
+            for call in CALLS:
+                row[f"{call}_mean"] = frames[call].mean()*1000
+                row[f"{call}_p99"] = frames[call].quantile(0.99)*1000
+                row[f"{call}_max"] = frames[call].max()*1000
+
+            culprits = frames.loc[frames["slow"], "culprit"]
+            row["slow_culprit"] = culprits.mode().iloc[0] if len(culprits) > 0 else None
+            rows.append(row)
+
+        return pd.DataFrame(rows).set_index("trial_type")
+
+    def save(self, output_dir, output_str, verbose=True):
+        """ Writes the summary to `<output_str>_profile.tsv`, the durations of every frame to `<output_str>_profile.npz` and the sampled stacks to `<output_str>_stacks.tsv` """
+
+        if self.n_frames == 0:
+            return None
+
+        np.savez(opj(output_dir, output_str+"_profile.npz"), frame_rate=self.frame_rate, **self.data())
+        summary = self.summary()
+        summary.round(4).to_csv(opj(output_dir, output_str+"_profile.tsv"), sep="\t")
+
+        if len(self.stacks) > 0:
+            names = self.type_names+["unknown"]
+            stacks = pd.DataFrame([{"trial_type": names[k[0]], "n_samples": n, "stack": k[1]} for k, n in self.stacks.items()])
+            stacks.sort_values("n_samples", ascending=False).to_csv(opj(output_dir, output_str+"_stacks.tsv"), sep="\t", index=False)
+
+        if verbose:
+            for trial_type, row in summary.iterrows():
+                calls = ", ".join(f"{call} = {round(row[f'{call}_mean'],3)}ms (max {round(row[f'{call}_max'],2)})" for call in CALLS)
+                culprit = f" (longest call: {row['slow_culprit']})" if row["n_slow"] > 0 else ""
+                print(f"{trial_type}: {row['n_frames']} frames, {row['n_slow']} slow{culprit}; {calls}")
+
+            if self.n_samples > 0:
+                print(f"Sampled {self.n_samples} stacks during slow frames")
+
+        return summary
@@ -0,0 +1,387 @@
+import gc
+import numpy as np
+import os
+import pandas as pd
+import sys
+import time
+import tracemalloc
+from .profiling import CALLS
+opj = os.path.join
+
+# garbage is collected at the start of phases with these names, or at the start of trials without such a phase
+IDLE_PHASES = ["iti"]
+
+# niceness on unix; psutil priority class on windows
+NICENESS = -10
+
+class RealtimeMode():
+
+    def __init__(self, frame_rate, cpu=None, priority=True, idle_phases=IDLE_PHASES):
+        """ Keeps the garbage collector and the scheduler out of the frame loop.
+
+        At :meth:`start`, everything created so far (stimuli, trials, design) is collected once and frozen (`gc.freeze`), so that later collections do not have to walk it, and automatic collection is disabled. Garbage is then only collected by :meth:`collect`, which sessions call at the start of a trial (:meth:`start_trial`) and which :meth:`instrument` hooks into the phase logging of every trial at the start of an ITI (phases in `idle_phases`); trials that have an ITI are only collected there, so that their stimulus onset is never delayed. Both run right after a flip, so a collection has a whole frame. The process priority is raised and the process is pinned to one CPU, where the operating system allows it (with psutil if it is installed, otherwise with `os.nice`/`os.sched_setaffinity`). :meth:`stop` restores all of it.
+
+        Parameters
+        ----------
+        frame_rate : float
+            Measured refresh rate of the window (Hz); collections longer than a frame are reported
+        cpu : int, optional
+            CPU to pin the process to; defaults to the last one available (CPU 0 tends to handle most interrupts)
+        priority : bool
+            Raise the process priority
+        idle_phases : list
+            Names of the phases that start with a collection
+        """
+        self.frame_period   = 1/frame_rate
+        self.cpu            = cpu
+        self.priority       = priority
+        self.idle_phases    = list(idle_phases)
+        self.collections    = []
+        self.trial_nr       = -1
+        self.started        = False
+        self.gc_enabled     = None
+        self.old_priority   = None
+        self.old_affinity   = None
+        self.status         = []
+
+    def start(self):
+        """ Collects and freezes everything created so far, disables automatic collection, raises the priority and pins the process """
+
+        if self.started:
+            return
+
+        self._pin()
+        if self.priority:
+            self._raise_priority()
+
+        self.gc_enabled = gc.isenabled()
+        gc.collect()
+        gc.freeze()
+        gc.disable()
+        self.started = True
+
+        if len(self.status) > 0:
+            print(f"Real-time mode: {', '.join(self.status)}")
+
+    def stop(self):
+        """ Restores automatic collection, the priority and the CPU affinity """
+
+        if not self.started:
+            return
+
+        gc.unfreeze()
+        if self.gc_enabled:
+            gc.enable()
+
+        if self.old_priority is not None:
+            self._set_priority(self.old_priority)
+        if self.old_affinity is not None:
+            self._set_affinity(self.old_affinity)
+
+        self.started = False
+
+    def _raise_priority(self):
+        try:
+            import psutil
+            process = psutil.Process()
+            self.old_priority = process.nice()
+            process.nice(psutil.HIGH_PRIORITY_CLASS if sys.platform == "win32" else NICENESS)
+            self.status.append(f"priority {process.nice()}")
+        except ImportError:
+            if not hasattr(os, "nice"):
+                self.status.append("normal priority (install psutil to raise it)")
+                return
+            try:
+                self.old_priority = os.nice(0)
+                os.nice(NICENESS-self.old_priority)
+                self.status.append(f"niceness {os.nice(0)}")
+            except OSError:
+                self.old_priority = None
+                self.status.append("normal priority (not allowed to raise it)")
+        except Exception as e:
+            # psutil.AccessDenied
+            self.old_priority = None
+            self.status.append(f"normal priority ({type(e).__name__})")
+
+    def _set_priority(self, value):
+        try:
+            import psutil
+            psutil.Process().nice(value)
+        except ImportError:
+            # lowering the priority again is always allowed
+            os.nice(value-os.nice(0))
+        except Exception:
+            pass
+
+    def _pin(self):
+        try:
+            import psutil
+            process = psutil.Process()
+            available = process.cpu_affinity()
+        except ImportError:
+            process = None
+            if not hasattr(os, "sched_getaffinity"):
+                self.status.append("not pinned (install psutil to pin the process)")
+                return
+            available = sorted(os.sched_getaffinity(0))
+        except Exception as e:
+            self.status.append(f"not pinned ({type(e).__name__})")
+            return
+
+        cpu = self.cpu if isinstance(self.cpu, int) else available[-1]
+        if cpu not in available:
+            raise ValueError(f"CPU must be one of {available}, not {cpu}")
+
+        try:
+            self._set_affinity([cpu])
+            self.old_affinity = available
+            self.status.append(f"pinned to CPU {cpu}")
+        except Exception as e:
+            self.status.append(f"not pinned ({type(e).__name__})")
+
+    def _set_affinity(self, cpus):
+        try:
+            import psutil
+            psutil.Process().cpu_affinity(list(cpus))
+        except ImportError:
+            os.sched_setaffinity(0, set(cpus))
+
+    def collect(self, phase=-1):
+        """ Collects garbage; `phase` is -1 between trials """
+
+        start = time.perf_counter()
+        n = gc.collect()
+        self.collections.append((self.trial_nr, phase, n, time.perf_counter()-start))
+
+    def start_trial(self, trial):
+        self.trial_nr = trial.trial_nr
+        if self.started and not any(name in self.idle_phases for name in trial.phase_names):
+            self.collect()
+
+    def _collecting(self, trial, log_phase_info):
+
+        # phase logging runs right after the flip that starts the phase
+        def log_and_collect(*args, **kwargs):
+            result = log_phase_info(*args, **kwargs)
+            phase = kwargs.get("phase", args[0] if len(args) > 0 else None)
+            phase = trial.phase if phase is None else phase
+            if self.started and trial.phase_names[phase] in self.idle_phases:
+                self.collect(phase)
+            return result
+
+        return log_and_collect
+
+    def instrument(self, trials):
+        """ Collect at the start of the ITI phases of every trial in `trials` """
+        for trial in trials:
+            if any(name in self.idle_phases for name in trial.phase_names):
+                trial.log_phase_info = self._collecting(trial, trial.log_phase_info)
+
+    def save(self, output_dir, output_str, verbose=True):
+        """ Writes every collection (trial, phase, number of objects collected, duration) to `<output_str>_gc.tsv` """
+
+        if len(self.collections) == 0:
+            return None
+
+        df = pd.DataFrame(self.collections, columns=["trial_nr", "phase", "n_collected", "duration"])
+        df.round({"duration": 6}).to_csv(opj(output_dir, output_str+"_gc.tsv"), sep="\t", index=False)
+
+        if verbose:
+            n_long = int((df["duration"] > self.frame_period).sum())
+            print(f"Collected garbage {len(df)} times outside of the stimulus phases ({int(df['n_collected'].sum())} objects): {round(df['duration'].mean()*1000,3)}ms on average (max {round(df['duration'].max()*1000,2)}ms, {n_long} longer than a frame)")
+
+        return df
+
+class AllocationAudit():
+
+    def __init__(self, capacity=2**18, n_sites=20, frames=25):
+        """ Traces the memory allocations of the calls that make up a frame (see `CALLS`) with `tracemalloc`.
+
+        Like :class:`profiling.CallProfiler`, :meth:`instrument` wraps `draw`, `get_events` and `log_phase_info` of every trial and :meth:`wrap` wraps `win.flip`. Each wrapper stores how many bytes the call allocated on top of what was allocated when it started (the peak of `tracemalloc`, so memory that is freed again within the call, like temporary tuples, counts too) in a preallocated (capacity,n_calls) array; the flip also stores the net change in traced bytes and allocated blocks (`sys.getallocatedblocks`) since the previous flip, i.e. what the frame kept. :meth:`save` reports both per trial type, and the source lines that kept memory, from snapshots around the first `frames` frames of every trial.
+
+        Tracing every allocation makes everything several times slower, so this is for finding allocations in the draw paths, not for real runs.
+
+        Parameters
+        ----------
+        capacity : int
+            Number of frames kept; once full, the oldest frames are overwritten
+        n_sites : int
+            Number of source lines reported per trial type
+        frames : int
+            Number of frames at the start of each trial that are compared between snapshots (0 disables snapshots)
+        """
+        self.capacity       = int(capacity)
+        self.allocated      = np.zeros((self.capacity, len(CALLS)), dtype=np.int64)
+        self.net_bytes      = np.zeros(self.capacity, dtype=np.int64)
+        self.net_blocks     = np.zeros(self.capacity, dtype=np.int64)
+        self.trial_types    = np.full(self.capacity, -1, dtype=np.int16)
+        self.type_names     = []
+        self.n_sites        = n_sites
+        self.frames         = frames
+        self.sites          = {}
+        self.n_frames       = 0
+        self.ix             = 0
+        self.trial_type     = -1
+        self.trial_frames   = 0
+        self.snapshot       = None
+        self.last_bytes     = None
+        self.last_blocks    = None
+        self.overhead       = 0
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+        # what the measurement itself allocates, from timing a call that allocates nothing
+        def nothing():
+            pass
+
+        self.overhead = min(self._measure(nothing)[1] for _ in range(10))
+
+    def stop(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def _measure(self, function, *args, **kwargs):
+        tracemalloc.reset_peak()
+        start = tracemalloc.get_traced_memory()[1]
+        result = function(*args, **kwargs)
+        peak = tracemalloc.get_traced_memory()[1]
+        return result, peak-start
+
+    def start_trial(self, trial):
+        self._compare()
+
+        name = type(trial).__name__
+        if name not in self.type_names:
+            self.type_names.append(name)
+
+        self.trial_type = self.type_names.index(name)
+        self.trial_frames = 0
+        if self.frames > 0 and tracemalloc.is_tracing():
+            self.snapshot = self._snapshot()
+
+        # the snapshot is not something the next frame kept
+        self.last_bytes = None
+
+    def _snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__)])
+
+    def _compare(self):
+
+        # source lines that hold on to more memory than at the start of the trial
+        if self.snapshot is None:
+            return
+
+        for stat in self._snapshot().compare_to(self.snapshot, "lineno"):
+            if stat.size_diff > 0:
+                frame = stat.traceback[0]
+                key = (self.trial_type, f"{os.path.basename(frame.filename)}:{frame.lineno}")
+                size, count, n_trials = self.sites.get(key, (0, 0, 0))
+                self.sites[key] = (size+stat.size_diff, count+stat.count_diff, n_trials+1)
+
+        self.snapshot = None
+        self.last_bytes = None
+
+    def traced(self, function, call):
+        """ `function`, with what it allocated added to `call` of the current frame """
+
+        k = CALLS.index(call)
+        allocated = self.allocated
+        def traced_call(*args, **kwargs):
+            result, size = self._measure(function, *args, **kwargs)
+            allocated[self.ix, k] += max(size-self.overhead, 0)
+            return result
+
+        return traced_call
+
+    def instrument(self, trials):
+        """ Wrap the calls of every trial in `trials` (on the instances, so other sessions are not affected) """
+        for trial in trials:
+            for call in CALLS[:-1]:
+                if hasattr(trial, call):
+                    setattr(trial, call, self.traced(getattr(trial, call), call))
+
+    def wrap(self, flip):
+        """ Wrap `win.flip`, which closes the current frame """
+
+        k = CALLS.index("flip")
+        def traced_flip(*args, **kwargs):
+            t, size = self._measure(flip, *args, **kwargs)
+            current, blocks = tracemalloc.get_traced_memory()[0], sys.getallocatedblocks()
+
+            ix = self.ix
+            self.allocated[ix, k] += max(size-self.overhead, 0)
+            if self.last_bytes is not None:
+                self.net_bytes[ix] = current-self.last_bytes
+                self.net_blocks[ix] = blocks-self.last_blocks
+            else:
+                self.net_bytes[ix] = self.net_blocks[ix] = 0
+            self.trial_types[ix] = self.trial_type
+            self.last_bytes, self.last_blocks = current, blocks
+
+            self.n_frames += 1
+            self.ix = self.n_frames % self.capacity
+            self.allocated[self.ix] = 0
+
+            # stop comparing once the frames at the start of the trial are done
+            self.trial_frames += 1
+            if self.trial_frames == self.frames:
+                self._compare()
+            return t
+
+        return traced_flip
+
+    def data(self):
+        """ Recorded frames in chronological order: bytes allocated by each call, net change in bytes and blocks, and trial type """
+
+        n = min(self.n_frames, self.capacity)
+        order = np.arange(self.n_frames-n, self.n_frames) % self.capacity
+        data = {call: self.allocated[order,k] for k, call in enumerate(CALLS)}
+        data["net_bytes"] = self.net_bytes[order]
+        data["net_blocks"] = self.net_blocks[order]
+        data["trial_type"] = np.asarray(self.type_names+["unknown"])[self.trial_types[order]]
+        return data
+
+    def summary(self):
+        """ Per trial type: number of frames, the share of frames in which each call allocated, mean and max bytes allocated per frame by each call, and the mean net change per frame """
+
+        df = pd.DataFrame(self.data())
+        rows = []
+        for trial_type, frames in df.groupby("trial_type", sort=False):
+            row = {"trial_type": trial_type, "n_frames": len(frames)}
+            for call in CALLS:
+                row[f"{call}_frac"] = (frames[call] > 0).mean()
+                row[f"{call}_mean"] = frames[call].mean()
+                row[f"{call}_max"] = frames[call].max()
+
+            row["net_bytes"] = frames["net_bytes"].mean()
+            row["net_blocks"] = frames["net_blocks"].mean()
+            rows.append(row)
+
+        return pd.DataFrame(rows).set_index("trial_type")
+
+    def save(self, output_dir, output_str, verbose=True):
+        """ Writes the summary to `<output_str>_alloc.tsv`, the allocations of every frame to `<output_str>_alloc.npz` and the source lines that kept memory to `<output_str>_alloc_sites.tsv` """
+
+        if self.n_frames == 0:
+            return None
+
+        np.savez(opj(output_dir, output_str+"_alloc.npz"), **self.data())
+        summary = self.summary()
+        summary.round(3).to_csv(opj(output_dir, output_str+"_alloc.tsv"), sep="\t")
+
+        if len(self.sites) > 0:
+            names = self.type_names+["unknown"]
+            sites = pd.DataFrame([{"trial_type": names[k[0]], "site": k[1], "bytes": v[0], "blocks": v[1], "n_trials": v[2]} for k, v in self.sites.items()])
+            sites = sites.sort_values("bytes", ascending=False).groupby("trial_type", sort=False).head(self.n_sites)
+            sites.to_csv(opj(output_dir, output_str+"_alloc_sites.tsv"), sep="\t", index=False)
+
+        if verbose:
+            for trial_type, row in summary.iterrows():
+                calls = ", ".join(f"{call} = {int(round(row[f'{call}_mean']))}B ({int(round(row[f'{call}_frac']*100))}% of frames)" for call in CALLS)
+                print(f"{trial_type}: {int(row['n_frames'])} frames, allocated per frame: {calls}; kept {round(row['net_bytes'],1)}B ({round(row['net_blocks'],2)} blocks) per frame")
+
+        return summary
@@ -0,0 +1,168 @@
+import json
+import numpy as np
+import os
+import pandas as pd
+opj = os.path.join
+
+# BIDS order of the entities in a file name
+BIDS_ENTITIES = ["sub", "ses", "task", "acq", "ce", "rec", "dir", "run", "echo"]
+
+# rows of the event log that are not phases of a trial
+NON_PHASE_EVENTS = ["response", "trigger", "pulse", "non_response_keypress"]
+
+def bids_name(output_str):
+
+    # reorder `key-value` entities of `output_str` (e.g., sub-01_ses-1_run-1_task-RL_acq-x) as BIDS wants them
+    entities = dict(part.split("-", 1) for part in output_str.split("_") if "-" in part)
+    keys = [key for key in BIDS_ENTITIES if key in entities] + [key for key in entities if key not in BIDS_ENTITIES]
+    return "_".join(f"{key}-{entities[key]}" for key in keys)
+
+def typed_column(values):
+
+    # numbers become int/float arrays (missing -> NaN), anything else fixed-width strings (missing -> '')
+    values = pd.Series(values)
+    numeric = pd.to_numeric(values, errors="coerce")
+    if values.notna().sum() > 0 and numeric.notna().sum() == values.notna().sum():
+        if numeric.notna().all() and np.all(np.mod(numeric, 1) == 0):
+            return numeric.to_numpy(dtype=np.int64)
+        return numeric.to_numpy(dtype=float)
+
+    return values.fillna("").astype(str).to_numpy(dtype=str)
+
+def log_arrays(log, trials=None, settings=None, trigger=None):
+    """log_arrays
+
+    Converts the event log of a session into typed arrays.
+
+    Parameters
+    ----------
+    log: pandas.DataFrame
+        Event log as written by exptools2 (`session.global_log` after `close()`)
+    trials: list, optional
+        Trials of the session; their `parameters` are stored per trial
+    settings: dict, optional
+        Settings of the session; stored as a JSON-string
+    trigger: str, optional
+        Event type of scanner triggers; default is 'trigger' (from the trigger listener) if the log has those, otherwise 'pulse'
+
+    Returns
+    ----------
+    dict
+        `events_<column>` for all rows of the log, `phase_onsets`/`phase_durations` of shape (n_trials,max_phases) (NaN-padded; row `i` is trial `trials_trial_nr[i]`), `trials_<parameter>` per trial, `first_trigger` (onset of the first trigger; NaN if there was none) and `settings`
+    """
+
+    log = log.reset_index() if "trial_nr" not in log.columns else log.copy()
+    n = log.shape[0]
+    col = lambda name: log[name] if name in log.columns else pd.Series([np.nan]*n)
+
+    arrays = {
+        "events_trial_nr": col("trial_nr").to_numpy(dtype=np.int32),
+        "events_onset": col("onset").to_numpy(dtype=float),
+        "events_duration": col("duration").to_numpy(dtype=float),
+        "events_event_type": col("event_type").fillna("").astype(str).to_numpy(dtype=str),
+        "events_phase": col("phase").fillna(-1).to_numpy(dtype=np.int16),
+        "events_response": col("response").fillna("").astype(str).to_numpy(dtype=str),
+        "events_nr_frames": col("nr_frames").fillna(-1).to_numpy(dtype=np.int32),
+        "events_latency": col("latency").to_numpy(dtype=float)
+    }
+
+    # onset and duration of each phase as a (trial, phase) table
+    is_phase = ~np.isin(arrays["events_event_type"], NON_PHASE_EVENTS)
+    trial_nrs, trial_ix = np.unique(arrays["events_trial_nr"][is_phase], return_inverse=True)
+    phases = arrays["events_phase"][is_phase]
+    n_phases = int(phases.max())+1 if phases.size > 0 else 0
+    arrays["phase_onsets"] = np.full((trial_nrs.size, n_phases), np.nan)
+    arrays["phase_durations"] = np.full((trial_nrs.size, n_phases), np.nan)
+    arrays["phase_onsets"][trial_ix, phases] = arrays["events_onset"][is_phase]
+    arrays["phase_durations"][trial_ix, phases] = arrays["events_duration"][is_phase]
+    arrays["trials_trial_nr"] = trial_nrs.astype(np.int32)
+
+    # trial parameters (e.g., condition and n_steps), one value per row of the phase table
+    if trials is not None:
+        parameters = {trial.trial_nr: trial.parameters for trial in trials}
+        keys = list(dict.fromkeys(key for params in parameters.values() for key in params))
+        for key in keys:
+            arrays[f"trials_{key}"] = typed_column([parameters.get(nr, {}).get(key) for nr in trial_nrs])
+
+    if trigger is None:
+        trigger = "trigger" if np.any(arrays["events_event_type"] == "trigger") else "pulse"
+
+    triggers = arrays["events_onset"][arrays["events_event_type"] == trigger]
+    arrays["first_trigger"] = np.array(triggers.min() if triggers.size > 0 else np.nan)
+    arrays["settings"] = np.array(json.dumps(settings if settings is not None else {}, default=str))
+
+    return arrays
+
+def bids_events(arrays, parameters=None):
+    """ BIDS events table from :func:`log_arrays`: all phases and responses after the first trigger, with onsets relative to that trigger; `trial_type` is the event type, trial parameters are added as columns """
+
+    t0 = float(arrays["first_trigger"])
+    if np.isnan(t0):
+        print("WARNING: no trigger in the log; onsets are relative to the start of the experiment")
+        t0 = 0.
+
+    event_type = arrays["events_event_type"]
+    keep = ~np.isin(event_type, ["trigger", "pulse"]) & (arrays["events_onset"] >= t0)
+
+    df = pd.DataFrame({
+        "onset": arrays["events_onset"][keep]-t0,
+        "duration": arrays["events_duration"][keep],
+        "trial_type": event_type[keep],
+        "trial_nr": arrays["events_trial_nr"][keep],
+        "response": arrays["events_response"][keep]
+    })
+    df.loc[df["response"] == "", "response"] = np.nan
+
+    # broadcast the trial parameters to the events
+    if parameters is None:
+        parameters = [key[7:] for key in arrays if key.startswith("trials_") and key != "trials_trial_nr"]
+
+    ix = np.searchsorted(arrays["trials_trial_nr"], df["trial_nr"].to_numpy())
+    ix = np.minimum(ix, arrays["trials_trial_nr"].size-1)
+    matched = arrays["trials_trial_nr"][ix] == df["trial_nr"].to_numpy()
+    for key in parameters:
+        values = pd.Series(arrays[f"trials_{key}"][ix]).where(matched)
+        if values.dtype.kind == "f" and np.all(np.mod(values.dropna(), 1) == 0):
+            values = values.astype("Int64")
+        elif not pd.api.types.is_numeric_dtype(values):
+            values = values.where(values != "")
+        df[key] = values
+
+    return df.round({"onset": 5, "duration": 5})
+
+def save_run(session, verbose=True):
+    """ Writes `<output_str>_log.npz` (see :func:`log_arrays`) and a BIDS `_events.tsv` in `<output_dir>/bids` for a closed session """
+
+    arrays = log_arrays(
+        session.global_log,
+        trials=getattr(session, "trials", None),
+        settings=session.settings)
+
+    fname = opj(session.output_dir, session.output_str+"_log.npz")
+    np.savez(fname, **arrays)
+
+    bids_dir = opj(session.output_dir, "bids")
+    os.makedirs(bids_dir, exist_ok=True)
+    bids_fname = opj(bids_dir, bids_name(session.output_str)+"_events.tsv")
+    bids_events(arrays).to_csv(bids_fname, sep="\t", index=False, na_rep="n/a")
+
+    if verbose:
+        print(f"Wrote {fname} and {bids_fname}")
+
+    return fname
+
+def load_run(fname, keys=None):
+    """ Reads (a subset of) the arrays of a `_log.npz`; arrays that are not requested are not read """
+
+    with np.load(fname, allow_pickle=False) as f_in:
+        keys = f_in.files if keys is None else keys
+        return {key: f_in[key] for key in keys}
+
+def load_study(fnames, keys=["events_trial_nr", "events_onset", "events_duration", "events_event_type"]):
+    """ Concatenates `keys` over runs; adds `run` with the index into `fnames` for every row. All keys should have the same number of rows within a run (e.g., all `events_*` or all `trials_*`) """
+
+    runs = [load_run(fname, keys=keys) for fname in fnames]
+    study = {key: np.concatenate([run[key] for run in runs]) for key in keys}
+    study["run"] = np.repeat(np.arange(len(runs)), [len(run[keys[0]]) for run in runs])
+
+    return study
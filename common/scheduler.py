@@ -0,0 +1,121 @@
+import numpy as np
+import os
+import pandas as pd
+opj = os.path.join
+
+class PulseScheduler():
+
+    def __init__(self, tr, planned_onsets, max_correction=0.5, frame_rate=60., window=20, verbose=True):
+        """ Locks trial onsets to the scanner pulses rather than to the psychopy clock.
+
+        The planned onset of each trial (seconds after the first pulse, from the design) is converted to a pulse count (`onset/tr`), and that pulse count to a time on the session clock using the pulses received so far: a straight line is fitted through the last `window` pulses (indexed by rounding their distance to the first pulse to whole TRs, so a missed pulse does not shift the count), which averages out jitter and follows drift of the scanner clock. The last phase of every trial is then ended at the anchored onset of the next trial, instead of after its nominal duration (see :meth:`prepare`).
+
+        Parameters
+        ----------
+        tr : float
+            Nominal repetition time (s)
+        planned_onsets : dict
+            Trial number -> planned onset (s after the first pulse)
+        max_correction : float
+            Anchored onsets differ at most this much from the onsets the psychopy clock alone would give; larger corrections are clipped (e.g., when pulses are missing or spurious)
+        frame_rate : float
+            Refresh rate; a phase is stopped when the next flip is less than half a frame from the anchored onset
+        window : int
+            Number of most recent pulses used to estimate the pulse clock
+        verbose : bool
+            Print a summary of the corrections
+        """
+        self.tr             = tr
+        self.planned_onsets = planned_onsets
+        self.max_correction = max_correction
+        self.frame_period   = 1/frame_rate
+        self.window         = window
+        self.verbose        = verbose
+        self.pulses         = []
+        self.fit            = None
+        self.corrections    = []
+        self.anchored       = set()
+
+    def prepare(self, trials):
+        """ Extend the last phase of every trial that is followed by a planned trial, so that the scheduler rather than the phase timer ends it """
+
+        slack = self.max_correction + self.frame_period
+        for trial in trials:
+            if trial.trial_nr+1 in self.planned_onsets:
+                trial.phase_durations[-1] += slack
+
+    def add_pulses(self, onsets):
+        if len(onsets) > 0:
+            self.pulses += list(onsets)
+            self.fit = None
+
+    def _fit_pulses(self):
+
+        # pulse index -> time on the session clock
+        pulses = np.asarray(self.pulses)
+        index = np.round((pulses-pulses[0])/self.tr)
+        index, pulses = index[-self.window:], pulses[-self.window:]
+        if np.unique(index).size < 2:
+            return self.tr, pulses[-1]-index[-1]*self.tr
+
+        slope, intercept = np.polyfit(index, pulses, 1)
+        return slope, intercept
+
+    def target(self, trial_nr):
+        """ Anchored onset of `trial_nr` on the session clock, and the onset the psychopy clock alone would give; None if unknown """
+
+        if len(self.pulses) == 0 or trial_nr not in self.planned_onsets:
+            return None
+
+        if self.fit is None:
+            self.fit = self._fit_pulses()
+
+        slope, intercept = self.fit
+        planned = self.planned_onsets[trial_nr]
+        clock_onset = self.pulses[0] + planned
+        anchored = intercept + slope*planned/self.tr
+        anchored = clock_onset + np.clip(anchored-clock_onset, -self.max_correction, self.max_correction)
+        return anchored, clock_onset
+
+    def check(self, trial, now):
+        """ True if `trial` should end now (`now` being the time of the last flip), because the next flip is less than half a frame from the anchored onset of the next trial """
+
+        next_trial = trial.trial_nr+1
+        if trial.phase != len(trial.phase_durations)-1 or next_trial in self.anchored:
+            return False
+
+        target = self.target(next_trial)
+        if target is None:
+            return False
+
+        anchored, clock_onset = target
+        if now+self.frame_period < anchored-self.frame_period/2:
+            return False
+
+        self.anchored.add(next_trial)
+        self.corrections.append({
+            "trial_nr": next_trial,
+            "planned": self.planned_onsets[next_trial],
+            "clock_onset": clock_onset,
+            "anchored_onset": anchored,
+            "correction": anchored-clock_onset,
+            "stopped_at": now,
+            "n_pulses": len(self.pulses),
+            "tr_estimate": self.fit[0]
+        })
+        return True
+
+    def save(self, output_dir, output_str):
+        """ Writes the correction of every trial to `<output_str>_schedule.tsv` """
+
+        if len(self.corrections) == 0:
+            return None
+
+        df = pd.DataFrame(self.corrections).round(6)
+        df.to_csv(opj(output_dir, output_str+"_schedule.tsv"), sep="\t", index=False)
+
+        if self.verbose:
+            correction = df["correction"].to_numpy()*1000
+            print(f"TR-locked {len(df)} trials on {len(self.pulses)} pulses (TR = {round(df['tr_estimate'].iloc[-1],5)}s); correction = {round(correction[-1],2)}ms at the end (max {round(np.abs(correction).max(),2)}ms)")
+
+        return df
@@ -0,0 +1,266 @@
+import json
+import numpy as np
+import os
+from .eventlog import EventStream
+from .frames import FrameRecorder
+from .profiling import CallProfiler
+from .realtime import AllocationAudit, RealtimeMode
+from .runlog import save_run
+from .scheduler import PulseScheduler
+from .triggers import create_trigger_listener
+opj = os.path.join
+
+# various-settings that change what is recorded during a run, not what the stimuli look like
+RUN_SETTINGS = [
+    "record_frames", "max_dropped_frames", "stream_events", "columnar_log",
+    "profile_calls", "profile_stacks", "realtime", "realtime_cpu", "audit_allocations"]
+
+def stimulus_key(name, settings):
+    """ Key of stimulus `name` in a stimulus cache that is shared between runs (see runner.py): the stimulus-settings and the various-settings other than `RUN_SETTINGS`, so that only changes that affect the stimuli create new ones """
+
+    various = {key: val for key, val in settings['various'].items() if key not in RUN_SETTINGS}
+    return (name, json.dumps([settings['stimuli'], various], sort_keys=True, default=str))
+
+class SessionMixin():
+
+    def __init__(self, output_str, output_dir=None, settings_file=None, win=None, frame_rate=None, stim_cache=None):
+        """ What MotorSession and StarSession add to exptools2's `Session` to record a run: the frame recorder, the trigger listener and TR-locked scheduler, the event stream, the profiler, the allocation audit and real-time mode, each enabled in the settings, and the window and stimuli that the runner shares between runs. Put it before `Session` in the bases of a session, which then only has to create `trials` (and `timeline`), call :meth:`instrument_trials` at the end of `create_trials`, and can extend :meth:`start_run`, :meth:`start_trial`, :meth:`end_trial` and :meth:`close`.
+
+        Parameters
+        ----------
+        output_str : str
+            Basename for all output-files
+        output_dir : str
+            Path to desired output-directory
+        settings_file : str
+            Path to yaml-file with settings
+        win: psychopy.visual.Window, optional
+            Window of a previous run to draw in, instead of opening a new one (see runner.py)
+        frame_rate: float, optional
+            Measured refresh rate of `win`
+        stim_cache: dict, optional
+            Stimuli of previous runs, which are reused if the stimulus-settings did not change (see :meth:`cached`)
+        """
+        self.shared_win = win
+        self.shared_frame_rate = frame_rate
+        self.stim_cache = stim_cache
+        super().__init__(
+            output_str,
+            output_dir=output_dir,
+            settings_file=settings_file
+        )  # initialize parent class!
+
+        # record flip timestamps to check for dropped frames
+        if self.settings['various'].get('record_frames'):
+            self.frame_recorder = FrameRecorder(
+                self.actual_framerate,
+                max_dropped=self.settings['various'].get('max_dropped_frames'))
+            self.win.flip = self.frame_recorder.wrap(self.win.flip)
+        else:
+            self.frame_recorder = None
+
+        # listen for scanner triggers on a separate thread (see common/triggers.py)
+        self.trigger_listener = create_trigger_listener(self.settings.get('triggers'), self.mri_trigger)
+        self.trigger_latencies = []
+        self.scheduler = None
+        self.timeline = None
+
+        # stream the event log to disk while running, so a crash does not lose it
+        if self.settings['various'].get('stream_events'):
+            self.event_stream = EventStream(self.output_dir, self.output_str)
+        else:
+            self.event_stream = None
+
+        # trace what draw, get_events, phase logging and flip allocate on every frame (see common/realtime.py)
+        if self.settings['various'].get('audit_allocations'):
+            self.allocation_audit = AllocationAudit()
+            self.win.flip = self.allocation_audit.wrap(self.win.flip)
+        else:
+            self.allocation_audit = None
+
+        # no automatic garbage collection during the run, raised priority and pinned to a CPU (see common/realtime.py)
+        if self.settings['various'].get('realtime'):
+            self.realtime = RealtimeMode(
+                self.actual_framerate,
+                cpu=self.settings['various'].get('realtime_cpu'))
+        else:
+            self.realtime = None
+
+        # time draw, get_events, phase logging and flip on every frame (see common/profiling.py)
+        if self.settings['various'].get('profile_calls'):
+            self.profiler = CallProfiler(
+                self.actual_framerate,
+                sample_stacks=bool(self.settings['various'].get('profile_stacks')))
+            self.win.flip = self.profiler.wrap(self.win.flip)
+        else:
+            self.profiler = None
+
+    def _create_window(self):
+        """ Opens the window, or takes the window of a previous run if one was passed (see runner.py) """
+        if self.shared_win is None:
+            return super()._create_window()
+
+        self.actual_framerate = self.shared_frame_rate if isinstance(self.shared_frame_rate, (int,float)) else self.shared_win.getActualFrameRate()
+        return self.shared_win
+
+    def cached(self, name, create):
+        """ Stimulus `name` from the stimulus cache shared between runs, or `create()` (which is then cached); the stimulus-settings are part of the key, so changed settings create new stimuli """
+        if self.stim_cache is None:
+            return create()
+
+        key = stimulus_key(name, self.settings)
+        if key not in self.stim_cache:
+            self.stim_cache[key] = create()
+
+        return self.stim_cache[key]
+
+    def instrument_trials(self):
+        """ Hooks the event stream, real-time mode, allocation audit and profiler into the trials; call at the end of `create_trials` """
+        if self.event_stream is not None:
+            self.event_stream.instrument(self.trials)
+        if self.realtime is not None:
+            self.realtime.instrument(self.trials)
+        if self.allocation_audit is not None:
+            self.allocation_audit.instrument(self.trials)
+        if self.profiler is not None:
+            self.profiler.instrument(self.trials)
+
+    def run(self):
+        """ Runs experiment. """
+        self.create_trials()  # create them *before* running!
+        self.start_run()
+        self.start_experiment()
+
+        # collect everything that setting up the run created, and nothing after that unless idle
+        if self.realtime is not None:
+            self.realtime.start()
+
+        for trial in self.trials:
+            self.start_trial(trial)
+            trial.run()
+            self.end_trial(trial)
+
+        self.close()
+
+    def start_run(self):
+        """ Starts the trigger listener, the profiler and the allocation audit; called before `start_experiment` """
+        if self.trigger_listener is not None:
+            self.trigger_listener.start()
+        if self.profiler is not None:
+            self.profiler.start()
+        if self.allocation_audit is not None:
+            self.allocation_audit.start()
+
+    def start_trial(self, trial):
+        """ Marks the start of `trial` in the frame recorder, profiler, allocation audit, real-time mode and event stream; called before the trial runs """
+        if self.frame_recorder is not None:
+            self.frame_recorder.start_trial(trial.trial_nr)
+        if self.profiler is not None:
+            self.profiler.start_trial(trial)
+        if self.allocation_audit is not None:
+            self.allocation_audit.start_trial(trial)
+        if self.realtime is not None:
+            self.realtime.start_trial(trial)
+        if self.event_stream is not None:
+            self.event_stream.start_trial(trial)
+
+    def end_trial(self, trial):
+        """ Called after `trial` has run """
+        pass
+
+    def poll_triggers(self, trial, events=None):
+        """ Logs the triggers from the trigger listener that arrived since the last call as 'trigger' events, with the timestamps of the listener; returns their onsets. The latency until the next flip is added to each trigger in the 'latency' column. In TR-locked mode, the pulses (from the listener, or the `mri_trigger` keys in `events`) are passed on to the scheduler, which ends the phase when the next trial is due """
+
+        onsets = []
+        for t in self.trigger_listener.drain() if self.trigger_listener is not None else []:
+            onset = t - self.clock.getLastResetTime()
+            idx = self.global_log.shape[0]
+            self.global_log.loc[idx, 'trial_nr'] = trial.trial_nr
+            self.global_log.loc[idx, 'onset'] = onset
+            self.global_log.loc[idx, 'event_type'] = 'trigger'
+            self.global_log.loc[idx, 'phase'] = trial.phase
+            self.global_log.loc[idx, 'response'] = self.mri_trigger
+            self.win.callOnFlip(self._log_trigger_latency, idx, onset)
+            onsets.append(onset)
+
+        if self.scheduler is not None:
+            if self.trigger_listener is not None:
+                self.scheduler.add_pulses(onsets)
+            elif events:
+                self.scheduler.add_pulses([t for key, t in events if key == self.mri_trigger])
+
+            if self.scheduler.check(trial, self.clock.getTime()):
+                trial.stop_phase()
+
+        return onsets
+
+    def create_scheduler(self, planned_onsets):
+        """ Creates the scheduler for TR-locked mode (`tr_locked` in the design-settings) and extends the trials so that it ends their last phase; `planned_onsets` maps trial numbers to onsets after the first pulse """
+
+        if not self.settings['design'].get('tr_locked'):
+            self.scheduler = None
+            return
+
+        tr = self.settings['design'].get('tr')
+        if not isinstance(tr, (int,float)):
+            tr = self.settings.get('mri', {}).get('TR')
+        if not isinstance(tr, (int,float)):
+            raise ValueError("TR-locked mode needs the TR; set `tr` in the design-settings or `TR` in the mri-settings")
+
+        self.scheduler = PulseScheduler(
+            tr,
+            planned_onsets,
+            max_correction=self.settings['design'].get('max_correction', 0.5),
+            frame_rate=self.actual_framerate)
+        self.scheduler.prepare(self.trials)
+
+    def _log_trigger_latency(self, idx, onset):
+        latency = self.clock.getTime()-onset
+        self.global_log.loc[idx, 'latency'] = latency
+        self.trigger_latencies.append(latency)
+
+    def close(self):
+        """ Closes the session, finishes the event stream and writes the columnar log, schedule, timeline, frame timings and the reports of the profiler, allocation audit and real-time mode """
+        if self.closed:
+            return
+
+        if self.event_stream is not None:
+            self.event_stream.poll(self.global_log)
+
+        if self.realtime is not None:
+            self.realtime.stop()
+
+        super().close()
+        if self.trigger_listener is not None:
+            self.trigger_listener.stop()
+            if len(self.trigger_latencies) > 0:
+                latencies = np.array(self.trigger_latencies)*1000
+                print(f"Received {self.trigger_listener.n_pulses} triggers; trigger-to-flip latency = {round(latencies[0],2)}ms for the first, {round(latencies.mean(),2)}ms on average (max {round(latencies.max(),2)}ms)")
+
+        if self.event_stream is not None:
+            self.event_stream.close()
+
+        # typed arrays for analysis and a BIDS events-file
+        if self.settings['various'].get('columnar_log'):
+            save_run(self)
+
+        if self.scheduler is not None:
+            self.scheduler.save(self.output_dir, self.output_str)
+
+        # planned timing, to compare with the log
+        if self.timeline is not None:
+            self.timeline.save(opj(self.output_dir, self.output_str+"_timeline.npz"))
+
+        if self.frame_recorder is not None:
+            self.frame_recorder.save(self.output_dir, self.output_str)
+
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler.save(self.output_dir, self.output_str)
+
+        if self.allocation_audit is not None:
+            self.allocation_audit.stop()
+            self.allocation_audit.save(self.output_dir, self.output_str)
+
+        if self.realtime is not None:
+            self.realtime.save(self.output_dir, self.output_str)
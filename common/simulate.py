@@ -0,0 +1,275 @@
+import numpy as np
+import os
+import time
+
+def _noop(*args, **kwargs):
+    return None
+
+class VirtualClock():
+    """ Simulated time base; only moves when :meth:`advance` is called """
+
+    def __init__(self, start=None):
+        self.now = time.perf_counter() if start is None else start
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, dt):
+        self.now += dt
+
+class NullStim():
+    """ Stand-in for psychopy stimuli in simulation mode: accepts any argument, remembers attributes that are set and draws nothing """
+
+    def __init__(self, *args, **kwargs):
+        for key, val in kwargs.items():
+            setattr(self, key, val)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return _noop
+
+class VirtualWindow(NullStim):
+    """ Window that does not open anything; every flip advances the simulated clock by one frame """
+
+    simulator = None
+
+    def __init__(self, size=(1920,1080), units="pix", monitor=None, **kwargs):
+        super().__init__(**kwargs)
+        self.size                   = np.array(size)
+        self.units                  = units
+        self.monitor                = monitor
+        self.frameIntervals         = []
+        self.recordFrameIntervals   = False
+        self.nDroppedFrames         = 0
+        self._to_call               = []
+        self._last_flip             = None
+
+    def callOnFlip(self, function, *args, **kwargs):
+        self._to_call.append((function, args, kwargs))
+
+    def flip(self, clearBuffer=True):
+        self.simulator.advance_frame()
+        now = self.simulator.clock()
+
+        for function, args, kwargs in self._to_call:
+            function(*args, **kwargs)
+        self._to_call = []
+
+        if self.recordFrameIntervals and self._last_flip is not None:
+            self.frameIntervals.append(now-self._last_flip)
+        self._last_flip = now
+
+        return now
+
+    def getActualFrameRate(self, *args, **kwargs):
+        return self.simulator.frame_rate
+
+    def close(self):
+        self.simulator.n_windows_closed += 1
+
+class SimulatedPulseTrain():
+
+    def __init__(self, tr, start, drift=0., jitter=0., rng=None):
+        """ Scanner pulses that drift and jitter relative to the (simulated) psychopy clock: pulse `i` arrives at `start + i*tr*(1+drift)`, displaced by Gaussian jitter with a standard deviation of `jitter` seconds """
+        self.tr         = tr
+        self.start      = start
+        self.drift      = drift
+        self.jitter     = jitter
+        self.rng        = np.random.default_rng() if rng is None else rng
+        self.n_pulses   = 0
+        self.next       = self._time(0)
+
+    def _time(self, i):
+        t = self.start + i*self.tr*(1+self.drift)
+        if self.jitter > 0:
+            t += self.rng.normal(0, self.jitter)
+        return t
+
+    def pop(self):
+        t = self.next
+        self.n_pulses += 1
+        self.next = max(self._time(self.n_pulses), t)
+        return t
+
+class Simulator():
+
+    # psychopy.visual stimuli that are replaced by NullStim
+    stimuli = [
+        "TextStim", "ShapeStim", "Circle", "RadialStim", "MovieStim3", "ImageStim", "GratingStim",
+        "BufferImageStim", "ElementArrayStim", "Rect", "Line", "Polygon"]
+
+    def __init__(
+        self,
+        frame_rate=60.,
+        tr=None,
+        trigger_key=None,
+        trigger_delay=1.,
+        dropped_frames=0.,
+        tr_drift=0.,
+        tr_jitter=0.,
+        seed=None,
+        verbose=True):
+
+        """ Headless, faster-than-real-time simulation of a session.
+
+        Replaces the psychopy window by a :class:`VirtualWindow`, all psychopy stimuli by :class:`NullStim`, psychopy's time base by a simulated clock that advances one frame per flip, and the keyboard by a simulated scanner that sends a trigger every `tr` seconds. Trial construction, the draw loop and logging run unchanged, as fast as the CPU allows.
+
+        The simulator must be installed *before* exptools2 and the experiment modules are imported, so that their `from psychopy.visual import ...` statements pick up the replacements, e.g.::
+
+            with Simulator(frame_rate=120) as sim:
+                from session import MotorSession
+                session = MotorSession(...)
+                sim.attach(session)
+                session.run()
+
+        Parameters
+        ----------
+        frame_rate : float
+            Simulated refresh rate (Hz)
+        tr : float, optional
+            Interval between simulated scanner triggers; read from the `mri` block of the session settings in :meth:`attach` if None (or 1s if not set)
+        trigger_key : str, optional
+            Key sent as scanner trigger; taken from `session.mri_trigger` in :meth:`attach` if None
+        trigger_delay : float
+            Time after :meth:`attach` at which the first trigger arrives
+        dropped_frames : float
+            Probability of simulating a dropped frame on each flip
+        tr_drift : float
+            Relative deviation of the scanner's TR from `tr` (e.g., 1e-4 makes the scanner clock 0.1ms/s slow), see :class:`SimulatedPulseTrain`
+        tr_jitter : float
+            Standard deviation of the timing of the triggers (s)
+        seed : int, optional
+            Seed for the dropped-frame and trigger simulation
+        verbose : bool
+            Print information on the simulation
+        """
+        self.frame_rate         = frame_rate
+        self.frame_period       = 1/frame_rate
+        self.tr                 = tr
+        self.trigger_key        = trigger_key
+        self.trigger_delay      = trigger_delay
+        self.dropped_frames     = dropped_frames
+        self.tr_drift           = tr_drift
+        self.tr_jitter          = tr_jitter
+        self.rng                = np.random.default_rng(seed)
+        self.verbose            = verbose
+        self.clock              = VirtualClock()
+        self.pulse_train        = None
+        self.n_frames           = 0
+        self.n_windows_closed   = 0
+        self._patched           = []
+
+    def _patch(self, obj, name, value):
+        self._patched.append((obj, name, getattr(obj, name, None)))
+        setattr(obj, name, value)
+
+    def install(self):
+        """ Patch psychopy; call before importing exptools2 or the experiment modules """
+
+        # never try to open a display
+        os.environ.setdefault("MPLBACKEND", "Agg")
+        try:
+            import pyglet
+            pyglet.options['shadow_window'] = False
+        except Exception:
+            pass
+
+        from psychopy import clock, event, visual
+
+        # continue from psychopy's time base, so clocks created before now stay consistent
+        self.clock.now = clock.getTime()
+        self._patch(clock, "getTime", self.clock)
+        self._patch(visual, "Window", type("VirtualWindow", (VirtualWindow,), {"simulator": self}))
+        for stim in self.stimuli:
+            self._patch(visual, stim, NullStim)
+
+        self._patch(event, "getKeys", self.getKeys)
+        self._patch(event, "waitKeys", self.waitKeys)
+        self._patch(event, "clearEvents", _noop)
+        self._patch(event, "Mouse", NullStim)
+
+        self.start_time = time.perf_counter()
+        return self
+
+    def uninstall(self):
+        for obj, name, value in self._patched[::-1]:
+            setattr(obj, name, value)
+        self._patched = []
+
+        if self.verbose:
+            elapsed = time.perf_counter()-self.start_time
+            simulated = self.n_frames*self.frame_period
+            print(f"Simulated {self.n_frames} frames ({round(simulated,2)}s) in {round(elapsed,2)}s ({round(simulated/max(elapsed,1e-9),1)}x real-time)")
+
+    def __enter__(self):
+        return self.install()
+
+    def __exit__(self, *args):
+        self.uninstall()
+
+    def attach(self, session):
+        """ Take the trigger key and TR from `session` and schedule the first trigger """
+
+        if self.trigger_key is None:
+            self.trigger_key = getattr(session, "mri_trigger", None) or "t"
+
+        if self.tr is None:
+            self.tr = session.settings.get("mri", {}).get("TR") or 1.
+
+        self.pulse_train = SimulatedPulseTrain(
+            self.tr,
+            self.clock() + self.trigger_delay,
+            drift=self.tr_drift,
+            jitter=self.tr_jitter,
+            rng=self.rng)
+
+        if self.verbose:
+            print(f"Simulating '{self.trigger_key}'-triggers every {self.tr}s (drift = {self.tr_drift}, jitter = {self.tr_jitter}s) at {self.frame_rate}Hz")
+
+    @property
+    def next_trigger(self):
+        return self.pulse_train.next if self.pulse_train is not None else np.inf
+
+    @property
+    def n_triggers(self):
+        return self.pulse_train.n_pulses if self.pulse_train is not None else 0
+
+    def advance_frame(self):
+        n = 1
+        if self.dropped_frames > 0 and self.rng.random() < self.dropped_frames:
+            n += 1
+
+        self.clock.advance(n*self.frame_period)
+        self.n_frames += 1
+
+    def getKeys(self, keyList=None, modifiers=False, timeStamped=False):
+        """ Replacement for `psychopy.event.getKeys`; returns the triggers that arrived since the last call """
+
+        keys = []
+        now = self.clock()
+        while self.next_trigger <= now:
+            t = self.pulse_train.pop()
+            if keyList is None or self.trigger_key in keyList:
+                if hasattr(timeStamped, "getTime"):
+                    keys.append((self.trigger_key, timeStamped.getTime()-(now-t)))
+                elif timeStamped:
+                    keys.append((self.trigger_key, t))
+                else:
+                    keys.append(self.trigger_key)
+
+        return keys
+
+    def waitKeys(self, maxWait=float('inf'), keyList=None, modifiers=False, timeStamped=False, **kwargs):
+        """ Replacement for `psychopy.event.waitKeys`; advances the simulated clock until a trigger arrives """
+
+        start = self.clock()
+        while self.clock()-start < maxWait:
+            keys = self.getKeys(keyList=keyList, timeStamped=timeStamped)
+            if keys:
+                return keys
+            if not np.isfinite(self.next_trigger):
+                return None
+            self.clock.advance(max(self.next_trigger-self.clock(), 0))
+
+        return None
@@ -0,0 +1,113 @@
+import contextlib
+import functools
+import time
+
+class StartupProfile():
+
+    def __init__(self, enabled=True):
+        """ Breaks down where the time goes between launching `main.py` and the first trigger screen.
+
+        Time is attributed to named sections, either with the :meth:`section` context manager (e.g., around imports) or by instrumenting methods with :meth:`instrument` (e.g., window creation in exptools2's `Session`). A section that runs within another one is only counted once: its time is taken out of the outer section (e.g., stimuli that are created while waiting for the scanner). :meth:`report_before` prints the report when a method is called for the first time, so it can be hooked into `start_experiment` or the first trial. When disabled, everything is a no-op.
+
+        Parameters
+        ----------
+        enabled : bool
+            Record and report timings (`--profile-startup`)
+        """
+        self.enabled    = enabled
+        self.start      = time.perf_counter()
+        self.sections   = {}
+        self.order      = []
+        self.reported   = False
+        self._patched   = []
+        self._nested    = []
+
+    def add(self, name, elapsed):
+        if name not in self.sections:
+            self.sections[name] = [0., 0]
+            self.order.append(name)
+
+        self.sections[name][0] += elapsed
+        self.sections[name][1] += 1
+
+    @contextlib.contextmanager
+    def _timing(self, name):
+
+        # time of the sections that run within this one, which is not counted twice
+        start = time.perf_counter()
+        self._nested.append(0.)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter()-start
+            self.add(name, elapsed-self._nested.pop())
+            if len(self._nested) > 0:
+                self._nested[-1] += elapsed
+
+    @contextlib.contextmanager
+    def section(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        with self._timing(name):
+            yield
+
+    def _patch(self, cls, method, wrapper):
+        self._patched.append((cls, method, cls.__dict__.get(method)))
+        setattr(cls, method, wrapper)
+
+    def instrument(self, cls, method, name=None):
+        """ Time every call of `cls.method` as section `name` (default: the method name) """
+
+        if not self.enabled:
+            return
+
+        name = method if name is None else name
+        fn = getattr(cls, method)
+
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            with self._timing(name):
+                return fn(*args, **kwargs)
+
+        self._patch(cls, method, timed)
+
+    def report_before(self, cls, method, until="first trigger screen"):
+        """ Print the report just before `cls.method` is called for the first time; `until` names that moment in the report """
+
+        if not self.enabled:
+            return
+
+        fn = getattr(cls, method)
+
+        @functools.wraps(fn)
+        def report_first(*args, **kwargs):
+            if not self.reported:
+                self.report(until=until)
+            return fn(*args, **kwargs)
+
+        self._patch(cls, method, report_first)
+
+    def restore(self):
+        for cls, method, fn in self._patched[::-1]:
+            if fn is None:
+                delattr(cls, method)
+            else:
+                setattr(cls, method, fn)
+        self._patched = []
+
+    def report(self, until="first trigger screen"):
+        if not self.enabled:
+            return
+
+        total = time.perf_counter()-self.start
+        print(f"\nStartup profile ({round(total,3)}s until {until})")
+        for name in self.order:
+            elapsed, n_calls = self.sections[name]
+            calls = f" ({n_calls} calls)" if n_calls > 1 else ""
+            print(f"  {name:<12} {elapsed:8.3f}s {100*elapsed/total:6.1f}%{calls}")
+
+        other = total-sum(elapsed for elapsed, _ in self.sections.values())
+        print(f"  {'other':<12} {other:8.3f}s {100*other/total:6.1f}%\n")
+        self.reported = True
@@ -0,0 +1,189 @@
+import numpy as np
+
+# one row per phase of every trial; trials without a condition or trajectory have -1 there
+TIMELINE_DTYPE = np.dtype([
+    ("trial_nr", np.int32),
+    ("phase", np.int16),
+    ("name", "U8"),
+    ("onset", np.float64),
+    ("duration", np.float64),
+    ("condition", np.int16),
+    ("traj_offset", np.int32),
+    ("traj_length", np.int32)
+])
+
+class Timeline():
+
+    def __init__(self, rows, conditions, trajectories=None):
+        """ Planned timing of a run as a single structured array.
+
+        Every phase of every trial is one row of :attr:`rows` (see `TIMELINE_DTYPE`): trial number, phase index and name, onset (seconds after the first pulse; NaN for the phase that waits for it), duration, condition (index into `conditions`) and the slice of `trajectories` the trial moves along. Sessions build their trials from it (:attr:`trial_nrs`, :meth:`phase_durations`, ...) rather than from loose design attributes, and it is saved next to the logs (:meth:`save`), so that the planned timing of a run can be compared to what happened.
+
+        Parameters
+        ----------
+        rows : numpy.ndarray
+            Structured array with `TIMELINE_DTYPE`, sorted by trial and phase
+        conditions : list
+            Names of the condition codes
+        trajectories : numpy.ndarray, optional
+            (n_positions,2) positions of all trials, concatenated
+        """
+        self.rows           = rows
+        self.conditions     = list(conditions)
+        self.trajectories   = np.zeros((0,2)) if trajectories is None else np.asarray(trajectories, dtype=float)
+        self._index()
+
+    def _index(self):
+
+        # first row of each trial, so that a trial is a slice of the rows
+        self.trial_nrs, self.starts, counts = np.unique(self.rows["trial_nr"], return_index=True, return_counts=True)
+        self.stops = self.starts+counts
+
+    @classmethod
+    def from_design(cls, durations, phase_names, condition, conditions, start_duration, end_duration, n_steps=None, coordinates=None):
+        """from_design
+
+        Builds the timeline of a run: a dummy trial (waiting for the first pulse, then `start_duration`), one trial per row of `durations`, and an outro trial of `end_duration`.
+
+        Parameters
+        ----------
+        durations: numpy.ndarray
+            (n_trials,n_phases) duration of each phase of each trial
+        phase_names: list
+            Name of each phase
+        condition: numpy.ndarray
+            Condition code of each trial
+        conditions: list
+            Names of the condition codes
+        start_duration: float
+            Baseline after the first pulse
+        end_duration: float
+            Baseline at the end
+        n_steps: numpy.ndarray, optional
+            Number of positions of each trial
+        coordinates: numpy.ndarray, optional
+            (n_trials,max_steps,2) positions of each trial, padded beyond `n_steps`
+
+        Returns
+        ----------
+        Timeline
+        """
+
+        durations = np.atleast_2d(np.asarray(durations, dtype=float))
+        n_trials, n_phases = durations.shape
+        if len(condition) != n_trials:
+            raise ValueError(f"Mismatch between number of conditions ({len(condition)}) and number of trials ({n_trials})")
+
+        rows = np.zeros(n_trials*n_phases+3, dtype=TIMELINE_DTYPE)
+        rows["condition"] = -1
+        rows["traj_offset"] = -1
+
+        # dummy trial: the wait for the first pulse, then the baseline
+        rows[:2]["trial_nr"] = 0
+        rows[:2]["phase"] = [0,1]
+        rows[:2]["name"] = ["dummy","intro"]
+        rows[:2]["duration"] = [np.inf, start_duration]
+
+        trials = rows[2:-1]
+        trials["trial_nr"] = np.repeat(np.arange(1,n_trials+1), n_phases)
+        trials["phase"] = np.tile(np.arange(n_phases), n_trials)
+        trials["name"] = np.tile(phase_names, n_trials)
+        trials["duration"] = durations.ravel()
+        trials["condition"] = np.repeat(condition, n_phases)
+
+        rows["trial_nr"][-1] = n_trials+1
+        rows["name"][-1] = "outro"
+        rows["duration"][-1] = end_duration
+
+        # onsets after the first pulse
+        rows["onset"][0] = np.nan
+        rows["onset"][1:] = np.concatenate([[0], np.cumsum(rows["duration"][1:-1])])
+
+        # trajectories, concatenated without the padding
+        trajectories = None
+        if n_steps is not None:
+            n_steps = np.asarray(n_steps, dtype=int)
+            offsets = np.concatenate([[0], np.cumsum(n_steps)[:-1]])
+            trials["traj_offset"] = np.repeat(offsets, n_phases)
+            trials["traj_length"] = np.repeat(n_steps, n_phases)
+            if coordinates is not None:
+                coordinates = np.asarray(coordinates, dtype=float)
+                trajectories = coordinates[np.arange(coordinates.shape[1])[None,:] < n_steps[:,None]]
+
+        return cls(rows, conditions, trajectories=trajectories)
+
+    @property
+    def n_trials(self):
+        """ Number of experimental trials (i.e., without the dummy and outro trial) """
+        return self.trial_nrs.size-2
+
+    @property
+    def total_duration(self):
+        """ Time from the first pulse until the end of the run """
+        return float(self.rows["duration"][1:].sum())
+
+    def pad(self, intended_duration):
+        """ Extends the outro so that the run lasts `intended_duration`; returns the added time. Raises a ValueError if the run is already longer """
+
+        if not isinstance(intended_duration, (int,float)):
+            return 0
+
+        total = self.total_duration
+        if intended_duration < total:
+            raise ValueError(f"WARNING: intended duration ({intended_duration}) is smaller than total experiment time ({total})")
+
+        added = intended_duration-total
+        self.rows["duration"][-1] += added
+        return added
+
+    def trial(self, trial_nr):
+        """ Rows of `trial_nr` """
+        ix = np.searchsorted(self.trial_nrs, trial_nr)
+        return self.rows[self.starts[ix]:self.stops[ix]]
+
+    def phase_durations(self, trial_nr):
+        return self.trial(trial_nr)["duration"].tolist()
+
+    def phase_names(self, trial_nr):
+        return self.trial(trial_nr)["name"].tolist()
+
+    def condition(self, trial_nr):
+        """ Name of the condition of `trial_nr`, or None """
+        code = self.trial(trial_nr)["condition"][0]
+        return self.conditions[code] if code >= 0 else None
+
+    def trajectory(self, trial_nr):
+        """ (n_steps,2) positions of `trial_nr` """
+        row = self.trial(trial_nr)[0]
+        return self.trajectories[row["traj_offset"]:row["traj_offset"]+row["traj_length"]]
+
+    def onsets(self):
+        """ Trial number -> planned onset of every trial after the dummy trial """
+        first = self.rows[self.starts[1:]]
+        return dict(zip(first["trial_nr"].tolist(), first["onset"].tolist()))
+
+    def summary(self):
+        """ Number of trials, time in the first phase and time in the other phases per condition """
+
+        trials = self.rows[self.rows["condition"] >= 0]
+        first = trials["phase"] == 0
+        n = np.bincount(trials["condition"][first], minlength=len(self.conditions))
+        stim = np.bincount(trials["condition"][first], weights=trials["duration"][first], minlength=len(self.conditions))
+        rest = np.bincount(trials["condition"][~first], weights=trials["duration"][~first], minlength=len(self.conditions))
+        return {name: {"n_trials": int(n[i]), "stim": float(stim[i]), "rest": float(rest[i])} for i, name in enumerate(self.conditions)}
+
+    def save(self, fname):
+        """ Writes the rows, condition names and trajectories to a single (uncompressed) `.npz` """
+        np.savez(fname, rows=self.rows, conditions=np.asarray(self.conditions, dtype=str), trajectories=self.trajectories)
+        return fname
+
+    @classmethod
+    def load(cls, fname):
+        with np.load(fname, allow_pickle=False) as f_in:
+            return cls(f_in["rows"], f_in["conditions"].tolist(), trajectories=f_in["trajectories"])
+
+    def __len__(self):
+        return self.rows.size
+
+    def __repr__(self):
+        return f"Timeline({self.n_trials} trials, {len(self.rows)} phases, {round(self.total_duration,2)}s)"
@@ -0,0 +1,218 @@
+import argparse
+import numpy as np
+import os
+import queue
+import threading
+import time
+
+def default_clock():
+
+    # psychopy's time base (also used by the session clocks), or perf_counter without psychopy
+    try:
+        from psychopy import clock
+        return lambda: clock.getTime()
+    except ImportError:
+        return time.perf_counter
+
+class KeyboardSource():
+
+    def __init__(self, key="t", poll_interval=0.0005):
+        """ Trigger key presses from psychopy's `Keyboard` with the psychtoolbox backend, which timestamps key presses itself (in psychopy's time base) and can be polled from any thread """
+
+        from psychopy.hardware.keyboard import Keyboard
+        self.key = key
+        self.poll_interval = poll_interval
+        self.keyboard = Keyboard(backend="ptb")
+        if self.keyboard.getBackend() != "ptb":
+            print(f"WARNING: keyboard backend is '{self.keyboard.getBackend()}' rather than 'ptb'; trigger timestamps are as accurate as the polling")
+
+    def read(self, timeout=None):
+        keys = self.keyboard.getKeys(keyList=[self.key], waitRelease=False, clear=True)
+        if not keys and timeout:
+            time.sleep(self.poll_interval)
+        return [key.tDown for key in keys]
+
+    def close(self):
+        pass
+
+class SerialSource():
+
+    def __init__(self, port, baudrate=115200, trigger="t", get_time=None):
+        """ Triggers arriving as bytes on a serial port (e.g., a scanner trigger box); each byte equal to `trigger` is timestamped as soon as the read returns """
+
+        import serial
+        self.serial = serial.Serial(port, baudrate=baudrate, timeout=0.1)
+        self.trigger = trigger.encode() if isinstance(trigger, str) else bytes([trigger])
+        self.get_time = default_clock() if get_time is None else get_time
+
+    def read(self, timeout=None):
+        self.serial.timeout = timeout
+        data = self.serial.read(max(self.serial.in_waiting, 1))
+        t = self.get_time()
+        return [t]*data.count(self.trigger)
+
+    def close(self):
+        self.serial.close()
+
+class PtyTriggerBox():
+
+    def __init__(self, tr=1., n_pulses=None, trigger="t", delay=1.):
+        """ Stand-in for a serial trigger box: a pseudo-terminal to which a thread writes `trigger` every `tr` seconds. Open :attr:`port` with :class:`SerialSource` (or set it as `port` in the trigger-settings). POSIX only.
+
+        Parameters
+        ----------
+        tr : float
+            Interval between pulses (s)
+        n_pulses : int, optional
+            Stop after this many pulses (default: continue until :meth:`stop`)
+        trigger : str
+            Byte that is sent for every pulse
+        delay : float
+            Time until the first pulse (s)
+        """
+        import pty
+        self.master, self.slave = pty.openpty()
+        self.port = os.ttyname(self.slave)
+        self.tr = tr
+        self.n_pulses = n_pulses
+        self.trigger = trigger.encode()
+        self.delay = delay
+        self.sent = []
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._send, name="pty-trigger-box", daemon=True)
+        self.thread.start()
+        return self
+
+    def _send(self):
+        t_next = time.perf_counter() + self.delay
+        while self.running and (self.n_pulses is None or len(self.sent) < self.n_pulses):
+            time.sleep(max(t_next-time.perf_counter()-0.002, 0))
+            while time.perf_counter() < t_next:
+                pass
+            self.sent.append(time.perf_counter())
+            os.write(self.master, self.trigger)
+            t_next += self.tr
+
+    def stop(self):
+        self.running = False
+        os.close(self.master)
+        os.close(self.slave)
+
+class TriggerListener():
+
+    def __init__(self, source, threaded=True, verbose=True):
+        """ Listens for scanner triggers independently of the frame loop.
+
+        A background thread blocks on `source` and puts the timestamp of every pulse on a queue, which the session drains once per frame (:meth:`drain`). Timestamps are therefore as precise as the source (psychtoolbox' keyboard queue or the serial read), rather than quantized to the frame interval. With `threaded=False`, :meth:`drain` polls the source directly (used for simulated sources that run on simulated time).
+
+        Parameters
+        ----------
+        source : object
+            Has `read(timeout)`, returning the timestamps of the pulses that arrived (in psychopy's time base), and `close()`
+        threaded : bool
+            Read the source on a background thread
+        verbose : bool
+            Print information on the listener
+        """
+        self.source     = source
+        self.threaded   = threaded
+        self.verbose    = verbose
+        self.queue      = queue.SimpleQueue()
+        self.n_pulses   = 0
+        self.running    = False
+        self.thread     = None
+
+    def start(self):
+        if self.threaded and self.thread is None:
+            self.running = True
+            self.thread = threading.Thread(target=self._listen, name="trigger-listener", daemon=True)
+            self.thread.start()
+
+        if self.verbose:
+            print(f"Listening for triggers on {self.source.__class__.__name__}")
+
+    def _listen(self):
+        while self.running:
+            for t in self.source.read(timeout=0.1):
+                self.queue.put(t)
+
+    def drain(self):
+        """ Timestamps of all pulses that arrived since the last call """
+
+        if not self.threaded:
+            pulses = list(self.source.read(timeout=0))
+        else:
+            pulses = []
+            while True:
+                try:
+                    pulses.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+        self.n_pulses += len(pulses)
+        return pulses
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(timeout=1)
+            self.thread = None
+
+        self.source.close()
+
+def create_trigger_listener(settings, trigger_key="t"):
+    """ Listener for the `triggers`-block of the settings, or None if `source` is not set. `source` is 'keyboard' (psychtoolbox keyboard, key `trigger_key`) or 'serial' (with `port`, `baudrate` and the `trigger` byte) """
+
+    settings = {} if settings is None else settings
+    source = settings.get("source")
+    if source == "keyboard":
+        return TriggerListener(KeyboardSource(key=trigger_key))
+    elif source == "serial":
+        return TriggerListener(SerialSource(
+            settings.get("port"),
+            baudrate=settings.get("baudrate", 115200),
+            trigger=settings.get("trigger", trigger_key)))
+    elif source in [None, "None"]:
+        return None
+    else:
+        raise ValueError(f"Trigger source must be 'keyboard', 'serial' or None, not '{source}'")
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Serve triggers on a pseudo-terminal (to test the serial trigger input without a scanner), or measure the timestamp error of the listener against it")
+    parser.add_argument('--tr', type=float, default=1.)
+    parser.add_argument('--n_pulses', type=int, default=None)
+    parser.add_argument('--trigger', default="t")
+    parser.add_argument('--test', action='store_true', help="listen on the pty and report the timestamp error per pulse")
+    args = parser.parse_args()
+
+    if args.test:
+        n_pulses = 20 if args.n_pulses is None else args.n_pulses
+        box = PtyTriggerBox(tr=args.tr, n_pulses=n_pulses, trigger=args.trigger, delay=0.5)
+        listener = TriggerListener(SerialSource(box.port, trigger=args.trigger, get_time=time.perf_counter))
+        listener.start()
+        box.start()
+
+        received = []
+        while len(received) < n_pulses:
+            received += listener.drain()
+            time.sleep(0.016)
+
+        listener.stop()
+        box.stop()
+        error = (np.array(received)-np.array(box.sent))*1000
+        print(f"{n_pulses} pulses; timestamp error = {error.mean():.3f}ms (sd {error.std():.3f}ms, max {error.max():.3f}ms)")
+    else:
+        box = PtyTriggerBox(tr=args.tr, n_pulses=args.n_pulses, trigger=args.trigger).start()
+        print(f"Sending '{args.trigger}' every {args.tr}s on {box.port}; set this as `port` in the trigger-settings (Ctrl+C to stop)")
+        try:
+            box.thread.join()
+        except KeyboardInterrupt:
+            pass
+        box.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,347 @@
+import argparse
+import contextlib
+from datetime import datetime
+import importlib
+import os
+import shlex
+import socket
+import sys
+import tempfile
+import time
+import yaml
+opj = os.path.join
+opd = os.path.dirname
+
+ROOT = opd(os.path.abspath(__file__))
+
+# name -> directory, session class, condition used to preload all stimuli, default condition
+EXPERIMENTS = {
+    "motor": ("BlockFingertap", "MotorSession", "RBL", "RL"),
+    "gaze": ("StarGaze", "StarSession", "gaze", "gaze")
+}
+
+# settings of the warm-up sessions: nothing that writes files or talks to hardware
+WARMUP_SETTINGS = {
+    "various": {"record_frames": False, "stream_events": False, "columnar_log": False, "profile_calls": False, "realtime": False, "audit_allocations": False},
+    "triggers": {"source": None},
+    "eyetracker": {"gaze_monitor": None},
+    "design": {"gaze_contingent": None}
+}
+
+def _keep_open():
+    pass
+
+class Experiment():
+
+    def __init__(self, name, directory, class_name, preload_condition, default_condition):
+        """ One experiment directory, loaded into a process that also holds other experiments.
+
+        The experiments import their modules by bare name (`session`, `trial`, `stimuli`, ...), and both directories have modules with the same names. The modules of an experiment are therefore only in `sys.modules` (and its directory on `sys.path` and as working directory) while it is :meth:`active`; in between they are kept in :attr:`modules`, and the functions and classes in them keep working because they hold on to their own module namespace.
+
+        Parameters
+        ----------
+        name : str
+            Name used in commands (e.g., 'motor')
+        directory : str
+            Directory of the experiment, relative to this file
+        class_name : str
+            Name of the session class in `session.py`
+        preload_condition : str
+            Condition of the warm-up session, so that it creates all stimuli
+        default_condition : str
+            Condition if a command does not give one
+        """
+        self.name               = name
+        self.directory          = opj(ROOT, directory)
+        self.class_name         = class_name
+        self.preload_condition  = preload_condition
+        self.default_condition  = default_condition
+        self.settings_file      = opj(self.directory, "settings.yml")
+        self.modules            = {}
+        self.stim_cache         = {}
+        self.session_class      = None
+
+    def _owns(self, module):
+        fname = getattr(module, "__file__", None)
+        return isinstance(fname, str) and opd(os.path.abspath(fname)) == self.directory
+
+    @contextlib.contextmanager
+    def active(self):
+        """ Makes the modules of this experiment importable by their bare names, with the experiment directory as working directory """
+
+        cwd = os.getcwd()
+        sys.path.insert(0, self.directory)
+        sys.modules.update(self.modules)
+        os.chdir(self.directory)
+        try:
+            yield self
+        finally:
+            os.chdir(cwd)
+            sys.path.remove(self.directory)
+
+            # also take out modules that were imported while active
+            for name, module in list(sys.modules.items()):
+                if self._owns(module):
+                    self.modules[name] = sys.modules.pop(name)
+
+    def import_module(self, name):
+        with self.active():
+            return importlib.import_module(name)
+
+    def load(self):
+        self.session_class = getattr(self.import_module("session"), self.class_name)
+        return self
+
+    def output_name(self, subject, session, run, condition, acquisition=None):
+        """ Condition (with aliases resolved) and basename of the output of a run, as `main.py` of the experiment would name them """
+
+        utils = self.modules.get("utils")
+        if hasattr(utils, "conform_condition"):
+            condition = utils.conform_condition(condition)
+
+        if hasattr(utils, "output_name"):
+            return condition, utils.output_name(subject, session, run, condition, acquisition)
+
+        add_acq = f"_acq-{acquisition}" if acquisition not in [None, "None"] else ""
+        return condition, f"sub-{subject}_ses-{session}_run-{run}_task-{condition}{add_acq}"
+
+    def warmup_settings(self, out_dir):
+        """ Copy of the settings without streaming, logging, trigger or eye-tracker input (see `WARMUP_SETTINGS`) """
+
+        with open(self.settings_file, 'r', encoding='utf8') as f_in:
+            settings = yaml.safe_load(f_in)
+
+        for block, values in WARMUP_SETTINGS.items():
+            if block in settings:
+                settings[block].update(values)
+
+        fname = opj(out_dir, f"{self.name}_settings.yml")
+        with open(fname, 'w', encoding='utf8') as f_out:
+            yaml.safe_dump(settings, f_out)
+
+        return fname
+
+class Runner():
+
+    def __init__(self, experiments=None, window_from="motor", simulator=None, verbose=True):
+        """ Long-lived process that runs both experiments in one window.
+
+        At :meth:`start`, all experiments are imported (see :class:`Experiment`), the window is opened once from the settings of `window_from`, and a warm-up session of every experiment creates all its stimuli into a cache. Each :meth:`run` then creates a new session in the same window, with the cached stimuli (a stimulus is only created again if the stimulus-settings changed), so the next run starts without relaunching Python, importing psychopy or opening a window.
+
+        Parameters
+        ----------
+        experiments : list, optional
+            Names of the experiments to load (default: all in `EXPERIMENTS`)
+        window_from : str
+            Experiment whose `window`-settings are used
+        simulator : common.simulate.Simulator, optional
+            Installed simulator, for headless runs (`--simulate`)
+        verbose : bool
+            Print setup times
+        """
+        names = list(EXPERIMENTS) if experiments is None else list(experiments)
+        for name in names:
+            if name not in EXPERIMENTS:
+                raise ValueError(f"Experiment must be one of {list(EXPERIMENTS)}, not '{name}'")
+
+        if window_from not in names:
+            raise ValueError(f"Window-settings are taken from a loaded experiment ({names}), not '{window_from}'")
+
+        # the experiment with the window-settings goes first, so that it opens the window
+        names.sort(key=lambda name: name != window_from)
+        self.experiments    = {name: Experiment(name, *EXPERIMENTS[name]) for name in names}
+        self.simulator      = simulator
+        self.verbose        = verbose
+        self.win            = None
+        self.frame_rate     = None
+        self.n_runs         = 0
+
+    def start(self):
+        """ Imports the experiments, opens the window and creates the stimuli of all experiments """
+
+        start = time.perf_counter()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for experiment in self.experiments.values():
+                experiment.load()
+                with experiment.active():
+                    session = experiment.session_class(
+                        output_str=f"warmup_{experiment.name}",
+                        output_dir=tmp_dir,
+                        settings_file=experiment.warmup_settings(tmp_dir),
+                        condition=experiment.preload_condition,
+                        win=self.win,
+                        frame_rate=self.frame_rate,
+                        stim_cache=experiment.stim_cache)
+
+                    # stimuli that are otherwise created while waiting for the scanner; the warm-up is not closed, so stop their decoding here
+                    if hasattr(session, "get_stim"):
+                        for stim in session.events:
+                            session.get_stim(stim)
+                    if hasattr(session, "stop_movies"):
+                        session.stop_movies()
+
+                if self.win is None:
+                    self.win, self.frame_rate = session.win, session.actual_framerate
+                    self.win.close = _keep_open
+
+                self._reset_window()
+
+        if self.verbose:
+            n_stimuli = sum(len(experiment.stim_cache) for experiment in self.experiments.values())
+            print(f"Ready in {round(time.perf_counter()-start,2)}s: {', '.join(self.experiments)} with {n_stimuli} stimuli at {round(self.frame_rate,2)}Hz")
+
+        return self
+
+    def _reset_window(self):
+
+        # sessions wrap `win.flip` (frame recorder, event stream); start every run from the plain flip
+        vars(self.win).pop("flip", None)
+
+    def run(self, experiment, subject, session, run, condition=None, acquisition=None):
+        """ Runs one run of `experiment` in the shared window; returns the output directory """
+
+        if experiment not in self.experiments:
+            raise ValueError(f"Experiment must be one of {list(self.experiments)}, not '{experiment}'")
+
+        exp = self.experiments[experiment]
+        condition, output_str = exp.output_name(subject, session, run, exp.default_condition if condition is None else condition, acquisition)
+        output_dir = opj(exp.directory, "logs", output_str)
+        if os.path.exists(output_dir):
+            print("Warning: output directory already exists. Renaming to avoid overwriting.")
+            output_dir = output_dir + datetime.now().strftime('%Y%m%d%H%M%S')
+
+        start = time.perf_counter()
+        with exp.active():
+            session_object = exp.session_class(
+                output_str=output_str,
+                output_dir=output_dir,
+                settings_file=exp.settings_file,
+                condition=condition,
+                win=self.win,
+                frame_rate=self.frame_rate,
+                stim_cache=exp.stim_cache)
+
+            if self.verbose:
+                print(f"Set up {output_str} in {round((time.perf_counter()-start)*1000,1)}ms; writing results to {output_dir}")
+
+            if self.simulator is not None:
+                self.simulator.attach(session_object)
+
+            # quitting a run (exptools2 calls core.quit) returns to the runner
+            try:
+                session_object.run()
+                session_object.close()
+            except SystemExit:
+                print(f"Run {output_str} was quit")
+
+        self._reset_window()
+        self.n_runs += 1
+        return output_dir
+
+    def handle(self, command):
+        """ Runs the run in `command`: '<experiment> <subject> <session> <run> [condition] [acquisition]'; returns the reply to the sender """
+
+        args = shlex.split(command)
+        if len(args) == 0:
+            return "error: empty command"
+
+        if args[0] in ["quit", "exit"]:
+            return "quit"
+
+        if len(args) < 4:
+            return f"error: expected '<experiment> <subject> <session> <run> [condition] [acquisition]', got '{command.strip()}'"
+
+        try:
+            return "ok " + self.run(*args[:6])
+        except ValueError as e:
+            return f"error: {e}"
+
+    def prompt(self):
+        """ Reads commands from the console until 'quit' """
+
+        while True:
+            try:
+                command = input(f"Next run ({'/'.join(self.experiments)} subject session run [condition] [acquisition], or quit): ")
+            except EOFError:
+                return
+
+            reply = self.handle(command)
+            if reply == "quit":
+                return
+            print(reply)
+
+    def serve(self, port, host="127.0.0.1", poll_interval=0.5):
+        """ Reads commands from a local socket until 'quit'; one command per connection, answered with 'ok <output directory>' once the run is done, or 'error: ...' (see :func:`send`). The window is flipped while waiting, so it stays responsive """
+
+        with socket.create_server((host, port)) as server:
+            server.settimeout(poll_interval)
+            if self.verbose:
+                print(f"Waiting for commands on {host}:{port}")
+
+            while True:
+                try:
+                    conn, _ = server.accept()
+                except socket.timeout:
+                    self.win.flip()
+                    continue
+
+                with conn, conn.makefile('rw', encoding='utf8') as f:
+                    reply = self.handle(f.readline())
+                    f.write(reply+"\n")
+
+                if reply == "quit":
+                    return
+
+    def close(self):
+        if self.win is not None:
+            type(self.win).close(self.win)
+            self.win = None
+
+def send(command, port, host="127.0.0.1"):
+    """ Sends `command` to a runner that is serving on `port` and waits for the reply (i.e., until the run is done) """
+
+    with socket.create_connection((host, port)) as conn, conn.makefile('rw', encoding='utf8') as f:
+        f.write(command.strip()+"\n")
+        f.flush()
+        return f.readline().strip()
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Keep the window and stimuli of both experiments ready, and start runs on command")
+    parser.add_argument('commands', nargs='*', help="runs to do right away, e.g., 'motor 01 1 1 RBL'; without commands (or --port), commands are read from the console")
+    parser.add_argument('--port', type=int, default=None, help="read commands from this local port instead of the console")
+    parser.add_argument('--send', default=None, help="send a command to a runner on --port and wait for the reply")
+    parser.add_argument('--experiments', nargs='+', default=None, help=f"experiments to load (default: {' '.join(EXPERIMENTS)})")
+    parser.add_argument('--window', default="motor", help="experiment whose window-settings are used")
+    parser.add_argument('--simulate', action='store_true', help="run headless and faster than real-time with simulated scanner triggers")
+    parser.add_argument('--frame_rate', type=float, default=60., help="refresh rate in simulation mode")
+    args = parser.parse_args()
+
+    if args.send is not None:
+        if args.port is None:
+            parser.error("--send needs --port")
+        print(send(args.send, args.port))
+        return
+
+    # simulation must be installed before psychopy's window and stimuli are imported by the experiments
+    simulator = None
+    if args.simulate:
+        from common.simulate import Simulator
+        simulator = Simulator(frame_rate=args.frame_rate).install()
+
+    runner = Runner(experiments=args.experiments, window_from=args.window, simulator=simulator).start()
+    try:
+        for command in args.commands:
+            print(runner.handle(command))
+
+        if args.port is not None:
+            runner.serve(args.port)
+        elif len(args.commands) == 0:
+            runner.prompt()
+    finally:
+        runner.close()
+        if simulator is not None:
+            simulator.uninstall()
+
+if __name__ == "__main__":
+    main()